@@ -0,0 +1 @@
+"""Benchmarks of the archiver and downloader on synthetic data. Run with python -m benchmarks."""
@@ -0,0 +1,432 @@
+"""
+Benchmarks of the hot paths of the archiver and the downloader on synthetic data (see
+synthetic.py). Each benchmark is run at each of the requested scales, given as a number of
+months of data and a number of sites. Elapsed time and peak memory are measured for each
+benchmark, and the results are saved as JSON so that they can be compared between versions:
+
+    python -m benchmarks --months 1 --months 12 --sites 1 --sites 10 -o results.json
+    python -m benchmarks --months 1 --months 12 --sites 1 --sites 10 --compare results.json
+
+The synthetic data and databases of each scale are made in the work directory when first
+needed, so the benchmarks run without network access.
+
+Peak memory is measured with tracemalloc in a separate run of the benchmark, so that tracing
+does not slow down the timed runs. It counts the memory allocated by Python, numpy, and
+pandas, but not the page cache of sqlite.
+"""
+from forecast_dataset_tools import logging_config  # isort:skip
+
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import click
+import numpy as np
+import pandas as pd
+import sqlalchemy
+
+from forecast_dataset_tools.db_archiver import (
+    ABBInverterDataSet,
+    MeteogramForecast,
+    SolCastWeather,
+)
+from forecast_dataset_tools.db_archiver.base import interpolate_to_index
+from forecast_dataset_tools.db_archiver.bulk_writer import (
+    apply_sqlite_performance_profile,
+)
+from forecast_dataset_tools.downloader.mgm_havadurumu import MGMHavaDurumu
+from forecast_dataset_tools.downloader.solcast import SolcastService
+
+from . import synthetic
+
+_log = logging.getLogger(__name__)
+
+# (name, scale parameters that the benchmark depends on, function) of each benchmark. The
+# function is called with the Workspace of the scale to set up the benchmark, and returns
+# the function that is measured.
+benchmarks = []
+
+# Number of forecast queries made per site by the query benchmarks
+n_queries = 20
+
+
+def benchmark(name, depends=("months", "sites")):
+    def decorator(f):
+        benchmarks.append((name, depends, f))
+        return f
+
+    return decorator
+
+
+class Workspace:
+    """Synthetic data and databases of one scale, made in root when first needed."""
+
+    def __init__(self, root, months, sites):
+        self.root = root
+        self.months = months
+        self.sites = sites
+        self.start = synthetic.default_start
+        self.end = self.start + pd.DateOffset(months=months)
+        self._data_dirs = {}
+
+    def data_dir(self, kind):
+        """Directory of the synthetic files of kind, which is "abb", "solcast", or
+        "meteogram"."""
+        if kind not in self._data_dirs:
+            data_dir = os.path.join(self.root, "data", kind)
+            shutil.rmtree(data_dir, ignore_errors=True)
+            if kind == "abb":
+                synthetic.write_abb_files(data_dir, self.start, self.end)
+            elif kind == "solcast":
+                synthetic.write_solcast_files(data_dir, self.start, self.end, self.sites)
+            else:
+                synthetic.write_meteogram_files(data_dir, self.start, self.end, self.sites)
+            self._data_dirs[kind] = data_dir
+        return self._data_dirs[kind]
+
+    def data_size(self):
+        """Number of files and bytes of the synthetic data of each kind made so far."""
+        sizes = {}
+        for kind, data_dir in self._data_dirs.items():
+            files = [os.path.join(data_dir, f) for f in os.listdir(data_dir)]
+            sizes[kind] = {"files": len(files), "bytes": sum(map(os.path.getsize, files))}
+        return sizes
+
+    def engine(self, name):
+        """Engine of a new, empty database."""
+        db_file = os.path.join(self.root, f"{name}.sqlite")
+        for f in (db_file, db_file + "-wal", db_file + "-shm"):
+            if os.path.exists(f):
+                os.remove(f)
+        return self._engine(db_file)
+
+    def dataset(self, cls, kind, imported=False, **kwargs):
+        """Dataset of class cls for the files of kind. The database is new unless imported
+        is True, in which case it is a copy of a database with all of the files imported."""
+        data_dir = self.data_dir(kind)
+        if not imported:
+            return cls(data_dir=data_dir, db_engine=self.engine(kind), **kwargs)
+        imported_file = os.path.join(self.root, f"{kind}_imported.sqlite")
+        if not os.path.exists(imported_file):
+            engine = self.engine(f"{kind}_importing")
+            cls(data_dir=data_dir, db_engine=engine, **kwargs).import_new_data()
+            engine.dispose()
+            os.replace(engine.url.database, imported_file)
+        engine = self.engine(kind)
+        engine.dispose()
+        shutil.copy(imported_file, engine.url.database)
+        return cls(data_dir=data_dir, db_engine=engine, **kwargs)
+
+    @staticmethod
+    def _engine(db_file):
+        engine = sqlalchemy.create_engine(f"sqlite+pysqlite:///{db_file}", echo=False)
+        return apply_sqlite_performance_profile(engine)
+
+
+@benchmark("abb.read_files", depends=("months",))
+def abb_read_files(ws):
+    ds = ABBInverterDataSet(data_dir=ws.data_dir("abb"), db_engine=ws.engine("abb"))
+    return lambda: [ds._read_file(f) for f in ds.file_names]
+
+
+@benchmark("abb.import_new_data", depends=("months",))
+def abb_import_new_data(ws):
+    return ws.dataset(ABBInverterDataSet, "abb").import_new_data
+
+
+@benchmark("abb.rebuild_processed_data", depends=("months",))
+def abb_rebuild_processed_data(ws):
+    return ws.dataset(ABBInverterDataSet, "abb", imported=True)._rebuild_processed_data
+
+
+@benchmark("solcast.read_files")
+def solcast_read_files(ws):
+    ds = SolCastWeather(data_dir=ws.data_dir("solcast"), db_engine=ws.engine("solcast"))
+    return lambda: [ds._read_file(f) for f in ds.file_names]
+
+
+@benchmark("solcast.import_new_data")
+def solcast_import_new_data(ws):
+    return ws.dataset(SolCastWeather, "solcast").import_new_data
+
+
+@benchmark("solcast.rebuild_processed_data")
+def solcast_rebuild_processed_data(ws):
+    return ws.dataset(SolCastWeather, "solcast", imported=True)._rebuild_processed_data
+
+
+@benchmark("solcast.remove_duplicate_rows")
+def solcast_remove_duplicate_rows(ws):
+    """Deduplication of a forecast table made by a version without the unique key, in which
+    every forecast was imported twice."""
+    ds = ws.dataset(SolCastWeather, "solcast", imported=True)
+    fx = ds.data_table_fx
+    cols = [c.name for c in fx.columns if c.name != "id"]
+    legacy = sqlalchemy.Table(
+        fx.name + "_legacy",
+        sqlalchemy.MetaData(),
+        *[sqlalchemy.Column(c.name, c.type, primary_key=c.primary_key) for c in fx.columns],
+    )
+    with ds.db_engine.begin() as conn:
+        legacy.create(conn)
+        select = sqlalchemy.select(*[fx.c[c] for c in cols])
+        for _ in range(2):
+            conn.execute(sqlalchemy.insert(legacy).from_select(cols, select))
+    key = [legacy.c.site_id, legacy.c.current_dt, legacy.c.dt, legacy.c.type]
+    return lambda: ds._remove_duplicate_rows(legacy, key)
+
+
+def _query_origins(ws):
+    return pd.date_range(ws.start + pd.Timedelta("2D"), ws.end - pd.Timedelta("2D"),
+                         periods=n_queries).floor("1h")
+
+
+@benchmark("solcast.get_fx_by_date")
+def solcast_get_fx_by_date(ws):
+    """Forecasts issued before each of n_queries origins for the following day, for each
+    site."""
+    ds = ws.dataset(SolCastWeather, "solcast", imported=True)
+    origins = _query_origins(ws)
+    return lambda: [
+        ds.get_fx_by_date(site_id, origin, origin + pd.Timedelta("1D"))
+        for site_id in ds.ids
+        for origin in origins
+    ]
+
+
+@benchmark("solcast.get_fx_by_date_latest")
+def solcast_get_fx_by_date_latest(ws):
+    """Latest forecasts for the day after each of n_queries origins, for each site."""
+    ds = ws.dataset(SolCastWeather, "solcast", imported=True)
+    origins = _query_origins(ws)
+    return lambda: [
+        ds.get_fx_by_date(site_id, origin, origin + pd.Timedelta("1D"), past=False)
+        for site_id in ds.ids
+        for origin in origins
+    ]
+
+
+@benchmark("meteogram.import_new_data")
+def meteogram_import_new_data(ws):
+    return ws.dataset(MeteogramForecast, "meteogram").import_new_data
+
+
+@benchmark("interpolate_to_index", depends=("months",))
+def interpolate(ws):
+    """Interpolation of irregularly sampled data, about every 5 minutes, to a 1 minute
+    index."""
+    rng = np.random.default_rng(0)
+    n = int((ws.end - ws.start) / pd.Timedelta("5min"))
+    dt = ws.start + pd.to_timedelta(np.cumsum(rng.uniform(240, 360, n)), unit="s")
+    df = pd.DataFrame(rng.uniform(0, 1000, (n, 3)), index=pd.DatetimeIndex(dt, name="dt"),
+                      columns=["a", "b", "c"])
+    index = pd.date_range(df.index[0].ceil("1min"), df.index[-1].floor("1min"), freq="1min")
+    return lambda: interpolate_to_index(df, index)
+
+
+@benchmark("download.solcast.parse", depends=("sites",))
+def download_solcast_parse(ws):
+    """Parsing of the responses of one download from each site."""
+    svc = SolcastService(api_key=None)
+    issue_time = ws.start + pd.Timedelta("1D")
+    sites = list(synthetic.locations(ws.sites).itertuples())
+    responses = [synthetic.solcast_response(issue_time, synthetic._rng(0, 4, i))
+                 for i in range(len(sites))]
+    return lambda: pd.concat([svc._parse(site, r) for site, r in zip(sites, responses)])
+
+
+@benchmark("download.mgm.parse", depends=("sites",))
+def download_mgm_parse(ws):
+    """Parsing of the responses of one download from each site."""
+    svc = MGMHavaDurumu()
+    issue_time = ws.start + pd.Timedelta("1D")
+    sites = list(synthetic.locations(ws.sites).itertuples())
+    responses = [synthetic.mgm_response(issue_time, synthetic._rng(0, 5, i), site.lat, site.lon)
+                 for i, site in enumerate(sites)]
+    return lambda: pd.concat([svc._parse(site, r) for site, r in zip(sites, responses)])
+
+
+def measure(setup, ws, repeat=1, memory=True):
+    """Run the benchmark made by setup(ws) repeat times, each after a new setup, and return
+    a dict of the results. If memory is True, the peak memory is measured in one more run."""
+    times = []
+    for _ in range(repeat):
+        run = setup(ws)
+        t0 = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - t0)
+    result = {"seconds": min(times), "times": times}
+    if memory:
+        run = setup(ws)
+        tracemalloc.start()
+        try:
+            run()
+            result["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def run_benchmarks(work_dir, months_list, sites_list, names=None, repeat=1, memory=True):
+    """Run the benchmarks whose names contain one of names (all if names is empty) at each
+    combination of months and sites. A benchmark that does not depend on a scale parameter
+    is only run at the first value of it. Returns the results as a dict."""
+    results = []
+    data = []
+    for months in months_list:
+        for sites in sites_list:
+            root = os.path.join(work_dir, f"months{months}_sites{sites}")
+            os.makedirs(root, exist_ok=True)
+            ws = Workspace(root, months, sites)
+            for name, depends, setup in benchmarks:
+                if names and not any(n in name for n in names):
+                    continue
+                if ("months" not in depends and months != months_list[0]) or (
+                    "sites" not in depends and sites != sites_list[0]
+                ):
+                    continue
+                _log.info(f"Running {name} for {months} months and {sites} sites")
+                result = {
+                    "benchmark": name,
+                    "months": months if "months" in depends else None,
+                    "sites": sites if "sites" in depends else None,
+                    **measure(setup, ws, repeat, memory),
+                }
+                _log.info(_format_result(result))
+                results.append(result)
+            data.append({"months": months, "sites": sites, "files": ws.data_size()})
+    return {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "versions": {m.__name__: m.__version__ for m in (np, pd, sqlalchemy)},
+        "data": data,
+        "results": results,
+    }
+
+
+def compare(results, baseline):
+    """Return lines comparing the time and peak memory of each benchmark in results with the
+    same benchmark and scale in baseline, as ratios of results to baseline."""
+    key = lambda r: (r["benchmark"], r["months"], r["sites"])
+    baseline = {key(r): r for r in baseline["results"]}
+    lines = []
+    for r in results["results"]:
+        b = baseline.get(key(r))
+        if b is None:
+            continue
+        line = f"{_label(r):60s} time x{r['seconds'] / b['seconds']:.2f}"
+        if r.get("peak_memory_bytes") and b.get("peak_memory_bytes"):
+            line += f"  memory x{r['peak_memory_bytes'] / b['peak_memory_bytes']:.2f}"
+        lines.append(line)
+    return lines
+
+
+def _label(result):
+    scale = ", ".join(
+        f"{result[p]} {p}" for p in ("months", "sites") if result[p] is not None
+    )
+    return f"{result['benchmark']} ({scale})"
+
+
+def _format_result(result):
+    text = f"{_label(result):60s} {result['seconds']:9.3f} s"
+    if "peak_memory_bytes" in result:
+        text += f" {result['peak_memory_bytes'] / 2**20:9.1f} MiB"
+    return text
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@logging_config.log_level_option
+@click.option(
+    "--months",
+    "months_list",
+    type=click.IntRange(min=1),
+    multiple=True,
+    default=[1],
+    show_default=True,
+    help="Months of synthetic data. May be given more than once, e.g. up to 120 for 10 years.",
+)
+@click.option(
+    "--sites",
+    "sites_list",
+    type=click.IntRange(min=1),
+    multiple=True,
+    default=[1],
+    show_default=True,
+    help="Number of sites in the synthetic data. May be given more than once.",
+)
+@click.option(
+    "-k",
+    "names",
+    multiple=True,
+    help="Only run the benchmarks whose names contain this text. May be given more than once.",
+)
+@click.option(
+    "-r",
+    "--repeat",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of timed runs of each benchmark. The shortest time is reported.",
+)
+@click.option("--memory/--no-memory", default=True, show_default=True,
+              help="Measure the peak memory of each benchmark.")
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False, writable=True),
+    help="JSON file to save the results to.",
+)
+@click.option(
+    "--compare",
+    "baseline_file",
+    type=click.Path(exists=True, dir_okay=False),
+    help="JSON file of earlier results to compare the results with.",
+)
+@click.option(
+    "--work-dir",
+    type=click.Path(file_okay=False),
+    help="Directory for the synthetic data and databases. It is kept if given. "
+    "Otherwise a temporary directory is used.",
+)
+def main(log_level, months_list, sites_list, names, repeat, memory, output, baseline_file,
+         work_dir):
+    """Run benchmarks of the archiver and downloader on synthetic data."""
+    logging.getLogger(__name__).setLevel(log_level)
+
+    if work_dir is None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            results = run_benchmarks(tmp_dir, months_list, sites_list, names, repeat, memory)
+    else:
+        results = run_benchmarks(work_dir, months_list, sites_list, names, repeat, memory)
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=1)
+    if baseline_file is not None:
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        for line in compare(results, baseline):
+            click.echo(line)
@@ -0,0 +1,283 @@
+"""
+Deterministic synthetic data in the formats read by the archiver: ABB logger JSON exports,
+SolCast downloader CSVs, and meteogram CSVs. Also makes SolCast and MGM API responses like
+the ones parsed by the downloader. The same arguments always give the same data.
+
+Forecast files are written as vintages issued at a regular interval. Each vintage covers a
+horizon longer than the interval, so consecutive vintages overlap as they do in the real data.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+default_start = pd.Timestamp("2021-01-01")
+
+
+def locations(n_sites):
+    """DataFrame of n_sites locations with the columns of the locations file that are
+    used by the downloaders."""
+    rng = np.random.default_rng(0)
+    names = [f"site_{i:03d}" for i in range(n_sites)]
+    return pd.DataFrame(
+        {
+            "name": names,
+            "lat": np.round(rng.uniform(36, 42, n_sites), 4),
+            "lon": np.round(rng.uniform(26, 45, n_sites), 4),
+            "il": "Ankara",
+            "ilce": names,
+            "solcast_site_id": [f"{i:04x}-{i:04x}-{i:04x}-{i:04x}" for i in range(n_sites)],
+        }
+    )
+
+
+def _rng(seed, *key):
+    """Random generator for one file or response, so that the data of each does not depend
+    on what else is generated."""
+    return np.random.default_rng([seed, *key])
+
+
+def _irradiance(dt, rng, peak=1000.0):
+    """Daily cycle of irradiance at the naive UTC times dt, reduced by random clouds.
+    Returns (irradiance, cloud opacity in %)."""
+    hour = (dt.hour + dt.minute / 60).to_numpy()
+    day = np.clip(np.sin(np.pi * (hour - 4) / 12), 0, None)
+    clouds = rng.uniform(0, 100, len(dt))
+    return peak * day * (1 - 0.75 * clouds / 100), clouds
+
+
+def _solcast_frame(issue_time, names, lats, lons, rng, history, horizon, freq="30min"):
+    """Rows of one SolCast download for all sites, as written by the downloader: the
+    estimated actuals of the period before issue_time and the forecasts after it."""
+    Δt = pd.to_timedelta(freq)
+    actual_dt = pd.date_range(issue_time - pd.to_timedelta(history), issue_time - Δt, freq=freq)
+    fx_dt = pd.date_range(issue_time, issue_time + pd.to_timedelta(horizon) - Δt, freq=freq)
+    frames = []
+    for dt, fx_type in [(actual_dt, 0), (fx_dt, "PT30M")]:
+        n = len(dt)
+        site = np.repeat(np.arange(len(names)), n)
+        dt_all = pd.DatetimeIndex(np.tile(dt.to_numpy(), len(names)))
+        ghi, clouds = _irradiance(dt_all, rng)
+        df = pd.DataFrame(
+            {
+                "location": np.asarray(names)[site],
+                "lat": np.asarray(lats)[site],
+                "lon": np.asarray(lons)[site],
+                "type": fx_type,
+                "current_dt": issue_time,
+                "dt": dt_all,
+                "clouds": clouds.round(1),
+                "ghi": ghi.round(1),
+                "ebh": (ghi * 0.7).round(1),
+                "dni": (ghi * 0.9).round(1),
+                "dhi": (ghi * 0.3).round(1),
+            }
+        )
+        if fx_type != 0:
+            df["temp"] = rng.normal(15, 8, len(df)).round(1)
+            df["ghi90"] = (ghi * 1.1).round(1)
+            df["ghi10"] = (ghi * 0.8).round(1)
+            df["dni10"] = (ghi * 0.7).round(1)
+            df["dni90"] = (ghi * 1.0).round(1)
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def write_solcast_files(
+    data_dir,
+    start,
+    end,
+    n_sites=1,
+    issue_freq="12h",
+    history="1D",
+    horizon="2D",
+    seed=0,
+):
+    """Write a SolCast downloader CSV with the data of all n_sites sites for each issue time
+    from start (inclusive) to end (exclusive). Each file has the estimated actuals of the
+    history before the issue time and the half-hourly forecasts for the horizon after it.
+    Returns the list of file names."""
+    os.makedirs(data_dir, exist_ok=True)
+    sites = locations(n_sites)
+    file_names = []
+    issue_times = pd.date_range(start, end, freq=issue_freq, inclusive="left")
+    for i, issue_time in enumerate(issue_times):
+        df = _solcast_frame(
+            issue_time,
+            sites["name"],
+            sites["lat"],
+            sites["lon"],
+            _rng(seed, 1, i),
+            history,
+            horizon,
+        )
+        file_name = os.path.join(data_dir, f"solcast_{issue_time:%Y%m%d_%H%M}.csv")
+        df.to_csv(file_name, index=False)
+        file_names.append(file_name)
+    return file_names
+
+
+def write_meteogram_files(
+    data_dir, start, end, n_sites=1, issue_freq="12h", horizon="3D", seed=0
+):
+    """Write a meteogram CSV with the hourly forecasts of all n_sites sites for each issue
+    time from start (inclusive) to end (exclusive). Returns the list of file names."""
+    os.makedirs(data_dir, exist_ok=True)
+    names = locations(n_sites)["name"].to_numpy()
+    file_names = []
+    issue_times = pd.date_range(start, end, freq=issue_freq, inclusive="left")
+    for i, issue_time in enumerate(issue_times):
+        rng = _rng(seed, 2, i)
+        dt = pd.date_range(
+            issue_time, issue_time + pd.to_timedelta(horizon), freq="1h", inclusive="left"
+        )
+        n = len(dt) * n_sites
+        df = pd.DataFrame(
+            {
+                "location": np.repeat(names, len(dt)),
+                "current_dt": issue_time,
+                "dt": np.tile(dt.to_numpy(), n_sites),
+                "clouds": rng.uniform(0, 8, n).round(2),
+                "temperature": rng.normal(15, 8, n).round(2),
+                "rain": np.clip(rng.normal(0, 1, n), 0, None).round(2),
+            }
+        )
+        file_name = os.path.join(data_dir, f"meteogram_{issue_time:%Y%m%d_%H}.csv")
+        df.to_csv(file_name, index=False)
+        file_names.append(file_name)
+    return file_names
+
+
+def write_abb_files(
+    data_dir, start, end, file_days=7, freq="5min", time_zone="Europe/Istanbul", seed=0
+):
+    """Write ABB logger JSON exports of the power output from start (inclusive) to end
+    (exclusive), one file per file_days days. As in the real exports, the timestamps are
+    local times labeled as UTC, newest first, and the power datastream follows others that
+    the archiver skips. Returns the list of file names."""
+    os.makedirs(data_dir, exist_ok=True)
+    file_names = []
+    file_starts = pd.date_range(start, end, freq=f"{file_days}D", inclusive="left")
+    for i, file_start in enumerate(file_starts):
+        rng = _rng(seed, 3, i)
+        file_end = min(file_start + pd.to_timedelta(file_days, "D"), pd.Timestamp(end))
+        dt = pd.date_range(file_start, file_end, freq=freq, inclusive="left")
+        power, _ = _irradiance(dt, rng, peak=25000.0)
+        local_dt = dt.tz_localize("UTC").tz_convert(time_zone).tz_localize(None)
+        stamps = local_dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+        data = [
+            {"timestamp": t, "value": round(float(v), 2)}
+            for t, v in zip(stamps[::-1], power[::-1])
+        ]
+        doc = {
+            "feeds": {
+                "ser4:000000-3N16-0000": {
+                    "product": "PVI-10.0-TL-OUTD",
+                    "datastreams": {
+                        "m101_1_DCV": {"units": "V", "data": data},
+                        "m103_1_W": {"units": "W", "data": data},
+                    },
+                }
+            }
+        }
+        file_name = os.path.join(data_dir, f"abb_{file_start:%Y%m%d}.json")
+        with open(file_name, "w") as f:
+            json.dump(doc, f)
+        file_names.append(file_name)
+    return file_names
+
+
+def solcast_response(issue_time, rng, history="1D", horizon="2D", freq="30min"):
+    """JSON response of the SolCast estimated_actuals and forecasts requests for one site,
+    merged as by SolcastService."""
+    Δt = pd.to_timedelta(freq)
+    end_format = "%Y-%m-%dT%H:%M:%S.0000000Z"
+    actual_end = pd.date_range(
+        issue_time - pd.to_timedelta(history) + Δt, issue_time, freq=freq
+    )
+    fx_end = pd.date_range(issue_time + Δt, issue_time + pd.to_timedelta(horizon), freq=freq)
+    ghi, clouds = _irradiance(actual_end, rng)
+    actuals = [
+        {
+            "period_end": t,
+            "period": "PT30M",
+            "cloud_opacity": c,
+            "ghi": g,
+            "ebh": g * 0.7,
+            "dni": g * 0.9,
+            "dhi": g * 0.3,
+        }
+        for t, g, c in zip(actual_end.strftime(end_format), ghi.round(1), clouds.round(1))
+    ]
+    ghi, clouds = _irradiance(fx_end, rng)
+    temp = rng.normal(15, 8, len(fx_end)).round(1)
+    forecasts = [
+        {
+            "period_end": t,
+            "period": "PT30M",
+            "air_temp": a,
+            "cloud_opacity": c,
+            "ghi": g,
+            "ghi90": g * 1.1,
+            "ghi10": g * 0.8,
+            "ebh": g * 0.7,
+            "dni": g * 0.9,
+            "dni10": g * 0.7,
+            "dni90": g * 1.0,
+            "dhi": g * 0.3,
+        }
+        for t, g, c, a in zip(fx_end.strftime(end_format), ghi.round(1), clouds.round(1), temp)
+    ]
+    return {"estimated_actuals": actuals, "forecasts": forecasts}
+
+
+def mgm_response(issue_time, rng, lat, lon, hours=72):
+    """Current weather, hourly, and daily forecast responses of the MGM service for one
+    location, combined as by MGMHavaDurumu."""
+    time_format = "%Y-%m-%dT%H:%M:%S.000Z"
+    hourly_dt = pd.date_range(issue_time, periods=hours, freq="1h")
+    daily_dt = pd.date_range(issue_time.floor("D"), periods=5, freq="1D")
+    daily = {}
+    for d, t in enumerate(daily_dt.strftime(time_format), start=1):
+        daily.update(
+            {
+                f"tarihGun{d}": t,
+                f"enYuksekGun{d}": int(rng.integers(10, 35)),
+                f"enDusukGun{d}": int(rng.integers(-5, 10)),
+                f"enDusukNemGun{d}": int(rng.integers(20, 50)),
+                f"enYuksekNemGun{d}": int(rng.integers(50, 100)),
+                f"ruzgarHizGun{d}": int(rng.integers(0, 30)),
+                f"ruzgarYonGun{d}": int(rng.integers(0, 360)),
+                f"hadiseGun{d}": "PB",
+            }
+        )
+    return {
+        "lat": lat,
+        "lon": lon,
+        "current": {
+            "veriZamani": issue_time.strftime(time_format),
+            "sicaklik": round(float(rng.normal(15, 8)), 1),
+            "kapalilik": int(rng.integers(0, 8)),
+            "hadiseKodu": "A",
+            "nem": int(rng.integers(20, 100)),
+            "ruzgarHiz": round(float(rng.uniform(0, 30)), 1),
+            "ruzgarYon": int(rng.integers(0, 360)),
+            "yagis1Saat": -9999,
+        },
+        "hourly": {
+            "baslangicZamani": issue_time.strftime(time_format),
+            "tahmin": [
+                {
+                    "tarih": t,
+                    "sicaklik": int(rng.integers(-5, 35)),
+                    "hadise": "A",
+                    "nem": int(rng.integers(20, 100)),
+                    "ruzgarHizi": int(rng.integers(0, 30)),
+                    "ruzgarYonu": int(rng.integers(0, 360)),
+                }
+                for t in hourly_dt.strftime(time_format)
+            ],
+        },
+        "daily": daily,
+    }
@@ -3,7 +3,7 @@ from . import logging_config  # isort:skip
 
 import click
 
-from .db_archiver.cli import archive
+from .db_archiver.cli import archive, precompute_clearsky
 from .downloader.cli import download
 
 
@@ -13,6 +13,7 @@ def cli(args=None):
 
 cli.add_command(download)
 cli.add_command(archive)
+cli.add_command(precompute_clearsky)
 
 
 if __name__ == "__main__":
@@ -61,7 +61,7 @@ def load(fname, do_convert_paths=True):
 def convert_paths(cfg):
     cfg["main_data_dir"] = Path(cfg["main_data_dir"]).expanduser().resolve()
 
-    for subdir in ["dataset_db_file", "locations_file"]:
+    for subdir in ["dataset_db_file", "locations_file", "parquet_dir"]:
         if subdir in cfg:
             cfg[subdir] = cfg["main_data_dir"] / cfg[subdir]
 
@@ -10,7 +10,10 @@ The data will be resampled to an hourly basis using a mean.
 
 """
 from .abb_inverter_logger import ABBInverterDataSet
+from .fx_tensor import load_fx_tensor
 from .meteogram_forecast import MeteogramForecast
+from .query_cache import QueryCache
 from .solcast_weather import SolCastWeather
+from .storage import ParquetStorage, SqlStorage
 
 # from .clearsky_model import ClearskyModel  # Need to sort out pvlib and ems.solar_model dependency
@@ -1,12 +1,16 @@
-import glob
+import hashlib
 import json
 import logging
 import os
+import zipfile
 
+import numpy as np
 import pandas as pd
+import platformdirs
 import sqlalchemy
 
-from .base import DataSet, extract_complete_days
+from .base import DataSet, default_site_id, extract_complete_days, site_id_column
+from .json_stream import iter_array
 
 _log = logging.getLogger(__name__)
 
@@ -18,8 +22,14 @@ ABB inverter.
 
 
 class ABBInverterDataSet(DataSet):
-    _df_cache = None
+    # Without a database, the hourly data is loaded from the json files. It is cached for the
+    # process in _df_cache, and between processes in a snapshot file in snapshot_dir, so that
+    # only files that were added or changed since are read. Set snapshot_dir to None to disable
+    # the snapshot.
+    _df_cache = {}
+    snapshot_dir = platformdirs.user_cache_path('forecast_dataset_tools')
     _cfg_key = "ABB Inverter"
+    file_pattern = '*.json'
 
     def __init__(self, data_dir='data/ABB_inverter', time_zone='Europe/Istanbul',
                  db_engine=None, db_table='abb_inverter',
@@ -29,27 +39,19 @@ class ABBInverterDataSet(DataSet):
         self.time_zone = time_zone
         self.scale_factor = scale_factor
 
-
-        if self._df_cache is None and db_engine is None:
-            self.df = self._load_df()
-            self._df_cache = self.df
-        elif db_engine is None:
-            self.df = self._df_cache
-        self.ids = [1]
-
-    @property
-    def file_names(self):
-        """ Get list of file names in the data directory. """
-        return sorted(glob.glob(os.path.join(self.data_dir, '*.json')))
+        if db_engine is None:
+            self.df = self._load_cached_df()
 
     def _define_table_data(self):
         self.data_table = sqlalchemy.Table(
             self.db_table_data,
             self.meta,
             sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
-            sqlalchemy.Column('dt', sqlalchemy.DateTime, index=True),
+            site_id_column(),
+            sqlalchemy.Column('dt', sqlalchemy.DateTime),
             sqlalchemy.Column(self.raw_col_name, sqlalchemy.Float),
-            sqlalchemy.Column(self.scaled_col_name, sqlalchemy.Float)
+            sqlalchemy.Column(self.scaled_col_name, sqlalchemy.Float),
+            sqlalchemy.Index(f'ix_{self.db_table_data}_site_id_dt', 'site_id', 'dt')
         )
         return self.data_table
 
@@ -62,6 +64,10 @@ class ABBInverterDataSet(DataSet):
         for file_name in self.file_names:
             df = self._read_file(file_name)
             df_list.append(df)
+        return self._df_from_files(df_list, complete_days)
+
+    def _df_from_files(self, df_list, complete_days=False):
+        """ Combine the DataFrames read from each file into the hourly data. """
         df = pd.concat(df_list, copy=False).reset_index(drop=False)
 
         df = df.drop_duplicates(subset='dt')
@@ -77,37 +83,160 @@ class ABBInverterDataSet(DataSet):
         # TODO: FIX ME
         df = df.resample('5min').mean()
         df = df.interpolate(method='slinear', limit=5, limit_area='inside')
-        df = df.resample('1H').mean()
+        df = df.resample('1h').mean()
         return df
 
+    def _file_stats(self):
+        """ (name, mtime in ns, size) of each file in the data directory. """
+        stats = []
+        for file_name in self.file_names:
+            st = os.stat(file_name)
+            stats.append((os.path.basename(file_name), st.st_mtime_ns, st.st_size))
+        return stats
+
+    def _load_cached_df(self):
+        """ Return the hourly data from the process-wide cache if the files are unchanged since
+        it was loaded. Otherwise load it with _load_snapshot_df and cache it. """
+        key = (os.path.abspath(self.data_dir), self.time_zone, self.scale_factor)
+        files = self._file_stats()
+        entry = self._df_cache.get(key)
+        if entry is not None and entry[0] == files:
+            return entry[1]
+        df = self._load_snapshot_df(files)
+        self._df_cache[key] = (files, df)
+        return df
+
+    @property
+    def snapshot_file(self):
+        if self.snapshot_dir is None:
+            return None
+        data_dir_hash = hashlib.sha1(os.path.abspath(self.data_dir).encode()).hexdigest()[:16]
+        return os.path.join(self.snapshot_dir, f'abb_inverter_{data_dir_hash}.npz')
+
+    def _load_snapshot_df(self, files):
+        """ Return the hourly data for files, a list from _file_stats. The hourly data in the
+        snapshot is used if the files are unchanged. Otherwise the data of the files that are
+        unchanged is taken from the snapshot, only the other files are read, and the snapshot is
+        updated. """
+        snapshot_dfs = {}
+        snapshot = self._open_snapshot()
+        if snapshot is not None:
+            npz, manifest = snapshot
+            with npz:
+                if manifest['files'] == files and manifest['scale_factor'] == self.scale_factor:
+                    _log.debug(f"Loaded data of {len(files)} files from {self.snapshot_file}")
+                    index = pd.DatetimeIndex(npz['dt'], name='dt', freq=manifest['freq'])
+                    return pd.DataFrame({c: npz[f'col_{i}'] for i, c in enumerate(manifest['columns'])},
+                                        index=index)
+                dt, values, offsets = npz['raw_dt'], npz['raw_value'], npz['raw_offsets']
+            for f, start, end in zip(manifest['files'], offsets[:-1], offsets[1:]):
+                snapshot_dfs[f] = pd.DataFrame({self.raw_col_name: values[start:end]},
+                                               index=pd.DatetimeIndex(dt[start:end], name='dt'))
+
+        df_list = []
+        n_read = 0
+        for f in files:
+            df = snapshot_dfs.get(f)
+            if df is None:
+                df = self._read_file(os.path.join(self.data_dir, f[0]))
+                n_read += 1
+            df_list.append(df)
+        _log.info(f"Read {n_read} new or changed files of {len(files)} in {self.data_dir}")
+
+        df = self._df_from_files(df_list)
+        self._write_snapshot(files, df_list, df)
+        return df
+
+    def _open_snapshot(self):
+        """ Return the opened snapshot file and its manifest, or None if there is no snapshot
+        for this data directory and time zone. """
+        if self.snapshot_file is None or not os.path.exists(self.snapshot_file):
+            return None
+        try:
+            npz = np.load(self.snapshot_file)
+            manifest = json.loads(str(npz['manifest']))
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            _log.warning(f"Ignoring invalid snapshot file {self.snapshot_file}")
+            return None
+        if manifest['data_dir'] != os.path.abspath(self.data_dir) \
+                or manifest['time_zone'] != self.time_zone:
+            npz.close()
+            return None
+        manifest['files'] = [tuple(f) for f in manifest['files']]
+        return npz, manifest
+
+    def _write_snapshot(self, files, df_list, df):
+        if self.snapshot_file is None:
+            return
+        manifest = {
+            'data_dir': os.path.abspath(self.data_dir),
+            'time_zone': self.time_zone,
+            'scale_factor': self.scale_factor,
+            'files': files,
+            'freq': df.index.freqstr,
+            'columns': list(df.columns),
+        }
+        arrays = {
+            'manifest': np.array(json.dumps(manifest)),
+            'raw_dt': np.concatenate([d.index.values for d in df_list]),
+            'raw_value': np.concatenate([d[self.raw_col_name].values for d in df_list]),
+            'raw_offsets': np.cumsum([0] + [len(d) for d in df_list]),
+            'dt': df.index.values,
+        }
+        arrays.update({f'col_{i}': df[c].values for i, c in enumerate(df.columns)})
+        try:
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+            # Write to a temporary file first so that the snapshot is never left partial
+            tmp_file = f'{self.snapshot_file}.tmp'
+            with open(tmp_file, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_file, self.snapshot_file)
+        except OSError:
+            _log.warning(f"Could not write snapshot file {self.snapshot_file}", exc_info=True)
+
     def _read_file(self, file_name):
         _log.debug(f"Reading data from {file_name}")
         with open(file_name, 'r') as f:
-            data = f.read()
-        data = json.loads(data)
-        [data] = data['feeds'].values()
-        df = pd.json_normalize(data, record_path=['datastreams',
-                                                  'm103_1_W',
-                                                  'data'])
-        df['dt'] = pd.to_datetime(df['timestamp'])
-        df.set_index(df['dt'], inplace=True)
-
-        # Keep only value column and index
-        df = df['value'].to_frame()
-        # Rename raw column to specified raw column name
-        df.columns = [self.raw_col_name]
-        # Sort by dt index. Reverse order first since it comes in oldest to newest
-        df = df[::-1]
-        df = df.sort_index()
+            dt, values = self._read_power_data(f)
+
+        # Sort by dt. Reverse order first since it comes in oldest to newest
+        dt, values = dt[::-1], values[::-1]
+        order = np.argsort(dt, kind='stable')
+        dt, values = dt[order], values[order]
 
         # Fix time zone. It appears the logger returns a timestamp that says it is UTC but actually is localized
         # This is probably a local configuration error.
-        df = df.tz_localize(None)
-        df = df.tz_localize(self.time_zone)
-        df = df.tz_convert('UTC')
-        df = df.tz_localize(None)
+        dt = pd.DatetimeIndex(dt, name='dt').tz_localize(self.time_zone).tz_convert(None)
 
-        return df
+        return pd.DataFrame({self.raw_col_name: values}, index=dt)
+
+    @staticmethod
+    def _read_power_data(f, block_size=2**16):
+        """ Stream the timestamps and values of the m103_1_W datastream from the logger export in
+        the open file f into numpy arrays. The timestamps are returned as naive datetime64 with
+        the time zone designator of the export dropped. The arrays are filled a block at a time,
+        so memory use is about that of the arrays rather than of the decoded JSON. """
+        dt_blocks, value_blocks = [], []
+        timestamps = np.empty(block_size, dtype=object)
+        values = np.empty(block_size, dtype='float64')
+        n = 0
+
+        def add_block():
+            dt_blocks.append(pd.to_datetime(timestamps[:n]).tz_localize(None).values
+                             if n else np.empty(0, dtype='datetime64[ns]'))
+            value_blocks.append(values[:n].copy())
+
+        for item in iter_array(f, ['feeds', None, 'datastreams', 'm103_1_W', 'data']):
+            timestamps[n] = item['timestamp']
+            value = item.get('value')
+            values[n] = np.nan if value is None else value
+            n += 1
+            if n == block_size:
+                add_block()
+                n = 0
+        add_block()
+
+        return np.concatenate(dt_blocks), np.concatenate(value_blocks)
 
     def _addl_postprocess(self, df):
         """ Add column for scaled output. """
@@ -117,11 +246,12 @@ class ABBInverterDataSet(DataSet):
             df[self.scaled_col_name] = df[self.raw_col_name]
         return df
 
-    def get_data_by_date(self, site_id=0, start=None, end=None):
+    def get_data_by_date(self, site_id=default_site_id, start=None, end=None):
         """ Returns data beginning on start and going to end (not inclusive).
         start and end may be dates or datetimes. """
+        self._check_site_id(site_id)
         if self.db_engine is None:
-            idx = pd.date_range(start=start, end=end, freq='1H',
+            idx = pd.date_range(start=start, end=end, freq='1h',
                                 inclusive='left')
             return self.df.loc[idx]
         else:
@@ -129,4 +259,5 @@ class ABBInverterDataSet(DataSet):
                 start = pd.to_datetime(start)
             if end is not None:
                 end = pd.to_datetime(end) - pd.to_timedelta(self.resample_interval)/10  # Open interval on end
-            return self._load_dt_range(self.data_table, start, end)
+            return self._cached_query(self.data_table, (site_id, start, end),
+                                      lambda: self._load_dt_range(self.data_table, site_id, start, end))
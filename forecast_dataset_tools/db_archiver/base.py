@@ -1,12 +1,86 @@
 import os
-import glob
+import fnmatch
+import hashlib
+import logging
+import queue
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from datetime import timedelta
 import sqlalchemy
 import pandas as pd
 import numpy as np
 
+from .. import profiling
+from .bulk_writer import bulk_insert, bulk_upsert, default_batch_size
+from .intervals import IntervalSet
+from .storage import SqlStorage
+
+_log = logging.getLogger(__name__)
+
+# Data version of each dataset in this process, keyed by DataSet._dataset_key
+_data_versions = {}
+
+# Site of the data of datasets whose files do not identify the site, and of the rows of
+# databases created before the tables had a site_id column
+default_site_id = 1
+
+
+# Table of the sites of all datasets in the database. The site ids of each dataset are taken from
+# it, so that a site id means the same site in every dataset.
+all_sites_table_name = 'sites'
+
+
+def site_id_column():
+    """ Column with the id of the site that a row of a data table belongs to. """
+    return sqlalchemy.Column('site_id', sqlalchemy.Integer, nullable=False, server_default=str(default_site_id))
+
+
+def all_sites_table(meta):
+    """ Define the table of the sites of all datasets in meta and return it. """
+    return sqlalchemy.Table(
+        all_sites_table_name,
+        meta,
+        sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+        sqlalchemy.Column('name', sqlalchemy.String, unique=True)
+    )
+
+
+def register_sites(db_engine, names):
+    """ Add the site names that are not in the sites table of the database yet to it, in the given
+    order, and return a dict of the site id of each name. """
+    table = all_sites_table(sqlalchemy.MetaData())
+    with db_engine.begin() as conn:
+        table.create(conn, checkfirst=True)
+        return _register_sites(conn, table, names)
+
+
+def _register_sites(conn, table, names):
+    names = list(dict.fromkeys(str(name) for name in names))
+    if names:
+        # Names added at the same time by another process are ignored
+        conn.execute(sqlalchemy.insert(table).prefix_with('OR IGNORE'), [{'name': name} for name in names])
+    wanted = set(names)
+    return {name: site_id for site_id, name in conn.execute(sqlalchemy.select(table.c.id, table.c.name))
+            if name in wanted}
+
+
+# Data file to be imported: its name, size, modification time and content hash when it was
+# found, and whether it was imported before with different content
+DataFile = namedtuple('DataFile', ['name', 'size', 'mtime_ns', 'hash', 'changed'])
+
 
 class DataSet:
+    # Data files are the files in the data directory whose names match this pattern
+    file_pattern = '*.csv'
+    # Number of rows sent to the database per executemany call when inserting data
+    insert_batch_size = default_batch_size
+    # Set to a QueryCache to cache the results of get_data_by_date and get_fx_by_date
+    query_cache = None
+    # Backend that serves range reads of the data tables. Set to a ParquetStorage to read
+    # columnar copies of the tables instead of querying the database.
+    storage = SqlStorage()
+
     def __init__(self, db_engine=None, db_table_prefix='generic_dataset',
                  resample_interval='5min', average_interval='1h'):
         self.start = None
@@ -15,18 +89,36 @@ class DataSet:
         self.db_table_prefix = db_table_prefix
         self.resample_interval = resample_interval
         self.average_interval = average_interval
+        # Intervals of raw data added since the processed data was last rebuilt, by site id
+        self._dirty_intervals = {}
+        # In-memory copies of the intervals and sites tables. Loaded when first needed.
+        self._intervals = None
+        self._sites = None
+        # Site ids given to queries that were not sites of the dataset, which are warned about once
+        self._unknown_site_ids = set()
+        # (table, site_id, intervals) of changes to data tables not yet synced to the storage,
+        # by table name and site id
+        self._unsynced = {}
         self._define_col_names()
 
         if db_engine is not None:
             self.meta = sqlalchemy.MetaData()
             self._define_tables()
 
+    def __getstate__(self):
+        # The database engine can't be sent to worker processes. Workers only read files.
+        state = self.__dict__.copy()
+        state['db_engine'] = None
+        return state
+
     def _define_table_names(self):
         # Define table names
         self.db_table_data_raw = self.db_table_prefix + '_data_raw'
         self.db_table_data = self.db_table_prefix + '_data'
         self.db_table_files = self.db_table_prefix + '_files'
+        self.db_table_file_ranges = self.db_table_prefix + '_file_ranges'
         self.db_table_intervals = self.db_table_prefix + '_intervals'
+        self.db_table_sites = self.db_table_prefix + '_sites'
 
     def _define_col_names(self):
         self.raw_col_name = 'value'
@@ -39,15 +131,19 @@ class DataSet:
         self._define_table_data_raw()
         self._define_table_data()
         self._define_table_files()
+        self._define_table_file_ranges()
         self._define_table_intervals()
+        self._define_table_sites()
 
     def _define_table_data_raw(self):
         self.data_table_raw = sqlalchemy.Table(
             self.db_table_data_raw,
             self.meta,
             sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
-            sqlalchemy.Column('dt', sqlalchemy.DateTime, index=True),
-            sqlalchemy.Column(self.raw_col_name, sqlalchemy.Float)
+            site_id_column(),
+            sqlalchemy.Column('dt', sqlalchemy.DateTime),
+            sqlalchemy.Column(self.raw_col_name, sqlalchemy.Float),
+            sqlalchemy.Index(f'ix_{self.db_table_data_raw}_site_id_dt', 'site_id', 'dt', unique=True)
         )
         return self.data_table_raw
 
@@ -56,8 +152,10 @@ class DataSet:
             self.db_table_data,
             self.meta,
             sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
-            sqlalchemy.Column('dt', sqlalchemy.DateTime, index=True),
-            sqlalchemy.Column(self.raw_col_name, sqlalchemy.Float)
+            site_id_column(),
+            sqlalchemy.Column('dt', sqlalchemy.DateTime),
+            sqlalchemy.Column(self.raw_col_name, sqlalchemy.Float),
+            sqlalchemy.Index(f'ix_{self.db_table_data}_site_id_dt', 'site_id', 'dt')
         )
         return self.data_table
 
@@ -66,102 +164,539 @@ class DataSet:
             self.db_table_files,
             self.meta,
             sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
-            sqlalchemy.Column('fname', sqlalchemy.String)
+            sqlalchemy.Column('fname', sqlalchemy.String),
+            sqlalchemy.Column('size', sqlalchemy.Integer),
+            sqlalchemy.Column('mtime_ns', sqlalchemy.Integer),
+            sqlalchemy.Column('hash', sqlalchemy.String),
+            sqlalchemy.Index(f'ix_{self.db_table_files}_fname', 'fname', unique=True)
         )
         return self.files_table
 
+    def _define_table_file_ranges(self):
+        """ Table of the first and last time of the raw data of each site in each imported file, so
+        that the rows of a file can be replaced when it changes. """
+        self.file_ranges_table = sqlalchemy.Table(
+            self.db_table_file_ranges,
+            self.meta,
+            sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+            sqlalchemy.Column('fname', sqlalchemy.String),
+            site_id_column(),
+            sqlalchemy.Column('start', sqlalchemy.DateTime),
+            sqlalchemy.Column('end', sqlalchemy.DateTime),
+            sqlalchemy.Index(f'ix_{self.db_table_file_ranges}_fname', 'fname')
+        )
+        return self.file_ranges_table
+
     def _define_table_intervals(self):
         self.intervals_table = sqlalchemy.Table(
             self.db_table_intervals,
             self.meta,
             sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+            site_id_column(),
             sqlalchemy.Column('start', sqlalchemy.DateTime),
             sqlalchemy.Column('end', sqlalchemy.DateTime)
         )
         return self.intervals_table
 
-    def import_all_data(self):
-        """ Import all available data into the database. Any existing data is dropped from the database first. """
-        self.meta.drop_all(self.db_engine)
-        self.import_new_data()
+    def _define_table_sites(self):
+        """ Table of the sites of datasets whose files identify the location of the data. The
+        id of a site is the site_id of its rows in the data tables, and is its id in the sites table
+        shared by all datasets. """
+        self.all_sites_table = all_sites_table(self.meta)
+        self.sites_table = sqlalchemy.Table(
+            self.db_table_sites,
+            self.meta,
+            sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True, autoincrement=False),
+            sqlalchemy.Column('name', sqlalchemy.String, unique=True)
+        )
+        return self.sites_table
 
-    def import_new_data(self):
-        """ Import available data that has not already been imported. Existing data is kept. """
+    def _create_tables(self):
+        """ Create any missing tables in the database and upgrade existing tables to the current
+        table definitions. """
         self.meta.create_all(self.db_engine)
+        self._migrate_columns()
+        self._migrate_indexes()
+        # Loading the intervals also coalesces the intervals table of older databases
+        self.intervals
+        for table in self._storage_tables:
+            self.storage.sync_if_missing(self, table)
+
+    @property
+    def _storage_tables(self):
+        """ Data tables that are read through the storage backend. """
+        return [t for t in (self.data_table_raw, self.data_table) if t is not None]
+
+    def _mark_unsynced(self, table, site_id, start, end):
+        """ Record that rows of table for site_id from start to end were changed in the database. """
+        self._unsynced.setdefault((table.name, site_id), (table, site_id, []))[2].append((start, end))
+
+    def _sync_storage(self):
+        """ Update the storage backend with the changes to the data tables recorded by _mark_unsynced. """
+        unsynced, self._unsynced = self._unsynced, {}
+        for table, site_id, intervals in unsynced.values():
+            self.storage.sync(self, table, list(IntervalSet(intervals)), site_id)
+
+    def _migrate_columns(self):
+        """ create_all does not add columns to existing tables. Add any columns that are missing
+        from tables made by older versions. Rows of databases created before the tables had a
+        site_id column are assigned to default_site_id. """
+        with self.db_engine.begin() as conn:
+            inspector = sqlalchemy.inspect(conn)
+            for table in self.meta.sorted_tables:
+                db_columns = {c['name'] for c in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name in db_columns:
+                        continue
+                    _log.info(f"Adding column {column.name} to {table.name}")
+                    column_ddl = sqlalchemy.schema.CreateColumn(column).compile(dialect=conn.dialect)
+                    conn.execute(sqlalchemy.text(f'ALTER TABLE "{table.name}" ADD COLUMN {column_ddl}'))
+
+    def _migrate_indexes(self):
+        """ create_all does not add indexes to existing tables. Create any indexes that are missing
+        from tables made by older versions, and drop the indexes that are no longer defined, such
+        as the indexes on dt that did not lead with site_id. Databases created before the raw and
+        forecast tables had unique natural keys have non-unique indexes instead. For those, remove
+        any rows that duplicate the key of a later row, then replace the old index with the unique
+        one. """
+        with self.db_engine.begin() as conn:
+            inspector = sqlalchemy.inspect(conn)
+            for table in self.meta.sorted_tables:
+                db_indexes = {ix['name']: ix for ix in inspector.get_indexes(table.name)}
+                index_names = {index.name for index in table.indexes}
+                for name in db_indexes:
+                    if name not in index_names:
+                        _log.info(f"Removing index {name} from {table.name}")
+                        conn.execute(sqlalchemy.text(f'DROP INDEX "{name}"'))
+                for index in table.indexes:
+                    if index.name in db_indexes and bool(db_indexes[index.name]['unique']) == bool(index.unique):
+                        continue
+                    _log.info(f"Adding index {index.name} to {table.name}")
+                    if index.unique:
+                        self._remove_duplicate_rows(table, index.columns, conn)
+                    if index.name in db_indexes:
+                        conn.execute(sqlalchemy.text(f'DROP INDEX "{index.name}"'))
+                    index.create(conn)
+
+    def _drop_tables(self):
+        # The sites table is shared with the other datasets, so it is kept
+        self.meta.drop_all(self.db_engine, tables=[t for t in self.meta.sorted_tables
+                                                   if t is not self.all_sites_table])
+        for table in self._storage_tables:
+            self.storage.drop(self, table)
+        self._intervals = None
+        self._sites = None
+        self._unsynced = {}
+        self._bump_data_version()
+
+    @property
+    def _dataset_key(self):
+        return str(self.db_engine.url), self.db_table_prefix
+
+    @property
+    def data_version(self):
+        """ Counter that is incremented whenever data of this dataset is changed in this process. """
+        return _data_versions.get(self._dataset_key, 0)
+
+    def _bump_data_version(self):
+        _data_versions[self._dataset_key] = self.data_version + 1
+
+    def _cached_query(self, table, key, load):
+        """ Return the result of load(), a function that queries table. If a query cache is set,
+        the result is cached under key. """
+        if self.query_cache is None:
+            return load()
+        return self.query_cache.get_or_load(self._dataset_key + (table.name,) + key, self.data_version, load)
+
+    @property
+    def sites(self):
+        """ Dict of the names of the sites in the sites table by site id. The table is empty for
+        datasets whose files do not identify the site, which only have default_site_id. """
+        if self._sites is None:
+            if self.db_engine is None or not sqlalchemy.inspect(self.db_engine).has_table(self.db_table_sites):
+                return {}
+            with self.db_engine.connect() as conn:
+                self._sites = dict(conn.execute(sqlalchemy.select(self.sites_table.c.id, self.sites_table.c.name)
+                                                .order_by(self.sites_table.c.id)).all())
+        return self._sites
+
+    @property
+    def ids(self):
+        """ List of the site ids of the dataset. """
+        return list(self.sites) or [default_site_id]
+
+    def _check_site_id(self, site_id):
+        """ Log a warning the first time that site_id is not one of the sites of the dataset. Site
+        ids start from 1. Earlier versions, which had one site per dataset, used site 0. """
+        if site_id in self._unknown_site_ids:
+            return
+        if site_id not in self.ids:
+            # Sites may have been added by another process since the sites table was loaded
+            self._sites = None
+            if site_id not in self.ids:
+                hint = ' Site ids start from 1, not 0 as in earlier versions.' if site_id == 0 else ''
+                _log.warning(f"Unknown site id {site_id} for {self.db_table_prefix}. Its site ids are "
+                             f"{', '.join(map(str, self.ids))}.{hint}")
+                self._unknown_site_ids.add(site_id)
+
+    def _site_ids_for(self, names):
+        """ Return dict of the site id of each of the given site names. Names that are not in the
+        sites table of the dataset yet are added to it, with their ids in the shared sites table. """
+        site_ids = {name: site_id for site_id, name in self.sites.items()}
+        new_names = [name for name in names if name not in site_ids]
+        if new_names:
+            with self.db_engine.begin() as conn:
+                new_ids = _register_sites(conn, self.all_sites_table, new_names)
+                conn.execute(sqlalchemy.insert(self.sites_table),
+                             [{'id': new_ids[str(name)], 'name': name} for name in new_names])
+            _log.info(f"Added sites {', '.join(map(str, new_names))} to {self.db_table_sites}")
+            self._sites = None
+            site_ids = {name: site_id for site_id, name in self.sites.items()}
+        return site_ids
+
+    def _assign_site_ids(self, df):
+        """ Replace the location column of df, if it has one, with the site_id column. """
+        if 'location' not in df.columns:
+            return df
+        site_ids = self._site_ids_for(df['location'].unique())
+        return df.assign(site_id=df['location'].map(site_ids)).drop(columns='location')
+
+    def _table_site_ids(self, table):
+        """ Sorted list of the site ids that have rows in table. """
         with self.db_engine.connect() as conn:
-            existing_file_names = set(conn.execute(sqlalchemy.select(self.files_table.c.fname)).scalars())
-        for file_name in self.file_names:
-            if file_name in existing_file_names:
-                continue
-            df = self._read_file(file_name)
-            self._import_df_to_db(df, file_name)
-        # Remove duplicates
-        self._remove_duplicate_rows_all_tables()
-        self._rebuild_processed_data()
-
-    def _import_df_to_db(self, df, file_name=None, callback=None):
-        """ Add data from DataFrame into database. """
-        if not df.empty:
-            # Make sure df is sorted
-            df = df.sort_index()
-
-            intervals_to_add = [(df.index.min(), df.index.max())]
-            intervals_to_add = self._new_intervals_to_add(intervals_to_add)
-        else:
-            intervals_to_add = []
+            return list(conn.execute(sqlalchemy.select(table.c.site_id).distinct()
+                                     .order_by(table.c.site_id)).scalars())
+
+    @property
+    def intervals(self):
+        """ Dict of IntervalSets of the intervals covered by the raw data, by site id. """
+        if self._intervals is None:
+            self._intervals = self._load_interval_sets()
+        return self._intervals
+
+    def _site_intervals(self, site_id):
+        """ IntervalSet of the intervals covered by the raw data of site_id. """
+        interval_set = self.intervals.get(site_id)
+        if interval_set is None:
+            interval_set = IntervalSet(tolerance=self._interval_tolerance)
+        return interval_set
+
+    def _load_interval_sets(self):
+        """ Load the intervals table into an IntervalSet for each site. If any rows of the table
+        are adjacent or overlapping, the table is rewritten with the coalesced intervals. """
+        table = self.intervals_table
+        with self.db_engine.connect() as conn:
+            db_intervals = list(conn.execute(sqlalchemy.select(table.c.site_id, table.c.start, table.c.end)))
+        site_intervals = {}
+        for site_id, start, end in db_intervals:
+            site_intervals.setdefault(site_id, []).append((start, end))
+        interval_sets = {site_id: IntervalSet(intervals, tolerance=self._interval_tolerance)
+                         for site_id, intervals in site_intervals.items()}
+        n_intervals = sum(len(interval_set) for interval_set in interval_sets.values())
+        if n_intervals < len(db_intervals):
+            _log.info(f"Coalescing {len(db_intervals)} rows of {self.db_table_intervals} "
+                      f"into {n_intervals} rows")
+            with self.db_engine.begin() as conn:
+                conn.execute(sqlalchemy.delete(table))
+                conn.execute(sqlalchemy.insert(table),
+                             [{'site_id': site_id, 'start': s, 'end': e}
+                              for site_id, interval_set in interval_sets.items() for s, e in interval_set])
+        return interval_sets
 
+    def import_all_data(self, workers=1):
+        """ Import all available data into the database. Any existing data is dropped from the database first. """
+        self._drop_tables()
+        self.import_new_data(workers=workers)
+
+    def import_new_data(self, full_rebuild=False, workers=1):
+        """ Import available data that has not already been imported. Existing data is kept.
+        Files whose content changed since they were imported are imported again, so that the raw
+        data is the same as if all files were imported again (see _import_changed_file).
+        Only the processed data affected by the new raw data is rebuilt unless full_rebuild is True.
+        If workers is greater than 1, files are parsed in that many worker processes while the
+        parsed data is written to the database in file name order, and the processed data of
+        the sites is rebuilt in parallel. If workers is 0, one worker process per CPU is used. """
+        with profiling.span('archive.create_tables', dataset=self.db_table_prefix):
+            self._create_tables()
+        with profiling.span('archive.list_files', dataset=self.db_table_prefix) as s:
+            files = self._files_to_import()
+            s.set(rows=len(files))
+        self._import_files(files, workers)
+        self._update_processed_data(full_rebuild, workers)
+
+    def _import_files(self, files, workers=1):
+        """ Import the raw data of files, a list of DataFile from _files_to_import, and sync it to the
+        storage backend. The processed data is not rebuilt until _update_processed_data is called. """
+        for file, (file_name, df) in zip(files, self._read_files([f.name for f in files], workers)):
+            with profiling.span('archive.import_file', dataset=self.db_table_prefix, file=file_name) as s:
+                s.set(rows=len(df))
+                if file.changed:
+                    _log.info(f"Importing {file_name} again since it changed")
+                    self._import_changed_file(file, df)
+                else:
+                    self._import_df_to_db(df, file)
+        with profiling.span('archive.sync_storage', dataset=self.db_table_prefix):
+            self._sync_storage()
+
+    def _update_processed_data(self, full_rebuild=False, workers=1):
+        """ Rebuild the processed data affected by the raw data imported since it was last rebuilt,
+        or all of it if full_rebuild is True. """
+        with profiling.span('archive.rebuild', dataset=self.db_table_prefix):
+            self._rebuild_processed_data(None if full_rebuild else self._dirty_intervals, workers)
+        self._dirty_intervals = {}
+
+    def _import_df_to_db(self, df, file=None, callback=None):
+        """ Add data from DataFrame into database. The data belongs to the sites in the site_id
+        column of df, or the location column if the file identifies sites by name. Without either
+        column, it belongs to default_site_id. If file is given, the DataFile that df was read
+        from is recorded in the files table, with the range of the data of each site in it. Only
+        the data of times not yet covered by the raw data is added. """
+        site_dfs = self._site_dfs(df)
+
+        added_intervals = {}
+        interval_sets = {}
+        table = self.intervals_table
+        file_ranges = {site_id: (df_site.index.min(), df_site.index.max())
+                       for site_id, df_site in site_dfs if not df_site.empty}
         with self.db_engine.begin() as conn:
-            for new_start, new_end in intervals_to_add:
-                idx = (df.index >= new_start) & (df.index <= new_end)
-                # Skip intervals with no datapoints in them
-                if idx.sum() == 0:
+            for site_id, df_site in site_dfs:
+                if df_site.empty:
                     continue
-                # Add data to data table
-                df.loc[idx].to_sql(self.db_table_data_raw, conn, if_exists='append')
-                # Add interval to interval table
-                conn.execute(sqlalchemy.insert(self.intervals_table).values(start=new_start, end=new_end))
+                # Make sure df is sorted
+                df_site = df_site.sort_index()
+                with profiling.span('archive.new_intervals', dataset=self.db_table_prefix, site_id=int(site_id)):
+                    intervals_to_add = self._new_intervals_to_add([(df_site.index.min(), df_site.index.max())],
+                                                                  site_id)
+                interval_set = self._site_intervals(site_id).copy()
+                for new_start, new_end in intervals_to_add:
+                    idx = (df_site.index >= new_start) & (df_site.index <= new_end)
+                    # Skip intervals with no datapoints in them
+                    if idx.sum() == 0:
+                        continue
+                    # Add data to data table
+                    with profiling.span('archive.write_raw', dataset=self.db_table_prefix,
+                                        site_id=int(site_id)) as s:
+                        s.set(rows=int(idx.sum()))
+                        bulk_upsert(conn, self.data_table_raw, df_site.loc[idx].assign(site_id=site_id),
+                                    batch_size=self.insert_batch_size)
+                    self._mark_unsynced(self.data_table_raw, site_id, new_start, new_end)
+                    # Add interval to interval table, replacing any intervals that it is merged with
+                    interval_set.update([(new_start, new_end)])
+                    merged_start, merged_end = interval_set.containing(new_start, new_end)
+                    conn.execute(sqlalchemy.delete(table).where(
+                        table.c.site_id == site_id, table.c.start >= merged_start, table.c.end <= merged_end))
+                    conn.execute(sqlalchemy.insert(table).values(site_id=site_id, start=merged_start,
+                                                                 end=merged_end))
+                    added_intervals.setdefault(site_id, []).append((new_start, new_end))
+                interval_sets[site_id] = interval_set
 
             if callback is not None:
                 callback(conn)
 
             # Add filename to file table
-            if file_name is not None:
-                conn.execute(sqlalchemy.insert(self.files_table).values(fname=file_name))
+            if file is not None:
+                self._record_files(conn, [file])
+                self._record_file_ranges(conn, file.name, file_ranges)
 
-    def _new_intervals_to_add(self, intervals_to_add):
-        Δt = pd.to_timedelta(self.resample_interval) / 10
-        stmt = sqlalchemy.select(self.intervals_table.c.start, self.intervals_table.c.end).where(
-            sqlalchemy.and_(intervals_to_add[0][1] >= self.intervals_table.c.start,
-                            intervals_to_add[0][0] <= self.intervals_table.c.end)
-        )
+        # Only update the in-memory intervals once the transaction is committed
+        self.intervals.update(interval_sets)
+        for site_id, intervals in added_intervals.items():
+            self._dirty_intervals.setdefault(site_id, []).extend(intervals)
+        self._bump_data_version()
+
+    def _site_dfs(self, df):
+        """ Return list of (site_id, DataFrame) of the raw data of each site in df, a DataFrame read
+        from a data file. The data belongs to the sites in the site_id column of df, or the
+        location column if the file identifies sites by name. Without either column, it belongs to
+        default_site_id. """
+        df = self._assign_site_ids(df)
+        if 'site_id' in df.columns:
+            return [(site_id, df_site.drop(columns='site_id')) for site_id, df_site in df.groupby('site_id')]
+        return [(default_site_id, df)]
+
+    def _site_ranges(self, df):
+        """ Return dict of the (start, end) range of the raw data of each site in df, a DataFrame
+        read from a data file. """
+        return {site_id: (df_site.index.min(), df_site.index.max())
+                for site_id, df_site in self._site_dfs(df) if not df_site.empty}
+
+    def _import_changed_file(self, file, df):
+        """ Import df, the new content of the DataFile file, which changed since it was imported,
+        so that the raw data is the same as if all of the files were imported again. The raw data
+        of each site over the ranges of the file when it was imported and of its new content is
+        removed. The files with raw data in those ranges are then imported again in file name
+        order, with the new content in the place of file, so that each time again has the data of
+        the first file that covers it. Files that no longer exist are skipped, so their data in
+        the ranges is not kept, as it would not be by a new import. """
+        new_ranges = self._site_ranges(df)
+        if self.data_table_raw is None:
+            # Only forecasts, which are replaced by the rows of the same forecast times
+            self._import_df_to_db(df, file)
+            return
+        table = self.file_ranges_table
         with self.db_engine.connect() as conn:
-            db_intervals = list(conn.execute(stmt))
-        for existing_start, existing_end in db_intervals:
-            next_intervals = []
-            while intervals_to_add:
-                new_start, new_end = intervals_to_add.pop()
-                # Check for overlap. Maybe not needed if existing interval query works?
-                if new_end < existing_start or new_start > existing_end:
-                    next_intervals.append((new_start, new_end))
-                    continue
-                if new_start < existing_start:
-                    next_intervals.append((new_start, existing_start - Δt))
-                if new_end > existing_end:
-                    next_intervals.append((existing_end + Δt, new_end))
-            intervals_to_add = next_intervals
-        return intervals_to_add
-
-    def _rebuild_processed_data(self):
-        """ Rebuilds table of processed data. Currently reprocessed *all* data.
+            old_ranges = list(conn.execute(sqlalchemy.select(table.c.site_id, table.c.start, table.c.end)
+                                           .where(table.c.fname == file.name)))
+        removed = {}
+        for site_id, start, end in old_ranges + [(site_id, *r) for site_id, r in new_ranges.items()]:
+            removed.setdefault(site_id, []).append((start, end))
+        self._record_missing_file_ranges(exclude=file.name)
+
+        with self.db_engine.begin() as conn:
+            overlapping = self._files_overlapping(conn, removed) - {file.name}
+            interval_sets = self._remove_raw_data(conn, removed)
+        self.intervals.update(interval_sets)
+        for site_id, intervals in removed.items():
+            self._dirty_intervals.setdefault(site_id, []).extend(intervals)
+        self._bump_data_version()
+
+        for file_name in sorted(overlapping | {file.name}):
+            if file_name == file.name:
+                self._import_df_to_db(df)
+            elif os.path.exists(file_name):
+                _log.debug(f"Importing {file_name} again since it overlaps {file.name}")
+                self._import_df_to_db(self._read_file(file_name))
+            else:
+                _log.info(f"Not importing {file_name} again since it no longer exists")
+        # The file is recorded last, so that it is imported again if this is interrupted
+        with self.db_engine.begin() as conn:
+            self._record_files(conn, [file])
+            self._record_file_ranges(conn, file.name, new_ranges)
+
+    def _files_overlapping(self, conn, site_ranges):
+        """ Return the set of the names of the files with raw data in any of the (start, end)
+        ranges in site_ranges, a dict of lists of ranges by site id. """
+        table = self.file_ranges_table
+        names = set()
+        for site_id, ranges in site_ranges.items():
+            for start, end in ranges:
+                names.update(conn.execute(sqlalchemy.select(table.c.fname).where(
+                    table.c.site_id == site_id, table.c.start <= end, table.c.end >= start)).scalars())
+        return names
+
+    def _record_missing_file_ranges(self, exclude=None):
+        """ Record the ranges of the files in the files table that have none, such as the files
+        imported by versions that did not record them, other than the file named exclude. Files
+        without raw data have no ranges, so they are read again each time. """
+        files, ranges = self.files_table, self.file_ranges_table
+        with self.db_engine.connect() as conn:
+            file_names = list(conn.execute(sqlalchemy.select(files.c.fname).where(
+                files.c.fname.not_in(sqlalchemy.select(ranges.c.fname)))).scalars())
+        file_names = [f for f in file_names if f != exclude and os.path.exists(f)]
+        if file_names:
+            _log.info(f"Recording the ranges of {len(file_names)} files imported before")
+        for file_name in file_names:
+            file_ranges = self._site_ranges(self._read_file(file_name))
+            with self.db_engine.begin() as conn:
+                self._record_file_ranges(conn, file_name, file_ranges)
+
+    def _remove_raw_data(self, conn, site_ranges):
+        """ Remove the raw data of each site in the (start, end) ranges in site_ranges, a dict of
+        lists of ranges by site id, and remove the ranges from the intervals table. Returns a dict
+        of the updated IntervalSets of the sites. """
+        raw = self.data_table_raw
+        interval_sets = {}
+        for site_id, ranges in site_ranges.items():
+            for start, end in ranges:
+                conn.execute(sqlalchemy.delete(raw).where(raw.c.site_id == site_id, raw.c.dt >= start,
+                                                          raw.c.dt <= end))
+                self._mark_unsynced(raw, site_id, start, end)
+            interval_sets[site_id] = IntervalSet(IntervalSet(ranges).difference(self._site_intervals(site_id),
+                                                                                self._Δt),
+                                                 tolerance=self._interval_tolerance)
+        intervals = self.intervals_table
+        for site_id, interval_set in interval_sets.items():
+            conn.execute(sqlalchemy.delete(intervals).where(intervals.c.site_id == site_id))
+            if len(interval_set):
+                conn.execute(sqlalchemy.insert(intervals), [{'site_id': site_id, 'start': s, 'end': e}
+                                                            for s, e in interval_set])
+        return interval_sets
+
+    def _new_intervals_to_add(self, intervals_to_add, site_id=default_site_id):
+        """ Return the parts of the given (start, end) intervals that are not already covered by
+        the raw data of site_id. """
+        return self._site_intervals(site_id).difference(intervals_to_add, self._Δt)
+
+    def _rebuild_processed_data(self, intervals=None, workers=1):
+        """ Rebuilds table of processed data. If intervals is None, *all* data is reprocessed.
+        Otherwise intervals is a dict of the (start, end) intervals of raw data added for each
+        site id, and only the average_interval buckets affected by them are reprocessed and
+        replaced in the table. The raw data is processed in that many worker processes if
+        workers is not 1 (0 for one per CPU) while the results are written to the database.
         Missing data is saved as NaN. """
-        # Interpolation step. Initially fill the entire period, even the gaps.
-        # Interpolated data is saved in a DataFrame in memory rather than to the db.
-        df = self._load_dt_range(self.data_table_raw)
+        if intervals is None:
+            with self.db_engine.begin() as conn:
+                self.data_table.drop(conn)
+                self.data_table.create(conn)
+            windows = [(site_id, None, None) for site_id in self._table_site_ids(self.data_table_raw)]
+        else:
+            windows = []
+            for site_id, site_intervals in intervals.items():
+                if self._processed_data_empty(site_id):
+                    windows.append((site_id, None, None))
+                else:
+                    windows.extend((site_id, start, end) for start, end in self._dirty_windows(site_id, site_intervals))
+        if not windows and intervals is not None:
+            return
+
+        # The intervals are needed for processing, so load them before the dataset is copied to
+        # any worker processes
+        self.intervals
+        raw_data = ((site_id, start, end, self._load_raw_window(site_id, start, end))
+                    for site_id, start, end in windows)
+        results = _imap(self, '_process_window', raw_data, workers if len(windows) > 1 else 1)
+        for site_id, start, end in windows:
+            # The raw data is loaded and processed while waiting for the result
+            with profiling.span('archive.rebuild.process', dataset=self.db_table_prefix, site_id=int(site_id)):
+                df = next(results)
+            if df is None:
+                continue
+            table = self.data_table
+            with profiling.span('archive.rebuild.write', dataset=self.db_table_prefix, site_id=int(site_id),
+                                rows=len(df)):
+                with self.db_engine.begin() as conn:
+                    if start is not None:
+                        conn.execute(sqlalchemy.delete(table).where(table.c.site_id == site_id,
+                                                                    table.c.dt >= start, table.c.dt < end))
+                    bulk_insert(conn, table, df.assign(site_id=site_id), batch_size=self.insert_batch_size)
+
+        if intervals is None:
+            self.storage.sync(self, self.data_table)
+        else:
+            for site_id in dict.fromkeys(site_id for site_id, _, _ in windows):
+                site_windows = [(start, end) for s, start, end in windows if s == site_id]
+                # Sites that had no processed data were rebuilt in full
+                self.storage.sync(self, self.data_table, None if site_windows[0][0] is None else site_windows,
+                                  site_id)
+        self._bump_data_version()
+
+    def _load_raw_window(self, site_id, start=None, end=None):
+        """ Return the raw data of site_id needed to reprocess the processed rows from start
+        (inclusive) to end (exclusive), or all of the raw data of the site if start is None. """
+        if start is None:
+            return self._load_dt_range(self.data_table_raw, site_id)
+        # Include the nearest raw data points outside the range so that interpolation at the
+        # edges of the range gives the same result as processing all of the data.
+        return pd.concat([self._load_neighbor_row(self.data_table_raw, site_id, start, before=True),
+                          self._load_dt_range(self.data_table_raw, site_id, start, end - self._Δt),
+                          self._load_neighbor_row(self.data_table_raw, site_id, end, before=False)])
 
+    def _process_window(self, site_id, start, end, df):
+        """ Process the raw data df loaded by _load_raw_window into the processed rows of site_id
+        from start (inclusive) to end (exclusive), or all rows if start is None. Returns None if
+        there is not enough data to process. """
         # Processing steps don't work if there isn't any data to process
         if len(df) < 2:
-            return df
+            return None
+        df4 = self._process_raw_data(df, site_id)
+        if start is not None:
+            df4 = df4.loc[(df4.index >= start) & (df4.index < end)]
+        return df4
 
+    def _process_raw_data(self, df, site_id=default_site_id):
+        """ Interpolates raw data of site_id to resample_interval, sets large gaps between
+        intervals of raw data to NaN, averages to average_interval, and applies any additional
+        post-processing. """
         index = pd.date_range(
             start=df.index[0].ceil(self.resample_interval),
             end=df.index[-1].floor(self.resample_interval),
@@ -170,17 +705,10 @@ class DataSet:
         )
         df2 = interpolate_to_index(df, index)
 
-        # Fill "large" gaps with NaN
-        with self.db_engine.connect() as conn:
-            db_intervals = list(conn.execute(sqlalchemy.select(self.intervals_table.c.start,
-                                                               self.intervals_table.c.end)
-                                             .order_by(self.intervals_table.c.start)))
-
         # Set large gaps between intervals to NaN.
-        Δt = index[1] - index[0]
-        for (start1, end1), (start2, end2) in zip(db_intervals[:-1], db_intervals[1:]):
-            if start2 - end1 > 2*Δt:
-                df2.loc[(end1+Δt/10):(start2-Δt/10)] = np.nan
+        Δt = pd.to_timedelta(self.resample_interval)
+        for end1, start2 in self._site_intervals(site_id).gaps(2*Δt, df.index[0], df.index[-1]):
+            df2.loc[(end1+Δt/10):(start2-Δt/10)] = np.nan
 
         # Resampling step. Use avg.
         if self.average_interval is not None:
@@ -189,34 +717,74 @@ class DataSet:
             df3 = df2
 
         # Additional post-processing
-        df4 = self._addl_postprocess(df3)
+        return self._addl_postprocess(df3)
 
-        # Save to database
-        with self.db_engine.begin() as conn:
-            self.data_table.drop(conn)
-            self.data_table.create(conn)
-            df4.to_sql(self.db_table_data, conn, if_exists='append')
+    def _dirty_windows(self, site_id, intervals):
+        """ Converts intervals of added raw data of site_id into sorted, non-overlapping (start, end) windows
+        of processed data that need to be rebuilt. Each window is extended to the neighboring raw
+        data points, since interpolation and gap filling depend on them, then to whole buckets of
+        average_interval, plus a margin of one bucket on each side. End is exclusive. """
+        freq = pd.to_timedelta(self.average_interval or self.resample_interval)
+        windows = []
+        for start, end in intervals:
+            before = self._load_neighbor_row(self.data_table_raw, site_id, start, before=True)
+            after = self._load_neighbor_row(self.data_table_raw, site_id, end, before=False)
+            start = before.index[0] if len(before) else pd.Timestamp(start)
+            end = after.index[0] if len(after) else pd.Timestamp(end)
+            windows.append((start.floor(freq) - freq, end.floor(freq) + 2*freq))
+        return list(IntervalSet(windows))
 
-        return df4
+    def _processed_data_empty(self, site_id):
+        with self.db_engine.connect() as conn:
+            row = conn.execute(sqlalchemy.select(self.data_table.c.dt)
+                               .where(self.data_table.c.site_id == site_id).limit(1)).first()
+        return row is None
+
+    @property
+    def _Δt(self):
+        """ Small time step used to make time ranges open on one end. """
+        return pd.to_timedelta(self.resample_interval) / 10
+
+    @property
+    def _interval_tolerance(self):
+        """ Intervals of raw data that are separated by no more than this are merged. """
+        return self._Δt
+
+    def _load_neighbor_row(self, table, site_id, dt, before=True):
+        """ Return DataFrame with the row of the table for site_id that is nearest to dt, either strictly
+        before or strictly after it. The DataFrame is empty if there is no such row. """
+        stmt = sqlalchemy.select(*_data_columns(table)).where(table.c.site_id == site_id)
+        if before:
+            stmt = stmt.where(table.c.dt < dt).order_by(table.c.dt.desc())
+        else:
+            stmt = stmt.where(table.c.dt > dt).order_by(table.c.dt)
+        df = pd.read_sql(stmt.limit(1), self.db_engine, index_col='dt')
+        df.columns = [str(c) for c in df.columns]
+        return df
 
     def _addl_postprocess(self, df):
         return df
 
-    def _load_dt_range(self, table, start=None, end=None):
-        """ Return DataFrame with data from specified database table.
-        Start and end parameters should be datetime compatible. Start and end
+    def _load_dt_range(self, table, site_id, start=None, end=None):
+        """ Return DataFrame with data of site_id from specified database table, read through the storage
+        backend. Start and end parameters should be datetime compatible. Start and end
         times are inclusive. (Add or subtract a small Δ to make one or both exclusive. """
-        cond = []
+        return self.storage.read_range(self, table, site_id, start, end)
+
+    def _read_sql_dt_range(self, table, site_id, start=None, end=None, inclusive='both', columns=None):
+        """ Return DataFrame with data of site_id from specified database table, queried from the
+        database. inclusive is 'both' or 'left' and gives which of start and end are included. """
+        cond = [table.c.site_id == site_id]
         if start is not None:
             cond.append(table.c.dt >= start)
-        if start is not None:
-            cond.append(table.c.dt <= end)
-        stmt = sqlalchemy.select(table)
-        if cond:
-            stmt = stmt.where(*cond)
-        stmt = stmt.order_by(table.c.dt)
+        if end is not None:
+            cond.append(table.c.dt <= end if inclusive == 'both' else table.c.dt < end)
+        if columns is None:
+            cols = _data_columns(table)
+        else:
+            cols = [table.c.dt] + [table.c[c] for c in columns if c != 'dt']
+        stmt = sqlalchemy.select(*cols).where(*cond).order_by(table.c.dt)
         df = pd.read_sql(stmt, self.db_engine, index_col='dt')
-        df = df.drop(columns='id')
         # Convert columns from sqlalchemy quoted_name to str. Otherwise sklearn issues a warning.
         df.columns = [str(c) for c in df.columns]
         return df
@@ -224,44 +792,161 @@ class DataSet:
     @property
     def file_names(self):
         """ Get list of file names in the data directory. """
-        return sorted(glob.glob(os.path.join(self.data_dir, '*.csv')))
+        return [entry.path for entry in self._scan_files()]
+
+    def _scan_files(self):
+        """ Return the os.DirEntry of each data file in the data directory, sorted by path. Hidden
+        files are skipped, as by glob. """
+        try:
+            with os.scandir(self.data_dir) as it:
+                entries = [entry for entry in it
+                           if not entry.name.startswith('.') and fnmatch.fnmatch(entry.name, self.file_pattern)
+                           and entry.is_file()]
+        except FileNotFoundError:
+            return []
+        return sorted(entries, key=lambda entry: entry.path)
+
+    def _files_to_import(self, ready=None):
+        """ Return a DataFile for each data file that is new or whose content changed since it was
+        imported, in file name order. If ready is given, it is called with the name and os.stat_result
+        of each file that is new or whose size or modification time changed, and the files for which
+        it returns False are skipped without being read.
+
+        Files whose size and modification time are the same as when they were imported are skipped
+        without being read. Other files that were imported before are hashed, and only those whose
+        content changed are returned. The latest modification time in the files table is used as a
+        high-water mark: only the files modified after it are looked up in the table, as long as the
+        number of older files matches the table. Otherwise, such as when files were deleted or copied
+        in with their old modification times, all files are compared with the table. """
+        table = self.files_table
+        stats = [(entry.path, entry.stat()) for entry in self._scan_files()]
+        with self.db_engine.connect() as conn:
+            n_files, n_without_stats, mark = conn.execute(sqlalchemy.select(
+                sqlalchemy.func.count(),
+                sqlalchemy.func.count() - sqlalchemy.func.count(table.c.mtime_ns),
+                sqlalchemy.func.max(table.c.mtime_ns))).one()
+            candidates = stats
+            records = None
+            if n_files and not n_without_stats:
+                candidates = [(f, st) for f, st in stats if st.st_mtime_ns > mark]
+                records = self._file_records(conn, [f for f, _ in candidates])
+                if len(stats) - len(candidates) + len(records) != n_files:
+                    candidates = stats
+                    records = None
+            if records is None:
+                if n_files:
+                    _log.debug(f"Comparing all files in {self.data_dir} with {table.name}")
+                records = self._file_records(conn)
+
+        files = []
+        unchanged = []
+        for file_name, st in candidates:
+            record = records.get(file_name)
+            if record is not None and (record.size, record.mtime_ns) == (st.st_size, st.st_mtime_ns):
+                continue
+            if ready is not None and not ready(file_name, st):
+                continue
+            file = DataFile(file_name, st.st_size, st.st_mtime_ns, _file_hash(file_name), False)
+            if record is None:
+                files.append(file)
+            elif record.hash is None or record.hash == file.hash:
+                # Files recorded by older versions, which did not record the content, are assumed
+                # to be unchanged
+                unchanged.append(file)
+            else:
+                files.append(file._replace(changed=True))
+        if unchanged:
+            with self.db_engine.begin() as conn:
+                self._record_files(conn, unchanged)
+        return files
+
+    def _file_records(self, conn, file_names=None):
+        """ Rows of the files table by file name, for the given file names or all files if
+        file_names is None. """
+        table = self.files_table
+        stmt = sqlalchemy.select(table.c.fname, table.c.size, table.c.mtime_ns, table.c.hash)
+        if file_names is None:
+            rows = conn.execute(stmt)
+        else:
+            # Limit the number of parameters per query
+            rows = [row for i in range(0, len(file_names), 500)
+                    for row in conn.execute(stmt.where(table.c.fname.in_(file_names[i:i + 500])))]
+        return {row.fname: row for row in rows}
+
+    def _record_files(self, conn, files):
+        """ Record the DataFiles files in the files table, replacing any rows of the same names. """
+        table = self.files_table
+        for i in range(0, len(files), 500):
+            conn.execute(sqlalchemy.delete(table).where(table.c.fname.in_([f.name for f in files[i:i + 500]])))
+        conn.execute(sqlalchemy.insert(table), [{'fname': f.name, 'size': f.size, 'mtime_ns': f.mtime_ns,
+                                                 'hash': f.hash} for f in files])
+
+    def _record_file_ranges(self, conn, file_name, file_ranges):
+        """ Record the (start, end) range of the raw data of each site in file_name, from the dict
+        file_ranges by site id, replacing the ranges recorded when it was last imported. """
+        table = self.file_ranges_table
+        conn.execute(sqlalchemy.delete(table).where(table.c.fname == file_name))
+        if file_ranges:
+            conn.execute(sqlalchemy.insert(table), [{'fname': file_name, 'site_id': site_id, 'start': start,
+                                                     'end': end} for site_id, (start, end) in file_ranges.items()])
 
     def _read_file(self, file_name):
         """ Read an individual data file and return a DataFrame of the data. """
         # Override in child classes.
         raise NotImplementedError
 
-    def _remove_duplicate_rows(self, table):
-        cols = [v for k, v in table.columns.items() if k != 'id']
-        """ SQL Code
+    def _read_files(self, file_names, workers=1):
+        """ Generator that reads the given files and yields (file_name, DataFrame) tuples in the
+        same order as file_names. If workers is not 1, the files are read in a pool of worker
+        processes. Only a few files more than the number of workers are read ahead of the consumer
+        so that memory use stays bounded. """
+        if len(file_names) < 2:
+            workers = 1
+        results = _imap(self, '_read_file', ((f,) for f in file_names), workers)
+        for file_name in file_names:
+            # With worker processes, this is the time spent waiting for the file to be read
+            with profiling.span('archive.read_file', dataset=self.db_table_prefix, file=file_name) as s:
+                df = next(results)
+                if profiling.enabled():
+                    s.set(rows=len(df), bytes=os.path.getsize(file_name))
+            yield file_name, df
+
+    def _remove_duplicate_rows(self, table, cols=None, conn=None):
+        """ Delete rows that have the same values in cols (by default, all columns other than id)
+        as a row with a larger id, so that the most recently inserted row is kept.
+
+        SQL Code
         DELETE from meteogram_data_fx
         WHERE id NOT IN
         (
             SELECT MAX(id) FROM meteogram_data_fx GROUP BY current_dt, dt
         )
         """
+        if cols is None:
+            cols = [v for k, v in table.columns.items() if k != 'id']
         ids_to_keep = sqlalchemy.select(sqlalchemy.sql.func.max(table.c.id).label('max_id')).group_by(*cols)
         stmt = sqlalchemy.delete(table).where(table.c.id.not_in(ids_to_keep))
+        if conn is not None:
+            conn.execute(stmt)
+            return
         with self.db_engine.begin() as conn:
             conn.execute(stmt)
 
-    def _remove_duplicate_rows_all_tables(self):
-        for t in [self.data_table_raw]:
-            self._remove_duplicate_rows(t)
-
     @property
     def date_range(self):
         """ Returns the start and end dates of the data set."""
         return self.start, self.end
 
-    def get_data_by_date(self, site_id=0, start=None, end=None):
-        """ Returns data beginning on start and going to end (not inclusive).
+    def get_data_by_date(self, site_id=default_site_id, start=None, end=None):
+        """ Returns data of site_id beginning on start and going to end (not inclusive).
         start and end may be dates or datetimes. """
+        self._check_site_id(site_id)
         if start is not None:
             start = pd.to_datetime(start)
         if end is not None:
             end = pd.to_datetime(end) - pd.to_timedelta(self.resample_interval)/10  # Open interval on end
-        return self._load_dt_range(self.data_table, start, end)
+        return self._cached_query(self.data_table, (site_id, start, end),
+                                  lambda: self._load_dt_range(self.data_table, site_id, start, end))
 
     def get_data_batches(self, site_id, ndays, start=None, end=None,
                          incomplete=True):
@@ -269,44 +954,201 @@ class DataSet:
         sequentially. Rows for days with missing data are filled with NA.
         The incomplete parameter determines whether the last, incomplete batch
         should be returned or not."""
+        for batch_start, batch_end in self._batch_ranges(ndays, start, end, incomplete):
+            yield self.get_data_by_date(site_id, batch_start, batch_end)
+
+    def iter_data_batches(self, site_id, ndays, start=None, end=None,
+                          incomplete=True, chunksize=10000, prefetch=1):
+        """ Streaming version of get_data_batches that returns the same batches. The processed
+        data for the whole range is read with a single ordered query, chunksize rows at a time,
+        so memory use depends on the batch size rather than the size of the range. The next
+        prefetch batches are read in a background thread while the current batch is being used.
+        If prefetch is 0, batches are read only when requested. Batches are not prefetched from
+        engines whose connections belong to one thread, such as in-memory sqlite databases, since
+        another thread would see a different database. """
+        self._check_site_id(site_id)
+        batches = self._stream_batches(site_id, ndays, start, end, incomplete, chunksize)
+        if prefetch > 0 and not isinstance(self.db_engine.pool, sqlalchemy.pool.SingletonThreadPool):
+            batches = _prefetch(batches, prefetch)
+        return batches
+
+    def _batch_ranges(self, ndays, start, end, incomplete):
+        """ Generator of (start, end) ranges for get_data_by_date for each batch of
+        get_data_batches. """
         if start is None:
             start = self.start
         if end is None:
             end = self.end
         days_available = (end - start).days + 1
         for n in range(days_available//ndays):
-            yield self.get_data_by_date(site_id,
-                                        start + n*timedelta(days=ndays),
-                                        start + (n+1)*timedelta(days=ndays) - timedelta(days=1))
+            yield (start + n*timedelta(days=ndays),
+                   start + (n+1)*timedelta(days=ndays) - timedelta(days=1))
         if incomplete and (start + (days_available//ndays)*timedelta(days=ndays) <= end):
-            yield self.get_data_by_date(site_id,
-                                        start + (days_available//ndays)*timedelta(days=ndays),
-                                        end)
+            yield start + (days_available//ndays)*timedelta(days=ndays), end
+
+    def _stream_batches(self, site_id, ndays, start, end, incomplete, chunksize):
+        # Inclusive ranges as used by _load_dt_range
+        Δt = self._Δt
+        ranges = [(pd.to_datetime(s), pd.to_datetime(e) - Δt)
+                  for s, e in self._batch_ranges(ndays, start, end, incomplete)]
+        if not ranges:
+            return
+
+        table = self.data_table
+        stmt = sqlalchemy.select(*_data_columns(table))\
+            .where(table.c.site_id == site_id, table.c.dt >= ranges[0][0], table.c.dt <= ranges[-1][1])\
+            .order_by(table.c.dt)
+        # Chunks of only NULL values would otherwise have object dtype
+        dtype = {c.name: 'float64' for c in table.columns if isinstance(c.type, sqlalchemy.Float)}
+        with self.db_engine.connect() as conn:
+            conn = conn.execution_options(stream_results=True)
+            chunks = pd.read_sql(stmt, conn, index_col='dt', chunksize=chunksize, dtype=dtype)
+            i = 0
+            pieces = []
+            empty = None
+            for chunk in chunks:
+                chunk.columns = [str(c) for c in chunk.columns]
+                empty = chunk.iloc[0:0]
+                if chunk.empty:
+                    continue
+                # A chunk may complete any number of batches
+                while i < len(ranges):
+                    batch_start, batch_end = ranges[i]
+                    pieces.append(chunk.loc[(chunk.index >= batch_start) & (chunk.index <= batch_end)])
+                    if chunk.index[-1] <= batch_end:
+                        break
+                    yield pd.concat(pieces)
+                    pieces = []
+                    i += 1
+
+        # Remaining batches have no more data
+        for batch_start, batch_end in ranges[i:]:
+            if pieces:
+                yield pd.concat(pieces)
+                pieces = []
+            elif empty is not None:
+                yield empty.copy()
+            else:
+                yield self._load_dt_range(table, site_id, batch_start, batch_end)
 
     @property
     def continuous_data_intervals(self):
         """
-        Return a list of intervals in which the data does not have gaps.
+        Return a list of intervals in which the data of default_site_id does not have gaps.
         """
-        stmt = sqlalchemy.select(self.intervals_table.c.start, self.intervals_table.c.end)
-        stmt = stmt.order_by(self.intervals_table.c.start.asc())
+        return self.get_continuous_data_intervals()
 
-        with self.db_engine.connect() as conn:
-            db_intervals = list(conn.execute(sqlalchemy.select(self.intervals_table.c.start,
-                                                               self.intervals_table.c.end)
-                                             .order_by(self.intervals_table.c.start)))
+    def get_continuous_data_intervals(self, site_id=default_site_id):
+        """
+        Return a list of intervals in which the data of site_id does not have gaps.
+        """
+        self._check_site_id(site_id)
+        Δt = pd.to_timedelta(self.resample_interval) / 10
+        interval_set = self._site_intervals(site_id)
+        if len(interval_set) == 0:
+            return []
+        gaps = interval_set.gaps(2*Δt)
+        starts = [interval_set.starts[0]] + [start for end, start in gaps]
+        ends = [end for end, start in gaps] + [interval_set.ends[-1]]
+        return [(pd.Timestamp(start), pd.Timestamp(end)) for start, end in zip(starts, ends)]
 
 
-        Δt = pd.to_timedelta(self.resample_interval) / 10
-        interval_start = db_intervals[0][0]
-        intervals = []
-        for (start1, end1), (start2, end2) in zip(db_intervals[:-1], db_intervals[1:]):
-            if start2 - end1 > 2*Δt:
-                # End the continuous interval and start a new one
-                intervals.append((interval_start, end1))
-                interval_start = start2
-        intervals.append((interval_start, end2))
-        return intervals
+def _prefetch(iterator, size):
+    """ Generator that yields the items of iterator, which are produced in a background thread
+    up to size items ahead of the consumer. Exceptions are raised in the consumer. """
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item, error=None):
+        # Give up if the consumer stopped, since it no longer takes items from a full queue
+        while not stop.is_set():
+            try:
+                items.put((item, error), timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterator:
+                if not put(item):
+                    return
+            put(done)
+        except Exception as e:
+            put(done, e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _file_hash(file_name, block_size=2**20):
+    """ Hash of the content of a file. """
+    h = hashlib.blake2b(digest_size=16)
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _data_columns(table):
+    """ Columns of table that are returned by queries: all but the id and site_id keys. """
+    return [c for c in table.columns if c.name not in ('id', 'site_id')]
+
+
+def _imap(dataset, method, args, workers=1):
+    """ Generator that calls the method of dataset named method with each tuple of arguments
+    of the iterable args and yields the results in the same order. If workers is not 1, the calls
+    are made in a pool of worker processes, each with a copy of dataset. If workers is 0, one
+    worker process per CPU is used. args is consumed only a few calls more than the number of
+    workers ahead of the consumer so that memory use stays bounded. """
+    if workers == 1:
+        for a in args:
+            yield getattr(dataset, method)(*a)
+        return
+
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(dataset,)) as executor:
+        pending = deque()
+        args = iter(args)
+
+        def submit_next():
+            a = next(args, None)
+            if a is not None:
+                pending.append(executor.submit(_call_in_worker, method, *a))
+
+        for _ in range(2*workers):
+            submit_next()
+        while pending:
+            future = pending.popleft()
+            submit_next()
+            yield future.result()
+
+
+# Dataset used by the calls made in worker processes. Set once per worker by _init_worker.
+_worker_dataset = None
+
+
+def _init_worker(dataset):
+    global _worker_dataset
+    _worker_dataset = dataset
+
+
+def _call_in_worker(method, *args):
+    return getattr(_worker_dataset, method)(*args)
 
 
 def extract_complete_days(df, expected_interval=None):
@@ -0,0 +1,100 @@
+"""
+Bulk write path for the sqlite database used by the archiver. DataFrames are inserted
+with a prepared statement and executemany in batches rather than through
+DataFrame.to_sql, which builds and type-converts every row through SQLAlchemy.
+"""
+import logging
+
+import pandas as pd
+import sqlalchemy
+
+_log = logging.getLogger(__name__)
+
+default_batch_size = 10000
+
+# Format used by the SQLAlchemy sqlite dialect to store DateTime columns. Timestamps are
+# formatted the same way here so that they compare correctly with existing rows.
+_sqlite_datetime_format = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def bulk_insert(conn, table, df, index=True, batch_size=default_batch_size):
+    """ Insert the rows of df into table on the SQLAlchemy connection conn. The index is written
+    as a column (named by the index name) if index is True. Columns are matched to table columns
+    by name. NaN and NaT values are stored as NULL. Rows are sent in batches of batch_size to
+    limit the memory used for conversion. """
+    if index:
+        df = df.reset_index()
+    return _insert_rows(conn, table.name, {c.name: c.type for c in table.columns}, df, batch_size)
+
+
+def bulk_upsert(conn, table, df, index=True, batch_size=default_batch_size):
+    """ Insert the rows of df into table like bulk_insert, but rows that conflict with an existing
+    row on a unique index of table replace the existing row. The rows are first bulk inserted
+    into a temporary staging table and then merged into table in one statement, so the cost of
+    deduplication depends on the number of new rows rather than the size of table. Of several new
+    rows with the same key, the last one is kept. """
+    if index:
+        df = df.reset_index()
+    if df.empty:
+        return 0
+
+    cols = ', '.join(_quote(conn, str(c)) for c in df.columns)
+    target = _quote(conn, table.name)
+    staging = _quote(conn, table.name + '_staging')
+    conn.exec_driver_sql(f'DROP TABLE IF EXISTS temp.{staging}')
+    conn.exec_driver_sql(f'CREATE TEMP TABLE {staging} AS SELECT {cols} FROM {target} WHERE 0')
+    _insert_rows(conn, table.name + '_staging', {c.name: c.type for c in table.columns}, df, batch_size)
+    conn.exec_driver_sql(f'INSERT OR REPLACE INTO {target} ({cols}) '
+                         f'SELECT {cols} FROM temp.{staging} ORDER BY rowid')
+    conn.exec_driver_sql(f'DROP TABLE temp.{staging}')
+    return len(df)
+
+
+def _insert_rows(conn, table_name, col_types, df, batch_size):
+    if df.empty:
+        return 0
+    cols = [str(c) for c in df.columns]
+    stmt = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        _quote(conn, table_name),
+        ', '.join(_quote(conn, c) for c in cols),
+        ', '.join('?' for _ in cols))
+    for i in range(0, len(df), batch_size):
+        conn.exec_driver_sql(stmt, _to_records(df.iloc[i:i + batch_size], cols, col_types))
+    return len(df)
+
+
+def _to_records(df, cols, col_types):
+    """ Convert a DataFrame to a list of tuples of Python objects that sqlite3 accepts. """
+    columns = []
+    for c, (_, s) in zip(cols, df.items()):
+        if isinstance(col_types.get(c), sqlalchemy.DateTime) or pd.api.types.is_datetime64_any_dtype(s):
+            s = pd.to_datetime(s).dt.strftime(_sqlite_datetime_format)
+        s = s.astype(object)
+        columns.append(s.where(s.notna(), None).tolist())
+    return list(zip(*columns))
+
+
+def _quote(conn, name):
+    return conn.dialect.identifier_preparer.quote(name)
+
+
+def apply_sqlite_performance_profile(engine, cache_size_mb=64, busy_timeout=600):
+    """ Configure every connection made by engine for faster bulk writes: WAL journal mode,
+    synchronous=NORMAL, an in-memory temp store, and a larger page cache. WAL mode is
+    persistent in the database file. With synchronous=NORMAL, a power loss may roll back the
+    most recent transactions but does not corrupt the database. A connection that needs a lock
+    held by another process, such as another group of archive --jobs, waits for up to
+    busy_timeout seconds for it. """
+    @sqlalchemy.event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # Set first, since switching to WAL mode also needs a lock
+        cursor.execute(f'PRAGMA busy_timeout={int(busy_timeout * 1000)}')
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        # Negative cache_size is in KiB rather than pages
+        cursor.execute(f'PRAGMA cache_size=-{int(cache_size_mb * 1024)}')
+        cursor.close()
+    _log.debug(f"Applied sqlite performance profile to {engine}")
+    return engine
@@ -1,32 +1,53 @@
+import hashlib
+import json
+import os
+
 import pandas as pd
 import sqlalchemy
-from .base import DataSet
+from .base import DataSet, _imap, default_site_id, site_id_column
 from ems.solar_model import clearsky
 
 """
 This "dataset" is imply a way to cache the pvlib modeled output for a given system since these calculations are
 somewhat computationally intensive and are reused many times in the PV forecasts in the ems.forecast sub-package.
-When reading from the database, does not verify that the current location matches the location of previous calculations.
+The tables of each location are named with a hash of the location parameters, so several locations can share a
+database and cached output is only used for the location it was calculated for.
 """
 
+# Location parameters that the modeled output depends on
+location_params = ['lat', 'lon', 'elevation', 'tilt', 'azimuth', 'nominal_max_output']
+
+
+def location_key(location):
+    """ Short hash of the parameters of location that the modeled output depends on. """
+    params = {p: float(location[p]) for p in location_params if p in location}
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+
 
 class ClearskyModel(DataSet):
     _df_cache = None
     _cfg_key = "Clearsky Model"
 
     def __init__(self, location, db_engine=None, db_table='clearsky_model',
-                 resample_interval='1min', average_interval='1h'):
+                 resample_interval='1min', average_interval='1h', workers=1, chunk_size='7D'):
         """ location: dict with location information. Should have members
-            'lat', 'lon', 'name', 'elevation', 'tilt', 'azimuth', 'nominal_max_output'."""
-        super().__init__(db_engine, db_table, resample_interval, average_interval)
+            'lat', 'lon', 'name', 'elevation', 'tilt', 'azimuth', 'nominal_max_output'.
+        Missing output is calculated in periods of up to chunk_size, in a pool of worker processes
+        if workers is not 1. If workers is 0, one worker process per CPU is used. """
         self.location = location
-
-        self.ids = [1]
+        self.location_key = location_key(location)
+        super().__init__(db_engine, f'{db_table}_{self.location_key}', resample_interval, average_interval)
+        self.workers = workers
+        self.chunk_size = chunk_size
 
     def _define_table_files(self):
         self.files_table = None
         return self.files_table
 
+    def _define_table_file_ranges(self):
+        self.file_ranges_table = None
+        return self.file_ranges_table
+
     def _define_col_names(self):
         self.raw_col_name = 'modeled_output'
 
@@ -35,10 +56,12 @@ class ClearskyModel(DataSet):
             self.db_table_data_raw,
             self.meta,
             sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
-            sqlalchemy.Column('dt', sqlalchemy.DateTime, index=True),
+            site_id_column(),
+            sqlalchemy.Column('dt', sqlalchemy.DateTime),
             sqlalchemy.Column(self.raw_col_name, sqlalchemy.Float),
             sqlalchemy.Column('effective_irradiance', sqlalchemy.Float),
-            sqlalchemy.Column('modeled_ghi', sqlalchemy.Float)
+            sqlalchemy.Column('modeled_ghi', sqlalchemy.Float),
+            sqlalchemy.Index(f'ix_{self.db_table_data_raw}_site_id_dt', 'site_id', 'dt', unique=True)
         )
         return self.data_table_raw
 
@@ -47,24 +70,27 @@ class ClearskyModel(DataSet):
             self.db_table_data,
             self.meta,
             sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
-            sqlalchemy.Column('dt', sqlalchemy.DateTime, index=True),
+            site_id_column(),
+            sqlalchemy.Column('dt', sqlalchemy.DateTime),
             sqlalchemy.Column(self.raw_col_name, sqlalchemy.Float),
             sqlalchemy.Column('effective_irradiance', sqlalchemy.Float),
-            sqlalchemy.Column('modeled_ghi', sqlalchemy.Float)
+            sqlalchemy.Column('modeled_ghi', sqlalchemy.Float),
+            sqlalchemy.Index(f'ix_{self.db_table_data}_site_id_dt', 'site_id', 'dt')
         )
         return self.data_table
 
-    def import_all_data(self, start=None, end=None):
+    def import_all_data(self, start=None, end=None, workers=None):
         """ Import all available data into the database. Any existing data is dropped from the database first.
         Generates the clearsky model output from start (inclusive) to end (exclusive). If start and/or end
         are not provided, a window of 6 weeks is provided, centered on the current date if neither is given. """
-        self.meta.drop_all(self.db_engine)
-        self.import_new_data(start, end)
+        self._drop_tables()
+        self.import_new_data(start, end, workers)
 
-    def import_new_data(self, start=None, end=None):
+    def import_new_data(self, start=None, end=None, workers=None):
         """ Import available data that has not already been imported. Existing data is kept.
         Generates the clearsky model output from start (inclusive) to end (exclusive). If start and/or end
-        are not provided, a window of 6 weeks is provided, centered on start of the current date if neither is given. """
+        are not provided, a window of 6 weeks is provided, centered on start of the current date if neither is given.
+        workers overrides the number of worker processes given when creating the dataset. """
         # Set default start and end if none given
         default_window = pd.to_timedelta('6w')
         if start is None and end is None:
@@ -78,21 +104,51 @@ class ClearskyModel(DataSet):
             start = pd.to_datetime(start)
             end = start + default_window
 
-        self.meta.create_all(self.db_engine)
+        self._create_tables()
         intervals_to_add = self._new_intervals_to_add([(start, end)])
-        for new_start, new_end in intervals_to_add:
-            index = pd.date_range(start=new_start, end=new_end, freq=self.resample_interval, inclusive='left')
-            df_in = pd.DataFrame(index=index)
-            df_in.index.name = 'dt'
-            # Clearsky model is calculated without temperature being provided
-            df = clearsky(self.location, df_in)
+        chunks = [chunk for new_start, new_end in intervals_to_add for chunk in self._chunks(new_start, new_end)]
+        for df in self._calculate(chunks, self.workers if workers is None else workers):
             self._import_df_to_db(df)
-        if intervals_to_add:
-            self._rebuild_processed_data()
+        self._sync_storage()
+        if self._dirty_intervals:
+            self._update_processed_data()
+
+    @property
+    def _interval_tolerance(self):
+        # The output is calculated on a regular grid, so intervals one step apart are contiguous
+        return pd.to_timedelta(self.resample_interval)
+
+    def _chunks(self, start, end):
+        """ Split start (inclusive) to end (exclusive) into periods of up to chunk_size. The
+        periods start on the resample_interval grid. """
+        chunk_size = pd.to_timedelta(self.chunk_size)
+        chunks = []
+        start = pd.Timestamp(start).ceil(self.resample_interval)
+        while start < end:
+            chunks.append((start, min(start + chunk_size, end)))
+            start = start + chunk_size
+        return chunks
+
+    def _calculate(self, chunks, workers=1):
+        """ Generator that calculates the modeled output for each (start, end) period of chunks and
+        yields the DataFrames in the same order. If workers is not 1, the periods are calculated in a
+        pool of worker processes (one per CPU if workers is 0), with only a few more periods in
+        progress than workers at a time. """
+        if len(chunks) < 2:
+            workers = 1
+        elif workers != 1:
+            workers = min(workers or os.cpu_count(), len(chunks))
+        return _imap(self, '_calculate_chunk', chunks, workers)
+
+    def _calculate_chunk(self, start, end):
+        index = pd.date_range(start=start, end=end, freq=self.resample_interval, inclusive='left', name='dt')
+        # Clearsky model is calculated without temperature being provided
+        return clearsky(self.location, pd.DataFrame(index=index))
 
-    def get_data_by_date(self, site_id=0, start=None, end=None):
+    def get_data_by_date(self, site_id=default_site_id, start=None, end=None):
         """ Returns data beginning on start and going to end (not inclusive).
         start and end may be dates or datetimes. """
+        self._check_site_id(site_id)
         # If a closed range is given, make sure it is loaded into the dataset if it isn't already
         if start is not None and end is not None:
             self.import_new_data(start, end)
@@ -101,4 +157,5 @@ class ClearskyModel(DataSet):
         if end is not None:
             end = pd.to_datetime(end) - pd.to_timedelta(self.resample_interval)/10  # Open interval on end
 
-        return self._load_dt_range(self.data_table, start, end)
+        return self._cached_query(self.data_table, (site_id, start, end),
+                                  lambda: self._load_dt_range(self.data_table, site_id, start, end))
@@ -2,16 +2,24 @@ from .. import logging_config  # isort:skip
 
 import inspect
 import logging
+import os
 import shutil
+from concurrent.futures import ProcessPoolExecutor
 
 import click
+import pandas as pd
 import sqlalchemy
 
 import forecast_dataset_tools.config as fdt_config
+from forecast_dataset_tools import profiling
 
 from .abb_inverter_logger import ABBInverterDataSet
+from .base import DataSet, register_sites
+from .bulk_writer import apply_sqlite_performance_profile
 from .meteogram_forecast import MeteogramForecast
 from .solcast_weather import SolCastWeather
+from .storage import ParquetStorage
+from .watch import Watcher
 
 _log = logging.getLogger(__name__)
 
@@ -32,35 +40,256 @@ context_settings = {"max_content_width": shutil.get_terminal_size().columns - 0}
     "The database will also be reset if reset_db is set to true in the config file. "
     "Otherwise, only new data is imported.",
 )
-def archive(config_filename, log_level, reset_db):
+@click.option(
+    "-w",
+    "--workers",
+    type=click.IntRange(min=0),
+    default=1,
+    show_default=True,
+    help="Number of worker processes used to parse data files. Use 0 for one worker per CPU.",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=0),
+    default=1,
+    show_default=True,
+    help="Number of config groups (datasets) processed at once, each in its own process "
+    "with its own --workers. Writes to the database are serialized by its lock. Use 0 for "
+    "one per CPU.",
+)
+@click.option(
+    "--watch",
+    is_flag=True,
+    help="After importing, keep running and import new and changed data files as they "
+    "appear, until interrupted with Ctrl-C or SIGTERM.",
+)
+@click.option(
+    "--interval",
+    type=click.FloatRange(min=0, min_open=True),
+    default=2.0,
+    show_default=True,
+    help="Seconds between checks of the data directories with --watch.",
+)
+@click.option(
+    "--debounce",
+    type=click.FloatRange(min=0),
+    default=2.0,
+    show_default=True,
+    help="With --watch, seconds that a file must be unmodified before it is imported, "
+    "and that no files must be imported before the processed data is rebuilt.",
+)
+@profiling.profiling_options
+def archive(
+    config_filename,
+    log_level,
+    reset_db,
+    workers,
+    jobs,
+    watch,
+    interval,
+    debounce,
+    profile,
+    profile_stats,
+):
     """Import data files into sqlite data archive using parameters from a
-    TOML-format configuration file."""
+    TOML-format configuration file. If a group fails, the others are still imported
+    and the command exits with an error."""
     logging.getLogger("forecast_dataset_tools").setLevel(log_level)
+    if watch and jobs != 1:
+        raise click.UsageError("--jobs can't be used with --watch")
 
     cfg = fdt_config.find_and_load(config_filename)
+    reset = reset_db or cfg.get("reset_db", False)
+    # Import results for any dataset classes mapped to groups in the config file
+    cfg_keys = [cfg_key for cfg_key in cfg if cfg_key in cfg_cls_map]
+    jobs = min(jobs or os.cpu_count(), len(cfg_keys))
 
-    dataset_db_file = cfg["dataset_db_file"]
-    engine = sqlalchemy.create_engine(
-        f"sqlite+pysqlite:///{dataset_db_file}", echo=False
-    )
+    with profiling.profile(profile, profile_stats):
+        engine = open_database(cfg)
+        register_locations(engine, cfg)
+        if watch:
+            datasets = {}
+            for cfg_key in cfg_keys:
+                try:
+                    ds = make_dataset(engine, cfg, cfg_key)
+                    if reset:
+                        ds._drop_tables()
+                    ds._create_tables()
+                except Exception:
+                    _log.error(f"Failed to set up {cfg_key}", exc_info=True)
+                else:
+                    datasets[cfg_key] = ds
+            # The files that are not imported yet are imported by the first poll
+            Watcher(datasets, interval, debounce, workers).run()
+            failed = [cfg_key for cfg_key in cfg_keys if cfg_key not in datasets]
+        elif jobs <= 1:
+            failed = [
+                cfg_key
+                for cfg_key in cfg_keys
+                if not archive_group(engine, cfg, cfg_key, reset, workers)
+            ]
+        else:
+            # Each worker process opens its own engine
+            engine.dispose()
+            failed = []
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = {
+                    cfg_key: executor.submit(
+                        _archive_group_in_worker,
+                        cfg,
+                        cfg_key,
+                        reset,
+                        workers,
+                        log_level,
+                        profiling.enabled(),
+                    )
+                    for cfg_key in cfg_keys
+                }
+                for cfg_key, future in futures.items():
+                    try:
+                        ok, spans = future.result()
+                    except Exception:
+                        # The worker process died or the result could not be returned
+                        _log.error(f"Failed to process {cfg_key}", exc_info=True)
+                        ok, spans = False, []
+                    profiling.add_spans(spans)
+                    if not ok:
+                        failed.append(cfg_key)
 
-    # Import results for any dataset classes mapped to groups in the config file
-    for cfg_key in cfg:
-        if cfg_key not in cfg_cls_map:
-            continue
+    if failed:
+        raise click.ClickException(f"Failed to process {', '.join(failed)}")
 
-        _log.info(f"Processing {cfg_key}")
 
-        cls = cfg_cls_map[cfg_key]
-        ds_cfg = cfg[cfg_key]
-        ds_init_args = inspect.signature(cls.__init__).parameters
-        ds_args = {p: ds_cfg[p] for p in ds_init_args if p in ds_cfg}
-        ds = cls(db_engine=engine, **ds_args)
+def make_dataset(engine, cfg, cfg_key):
+    """Return the dataset of the config group cfg_key, with the database of engine."""
+    cls = cfg_cls_map[cfg_key]
+    ds_cfg = cfg[cfg_key]
+    ds_init_args = inspect.signature(cls.__init__).parameters
+    ds_args = {p: ds_cfg[p] for p in ds_init_args if p in ds_cfg}
+    return cls(db_engine=engine, **ds_args)
 
-        if reset_db or cfg.get("reset_db", False):
-            ds.import_all_data()
-        else:
-            ds.import_new_data()
+
+def register_locations(engine, cfg):
+    """Give the locations of the locations file, if one is configured, site ids in the
+    order of the file. The first location is then the site of the datasets whose files
+    do not name a location. Locations that already have site ids keep them."""
+    if "locations_file" in cfg:
+        register_sites(engine, pd.read_csv(cfg["locations_file"])["name"])
+
+
+def archive_group(engine, cfg, cfg_key, reset, workers=1):
+    """Import the data files of the dataset of the config group cfg_key into the
+    database of engine, after dropping its existing data if reset is True. Returns True
+    if it succeeded. Errors are logged rather than raised, so that a failure does not
+    stop the other groups from being imported."""
+    _log.info(f"Processing {cfg_key}")
+
+    try:
+        ds = make_dataset(engine, cfg, cfg_key)
+        with profiling.span("archive.dataset", dataset=ds.db_table_prefix):
+            if reset:
+                ds.import_all_data(workers=workers)
+            else:
+                ds.import_new_data(workers=workers)
+    except Exception:
+        _log.error(f"Failed to process {cfg_key}", exc_info=True)
+        return False
+    return True
+
+
+def _archive_group_in_worker(cfg, cfg_key, reset, workers, log_level, profile):
+    """Run archive_group in a worker process, with its own database engine. Spans are
+    recorded if profile is True. Returns (whether it succeeded, the records of the
+    spans)."""
+    logging.getLogger("forecast_dataset_tools").setLevel(log_level)
+    profiler = profiling.enable() if profile else None
+    engine = open_database(cfg)
+    try:
+        ok = archive_group(engine, cfg, cfg_key, reset, workers)
+    finally:
+        engine.dispose()
+        profiling.disable()
+    return ok, profiler.spans if profiler is not None else []
+
+
+@click.command(context_settings=context_settings)
+@fdt_config.config_file_option
+@logging_config.log_level_option
+@click.option(
+    "--start",
+    type=click.DateTime(),
+    default=None,
+    help="Start of the period to compute. Defaults to the start of the current year.",
+)
+@click.option(
+    "--days",
+    type=click.IntRange(min=1),
+    default=365,
+    show_default=True,
+    help="Number of days to compute from the start.",
+)
+@click.option(
+    "--location",
+    "location_names",
+    multiple=True,
+    help="Name of a location in the locations file to compute. May be given more than once. "
+    "Defaults to all locations.",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="Number of worker processes used for the calculation. Use 0 for one worker per CPU.",
+)
+def precompute_clearsky(config_filename, log_level, start, days, location_names, workers):
+    """Calculate the clearsky model output for the locations in the locations file
+    ahead of time and store it in the sqlite data archive. Periods that were already
+    calculated for a location are skipped."""
+    # Requires the ems package, so only imported when needed
+    from .clearsky_model import ClearskyModel
+
+    logging.getLogger("forecast_dataset_tools").setLevel(log_level)
+
+    cfg = fdt_config.find_and_load(config_filename)
+    engine = open_database(cfg)
+    locations = pd.read_csv(cfg["locations_file"])
+    if location_names:
+        unknown = set(location_names) - set(locations["name"])
+        if unknown:
+            raise click.BadParameter(f"Unknown locations: {', '.join(sorted(unknown))}")
+        locations = locations[locations["name"].isin(location_names)]
+
+    if start is None:
+        start = pd.Timestamp.today().to_period("Y").start_time
+    start = pd.Timestamp(start)
+    end = start + pd.to_timedelta(days, "D")
+
+    ds_cfg = cfg.get(ClearskyModel._cfg_key, {})
+    ds_init_args = inspect.signature(ClearskyModel.__init__).parameters
+    ds_args = {p: ds_cfg[p] for p in ds_init_args if p in ds_cfg and p != "location"}
+    for location in locations.to_dict("records"):
+        ds = ClearskyModel(location, db_engine=engine, **ds_args)
+        _log.info(
+            f"Calculating clearsky model output for {location['name']} "
+            f"({ds.location_key}) from {start} to {end}"
+        )
+        ds.import_new_data(start, end, workers=workers)
+
+
+def open_database(cfg):
+    """Return the engine of the sqlite data archive, and set the storage backend of the
+    datasets, given the loaded configuration."""
+    dataset_db_file = cfg["dataset_db_file"]
+    engine = sqlalchemy.create_engine(
+        f"sqlite+pysqlite:///{dataset_db_file}", echo=False
+    )
+    apply_sqlite_performance_profile(engine)
+    if "parquet_dir" in cfg:
+        DataSet.storage = ParquetStorage(cfg["parquet_dir"])
+    return engine
 
 
 if __name__ == "__main__":
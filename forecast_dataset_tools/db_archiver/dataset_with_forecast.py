@@ -4,12 +4,17 @@ import sqlalchemy
 import pandas as pd
 import numpy as np
 
-from .base import DataSet
+from .. import profiling
+from .base import DataSet, _data_columns, default_site_id, site_id_column
+from .bulk_writer import bulk_upsert
+from . import fx_tensor
 
 class DataSetWithForecast(DataSet):
     """ This is a generic base class for datasets that include forecast values in addition to
         actual values. It is assumed that the forecast is generated for some future time period(s)
-        and that de-duplication of the forecast data is not needed as it is for actuals.
+        and that de-duplication of the forecast data is not needed as it is for actuals. Forecast
+        values are identified by (site_id, current_dt, dt, type); a forecast that is imported again
+        replaces the existing values.
     """
     def __init__(self, db_engine=None, db_table_prefix='generic_dataset',
                  resample_interval='5min', average_interval='1h'):
@@ -18,12 +23,14 @@ class DataSetWithForecast(DataSet):
     def _define_table_names(self):
         super()._define_table_names()
         self.db_table_data_fx = self.db_table_prefix + '_data_fx'
+        self.db_table_data_fx_latest = self.db_table_prefix + '_data_fx_latest'
 
     def _define_tables(self):
         """ Create table definitions in object metadata member.
         Does not connect to database or create tables in the database itself."""
         super()._define_tables()
         self._define_table_data_fx()
+        self._define_table_data_fx_latest()
 
     def _define_col_names(self):
         # Almost certainly need to override this method in child classes.
@@ -41,8 +48,10 @@ class DataSetWithForecast(DataSet):
                 self.db_table_data_raw,
                 self.meta,
                 sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
-                sqlalchemy.Column('dt', sqlalchemy.DateTime, index=True),
-                *[sqlalchemy.Column(*c) for c in self._actual_columns]
+                site_id_column(),
+                sqlalchemy.Column('dt', sqlalchemy.DateTime),
+                *[sqlalchemy.Column(*c) for c in self._actual_columns],
+                sqlalchemy.Index(f'ix_{self.db_table_data_raw}_site_id_dt', 'site_id', 'dt', unique=True)
             )
         else:
             self.data_table_raw = None
@@ -54,8 +63,10 @@ class DataSetWithForecast(DataSet):
                 self.db_table_data,
                 self.meta,
                 sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
-                sqlalchemy.Column('dt', sqlalchemy.DateTime, index=True),
-                *[sqlalchemy.Column(*c) for c in self._actual_columns]
+                site_id_column(),
+                sqlalchemy.Column('dt', sqlalchemy.DateTime),
+                *[sqlalchemy.Column(*c) for c in self._actual_columns],
+                sqlalchemy.Index(f'ix_{self.db_table_data}_site_id_dt', 'site_id', 'dt')
             )
         else:
             self.data_table = None
@@ -67,24 +78,96 @@ class DataSetWithForecast(DataSet):
                 self.db_table_data_fx,
                 self.meta,
                 sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
-                sqlalchemy.Column('current_dt', sqlalchemy.DateTime, index=True),
-                sqlalchemy.Column('dt', sqlalchemy.DateTime, index=True),
+                site_id_column(),
+                sqlalchemy.Column('current_dt', sqlalchemy.DateTime),
+                sqlalchemy.Column('dt', sqlalchemy.DateTime),
                 sqlalchemy.Column('type', sqlalchemy.Text),
-                *[sqlalchemy.Column(*c) for c in self._forecast_columns]
+                *[sqlalchemy.Column(*c) for c in self._forecast_columns],
+                # Natural key of a forecast value. Used to deduplicate forecasts as they are inserted,
+                # and to find the forecasts issued in a range of current_dt.
+                sqlalchemy.Index(f'ix_{self.db_table_data_fx}_site_id_current_dt_dt_type',
+                                 'site_id', 'current_dt', 'dt', 'type', unique=True),
+                # Used to find the latest forecast made before a given time for a range of dt
+                sqlalchemy.Index(f'ix_{self.db_table_data_fx}_site_id_dt_current_dt', 'site_id', 'dt', 'current_dt')
             )
         else:
             self.data_table_fx = None
         return self.data_table_fx
 
+    def _define_table_data_fx_latest(self):
+        """ Table with the rows of the forecast table that have the latest current_dt for their
+        dt. It is kept up to date as forecasts are imported. """
+        if self._forecast_columns:
+            self.data_table_fx_latest = sqlalchemy.Table(
+                self.db_table_data_fx_latest,
+                self.meta,
+                sqlalchemy.Column('id', sqlalchemy.Integer, primary_key=True),
+                site_id_column(),
+                sqlalchemy.Column('current_dt', sqlalchemy.DateTime),
+                sqlalchemy.Column('dt', sqlalchemy.DateTime),
+                sqlalchemy.Column('type', sqlalchemy.Text),
+                *[sqlalchemy.Column(*c) for c in self._forecast_columns],
+                sqlalchemy.Index(f'ix_{self.db_table_data_fx_latest}_site_id_dt_type',
+                                 'site_id', 'dt', 'type', unique=True)
+            )
+        else:
+            self.data_table_fx_latest = None
+        return self.data_table_fx_latest
+
+    def _create_tables(self):
+        super()._create_tables()
+        # Fill the latest forecast table if it was just added to an existing database
+        if self.data_table_fx_latest is not None:
+            with self.db_engine.begin() as conn:
+                if (conn.execute(sqlalchemy.select(self.data_table_fx_latest.c.id).limit(1)).first() is None
+                        and conn.execute(sqlalchemy.select(self.data_table_fx.c.id).limit(1)).first() is not None):
+                    self._refresh_latest_fx(conn)
+                    self.storage.sync(self, self.data_table_fx_latest)
+
+    @property
+    def _storage_tables(self):
+        return super()._storage_tables + [t for t in (self.data_table_fx, self.data_table_fx_latest)
+                                          if t is not None]
+
+    def _refresh_latest_fx(self, conn, site_id=None, start=None, end=None):
+        """ Replace the rows of the latest forecast table for site_id and dt from start to end
+        (inclusive) with the forecasts that have the latest current_dt for each dt. All sites are
+        refreshed if site_id is None. """
+        table = self.data_table_fx
+        latest = self.data_table_fx_latest
+        cond = []
+        latest_cond = []
+        if site_id is not None:
+            cond.append(table.c.site_id == site_id)
+            latest_cond.append(latest.c.site_id == site_id)
+        if start is not None:
+            cond.append(table.c.dt >= start)
+            latest_cond.append(latest.c.dt >= start)
+        if end is not None:
+            cond.append(table.c.dt <= end)
+            latest_cond.append(latest.c.dt <= end)
+
+        idxmax = sqlalchemy.select(table.c.site_id, table.c.dt,
+                                   sqlalchemy.sql.func.max(table.c.current_dt).label('max_dt'))\
+            .where(*cond).group_by(table.c.site_id, table.c.dt).subquery()
+        cols = [c.name for c in latest.columns if c.name != 'id']
+        stmt = sqlalchemy.select(*[table.c[c] for c in cols])\
+            .select_from(table.join(idxmax,
+                                    sqlalchemy.and_(idxmax.c.max_dt == table.c.current_dt,
+                                                    idxmax.c.site_id == table.c.site_id,
+                                                    idxmax.c.dt == table.c.dt)))
+        conn.execute(sqlalchemy.delete(latest).where(*latest_cond))
+        conn.execute(sqlalchemy.insert(latest).from_select(cols, stmt))
+
     @staticmethod
     def _split_actual_fx(df: pd.DataFrame):
         """ Given an input DataFrame with combined actual and forecast data, splits
             the data to return two DataFrames: one for actual, and one for forecast
             data. The input DataFrame is assumed to have a column named 'type' which
             takes the value 0 or '0' for actual values and 'daily', 'hourly', etc. for
-            forecasts. The columns 'current_dt' and 'type' are dropped from the DataFrame
-            of actual values. Any columns with all NA values are also dropped from both
-            DataFrames.
+            forecasts. Any site_id column is kept in both DataFrames. The columns
+            'current_dt' and 'type' are dropped from the DataFrame of actual values.
+            Any columns with all NA values are also dropped from both DataFrames.
         """
         idx = (df['type'] == 0) | (df['type'] == '0')
 
@@ -99,56 +182,179 @@ class DataSetWithForecast(DataSet):
 
         return df_actual, df_fx
 
-    def _import_df_to_db(self, df, file_name=None, callback=None):
+    def _split_sites_actual_fx(self, df):
+        """ Assign the site ids of the rows of df, read from a data file, and split it into the
+        DataFrames of actual and forecast data with _split_actual_fx. """
+        df = self._assign_site_ids(df)
+        if 'site_id' not in df.columns:
+            df = df.assign(site_id=default_site_id)
+        return self._split_actual_fx(df)
+
+    def _site_ranges(self, df):
+        df_actual, _ = self._split_sites_actual_fx(df)
+        return super()._site_ranges(df_actual)
+
+    def _import_df_to_db(self, df, file=None, callback=None):
         """ Add data from DataFrame into database. """
-        df_actual, df_fx = self._split_actual_fx(df)
+        df_actual, df_fx = self._split_sites_actual_fx(df)
 
         # Create callback function to add forecast to db
         def f(conn):
             # Add forecasts
-            df_fx.to_sql(self.db_table_data_fx, conn, index=False, if_exists='append')
+            with profiling.span('archive.write_fx', dataset=self.db_table_prefix, rows=len(df_fx)):
+                bulk_upsert(conn, self.data_table_fx, df_fx, index=False, batch_size=self.insert_batch_size)
+            for site_id, df_site in df_fx.groupby('site_id'):
+                start, end = df_site['dt'].min(), df_site['dt'].max()
+                with profiling.span('archive.refresh_latest_fx', dataset=self.db_table_prefix,
+                                    site_id=int(site_id)):
+                    self._refresh_latest_fx(conn, site_id, start, end)
+                self._mark_unsynced(self.data_table_fx, site_id, start, end)
+                self._mark_unsynced(self.data_table_fx_latest, site_id, start, end)
             if callback is not None:
                 callback(conn)
 
         # Parent function will add actuals and track filenames and intervals
         # Callback will be called to add the forecasts.
-        super()._import_df_to_db(df_actual, file_name, f)
+        super()._import_df_to_db(df_actual, file, f)
 
-    def _remove_duplicate_rows_all_tables(self):
-        for t in [self.data_table_raw, self.data_table_fx]:
-            if t is not None:
-                self._remove_duplicate_rows(t)
-
-    def get_fx_by_date(self, site_id=0, start=None, end=None, past=True):
-        """ Returns data beginning on start and going to end (not inclusive).
+    def get_fx_by_date(self, site_id=default_site_id, start=None, end=None, past=True):
+        """ Returns forecasts of site_id beginning on start and going to end (not inclusive).
         start and end may be dates or datetimes.
         If past is True, then weather forecasts will not be generated after the beginning of the forecast period.
         """
+        self._check_site_id(site_id)
         if start is not None:
             start = pd.to_datetime(start)
         if end is not None:
             end = pd.to_datetime(end)
+        return self._cached_query(self.data_table_fx, (site_id, start, end, past),
+                                  lambda: self._load_fx(site_id, start, end, past))
 
-        table = self.data_table_fx
-        cond = []
-        if start is not None:
-            cond.append(table.c.dt >= start)
-        if start is not None:
-            cond.append(table.c.dt < end)
+    def _load_fx(self, site_id, start, end, past):
+        """ Return DataFrame with the most recent forecast of site_id for each dt from start (inclusive)
+        to end (exclusive). If past is True, only forecasts made before start are used. Otherwise, the
+        forecasts are read from the latest forecast table. Data is read through the storage backend. """
         if past and start is not None:
-            cond.append(table.c.current_dt < start)
-
-        # Pandas "query" code for getting most recent forecast:
-        # fc_irr = fc_irr.loc[fc_irr.groupby(['dt'])['current_dt'].idxmax()]
-        idxmax = sqlalchemy.select(table.c.dt, sqlalchemy.sql.func.max(table.c.current_dt).label('max_dt'))\
-            .where(*cond).group_by(table.c.dt).cte()
-        stmt = sqlalchemy.select(table).\
-            select_from(table.join(idxmax,
-                                   sqlalchemy.and_(idxmax.c.max_dt == table.c.current_dt,
-                                                   idxmax.c.dt == table.c.dt)))\
-            .order_by(table.c.dt)
-        df = pd.read_sql(stmt, self.db_engine, index_col='dt')
-        df = df.drop(columns='id')
+            return self.storage.read_fx_before(self, self.data_table_fx, site_id, start, end)
+        return self.storage.read_range(self, self.data_table_fx_latest, site_id, start, end, inclusive='left')
+
+    def _read_sql_fx_before(self, site_id, start, end):
+        """ Query the database for the forecasts of site_id with the latest current_dt before start
+        for each dt from start to end. """
+        df = pd.read_sql(self._latest_fx_before_start_stmt(site_id, start, end), self.db_engine, index_col='dt')
         # Convert columns from sqlalchemy quoted_name to str. Otherwise sklearn issues a warning.
         df.columns = [str(c) for c in df.columns]
         return df
+
+    def _latest_fx_before_start_stmt(self, site_id, start, end):
+        """ Query for the forecasts of site_id with the latest current_dt before start for each dt in
+        the range. Uses the (site_id, dt, current_dt) index to rank the forecasts for each dt. """
+        table = self.data_table_fx
+        cond = [table.c.site_id == site_id, table.c.dt >= start, table.c.current_dt < start]
+        if end is not None:
+            cond.append(table.c.dt < end)
+        rank = sqlalchemy.sql.func.rank().over(partition_by=table.c.dt,
+                                               order_by=table.c.current_dt.desc()).label('fx_rank')
+        ranked = sqlalchemy.select(table, rank).where(*cond).subquery()
+        return sqlalchemy.select(*[ranked.c[c.name] for c in _data_columns(table)])\
+            .where(ranked.c.fx_rank == 1).order_by(ranked.c.dt)
+
+    def get_fx_as_of(self, origins, horizon, site_id=default_site_id):
+        """ Returns the forecasts of site_id that were available at each of the forecast origins for the
+        period from the origin to origin + horizon (not inclusive). For each origin and dt, this is
+        the same data as get_fx_by_date(site_id, origin, origin + horizon, past=True), but the
+        forecast table is read only once for all origins.
+        Returns a DataFrame with a (origin, dt) MultiIndex, sorted by origin and dt.
+        """
+        self._check_site_id(site_id)
+        origins = np.unique(pd.to_datetime(origins).to_numpy(dtype='datetime64[ns]'))
+        horizon = pd.to_timedelta(horizon).to_timedelta64()
+        if len(origins) == 0:
+            return self._empty_fx_as_of()
+
+        fx = self.storage.read_range(self, self.data_table_fx, site_id, pd.Timestamp(origins[0]),
+                                     pd.Timestamp(origins[-1] + horizon), inclusive='left').reset_index()
+        fx = fx.loc[fx['current_dt'] < pd.Timestamp(origins[-1])]
+        if fx.empty:
+            return self._empty_fx_as_of()
+        fx['dt'] = pd.to_datetime(fx['dt']).astype('datetime64[ns]')
+        fx['current_dt'] = pd.to_datetime(fx['current_dt']).astype('datetime64[ns]')
+
+        # Pair each dt with every origin for which it is within the horizon
+        dts = np.unique(fx['dt'].to_numpy())
+        lo = np.searchsorted(origins, dts - horizon, side='right')
+        hi = np.searchsorted(origins, dts, side='right')
+        counts = hi - lo
+        offsets = np.repeat(np.cumsum(counts) - counts, counts)
+        origin_idx = np.arange(counts.sum()) - offsets + np.repeat(lo, counts)
+        pairs = pd.DataFrame({'origin': origins[origin_idx], 'dt': np.repeat(dts, counts)})
+
+        # For each pair, find the latest forecast issued before the origin
+        vintages = fx[['dt', 'current_dt']].drop_duplicates().sort_values('current_dt')
+        pairs = pd.merge_asof(pairs.sort_values('origin'), vintages, left_on='origin', right_on='current_dt',
+                              by='dt', direction='backward', allow_exact_matches=False)
+        pairs = pairs.dropna(subset=['current_dt'])
+
+        # Join back to the forecasts. There may be more than one forecast type for a vintage.
+        df = pairs.merge(fx, on=['dt', 'current_dt'])
+        df = df.set_index(['origin', 'dt']).sort_index()
+        return df
+
+    def _empty_fx_as_of(self):
+        cols = [c.name for c in _data_columns(self.data_table_fx) if c.name != 'dt']
+        index = pd.MultiIndex.from_arrays([pd.DatetimeIndex([]), pd.DatetimeIndex([])], names=['origin', 'dt'])
+        return pd.DataFrame(columns=cols, index=index)
+
+    def export_fx_tensor(self, path, max_lead_time, lead_time_step=None, start=None, end=None,
+                         columns=None, fx_type=None, dtype='float32', chunk_issue_times=256,
+                         site_id=default_site_id):
+        """ Write the forecasts of site_id as a dense (issue_time x lead_time x variable) array to the .npy file
+        at path, with the axis coordinates in a json sidecar file (see fx_tensor.load_fx_tensor).
+        Issue times are the distinct current_dt values from start (inclusive) to end (exclusive).
+        Lead times run from 0 up to max_lead_time (inclusive) in steps of lead_time_step, which
+        defaults to resample_interval. Forecasts whose lead time is not on that grid are skipped.
+        Variables are the given columns, or all forecast columns. If fx_type is given, only
+        forecasts of that type are exported. Cells without a forecast are NaN.
+        The array is written through a memory map, chunk_issue_times issue times at a time, so
+        the whole array is never held in memory. Returns the memory-mapped array.
+        """
+        table = self.data_table_fx
+        step = pd.to_timedelta(lead_time_step or self.resample_interval)
+        lead_times = pd.timedelta_range(start='0s', end=pd.to_timedelta(max_lead_time), freq=step)
+        if columns is None:
+            columns = [c for c, _ in self._forecast_columns]
+
+        cond = [table.c.site_id == site_id]
+        if start is not None:
+            cond.append(table.c.current_dt >= pd.to_datetime(start))
+        if end is not None:
+            cond.append(table.c.current_dt < pd.to_datetime(end))
+        if fx_type is not None:
+            cond.append(table.c.type == fx_type)
+        with self.db_engine.connect() as conn:
+            issue_times = pd.DatetimeIndex(list(conn.execute(
+                sqlalchemy.select(table.c.current_dt).where(*cond).distinct().order_by(table.c.current_dt)
+            ).scalars()))
+
+        array = np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                          shape=(len(issue_times), len(lead_times), len(columns)))
+        array[:] = np.nan
+        issue_times_ns = issue_times.to_numpy(dtype='datetime64[ns]')
+        for i in range(0, len(issue_times), chunk_issue_times):
+            chunk = issue_times[i:i + chunk_issue_times]
+            stmt = sqlalchemy.select(table.c.current_dt, table.c.dt, *[table.c[c] for c in columns])\
+                .where(*cond, table.c.current_dt >= chunk[0], table.c.current_dt <= chunk[-1])
+            df = pd.read_sql(stmt, self.db_engine)
+            if df.empty:
+                continue
+            current_dt = pd.to_datetime(df['current_dt']).to_numpy(dtype='datetime64[ns]')
+            lead = pd.to_datetime(df['dt']).to_numpy(dtype='datetime64[ns]') - current_dt
+            j, remainder = np.divmod(lead, step.to_timedelta64())
+            on_grid = (remainder == np.timedelta64(0)) & (j >= 0) & (j < len(lead_times))
+            i_issue = np.searchsorted(issue_times_ns, current_dt[on_grid])
+            array[i_issue, j[on_grid], :] = df.loc[on_grid, columns].to_numpy(dtype=dtype)
+        array.flush()
+
+        fx_tensor.write_coords(path, issue_times, lead_times, columns, dataset=self.db_table_prefix,
+                               site_id=site_id, fx_type=fx_type)
+        return array
@@ -0,0 +1,41 @@
+"""
+Dense (issue_time x lead_time x variable) arrays of forecasts, as written by
+DataSetWithForecast.export_fx_tensor. The array is stored as a .npy file so that it can be
+memory-mapped, and the axis coordinates are stored in a json sidecar file next to it.
+"""
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+dims = ['issue_time', 'lead_time', 'variable']
+
+
+def sidecar_path(path):
+    """ Path of the json file with the axis coordinates for the array at path. """
+    return Path(path).with_suffix('.json')
+
+
+def write_coords(path, issue_times, lead_times, variables, **attrs):
+    coords = {
+        'dims': dims,
+        'issue_time': [t.isoformat() for t in pd.DatetimeIndex(issue_times)],
+        'lead_time_seconds': [td.total_seconds() for td in pd.TimedeltaIndex(lead_times)],
+        'variable': list(variables),
+        **attrs
+    }
+    with open(sidecar_path(path), 'w') as f:
+        json.dump(coords, f, indent=1)
+
+
+def load_fx_tensor(path, mmap_mode='r'):
+    """ Open a forecast array written by export_fx_tensor without reading it into memory.
+    Returns the memory-mapped array and a dict with the axis coordinates: 'issue_time'
+    (DatetimeIndex), 'lead_time' (TimedeltaIndex), and 'variable' (list of column names). """
+    array = np.load(path, mmap_mode=mmap_mode)
+    with open(sidecar_path(path)) as f:
+        coords = json.load(f)
+    coords['issue_time'] = pd.DatetimeIndex(coords['issue_time'], name='issue_time')
+    coords['lead_time'] = pd.to_timedelta(coords.pop('lead_time_seconds'), unit='s').rename('lead_time')
+    return array, coords
@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+
+
+class IntervalSet:
+    """ Set of closed [start, end] datetime intervals, stored as sorted arrays of start and end
+    times of non-overlapping intervals. Intervals that overlap or are separated by no more than
+    tolerance are merged into one. Queries use binary search on the sorted arrays, and accept
+    many candidate intervals at once.
+    """
+    def __init__(self, intervals=(), tolerance=0):
+        self.tolerance = pd.to_timedelta(tolerance).to_timedelta64()
+        self.starts = np.array([], dtype='datetime64[ns]')
+        self.ends = np.array([], dtype='datetime64[ns]')
+        self.update(intervals)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return iter(self._to_list(self.starts, self.ends))
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({list(self)!r})'
+
+    def copy(self):
+        rtn = IntervalSet(tolerance=self.tolerance)
+        rtn.starts, rtn.ends = self.starts.copy(), self.ends.copy()
+        return rtn
+
+    def update(self, intervals):
+        """ Add (start, end) intervals to the set, merging them with existing intervals. """
+        starts, ends = self._to_arrays(intervals)
+        if len(starts) == 0:
+            return
+        starts = np.concatenate([self.starts, starts])
+        ends = np.concatenate([self.ends, ends])
+        order = np.argsort(starts, kind='stable')
+        starts, ends = starts[order], ends[order]
+
+        # An interval begins a new group unless it starts within tolerance of the end of an
+        # earlier interval.
+        running_end = np.maximum.accumulate(ends)
+        new_group = np.ones(len(starts), dtype=bool)
+        new_group[1:] = starts[1:] > running_end[:-1] + self.tolerance
+        group_first = np.flatnonzero(new_group)
+        group_last = np.append(group_first[1:] - 1, len(starts) - 1)
+        self.starts = starts[group_first]
+        self.ends = running_end[group_last]
+
+    def containing(self, start, end):
+        """ Return the interval of the set that contains [start, end], or None. """
+        i = np.searchsorted(self.ends, np.datetime64(pd.Timestamp(start), 'ns'), side='left')
+        if i < len(self) and self.starts[i] <= np.datetime64(pd.Timestamp(end), 'ns'):
+            return pd.Timestamp(self.starts[i]), pd.Timestamp(self.ends[i])
+        return None
+
+    def overlapping(self, start=None, end=None):
+        """ Return list of the intervals that overlap [start, end]. """
+        i0, i1 = self._overlap_slice(start, end)
+        return self._to_list(self.starts[i0:i1], self.ends[i0:i1])
+
+    def overlaps(self, intervals):
+        """ Return boolean array that is True for each of the given (start, end) intervals that
+        overlaps any interval in the set. """
+        starts, ends = self._to_arrays(intervals)
+        i0 = np.searchsorted(self.ends, starts, side='left')
+        i1 = np.searchsorted(self.starts, ends, side='right')
+        return i0 < i1
+
+    def difference(self, intervals, step):
+        """ Return sorted list of the parts of the given (start, end) intervals that are not in the
+        set. Parts are separated from intervals in the set by step on each side. """
+        starts, ends = self._to_arrays(intervals)
+        i0s = np.searchsorted(self.ends, starts, side='left')
+        i1s = np.searchsorted(self.starts, ends, side='right')
+        step = pd.to_timedelta(step).to_timedelta64()
+        rtn = []
+        for new_start, new_end, i0, i1 in zip(starts, ends, i0s, i1s):
+            for existing_start, existing_end in zip(self.starts[i0:i1], self.ends[i0:i1]):
+                if new_start < existing_start:
+                    rtn.append((new_start, existing_start - step))
+                new_start = existing_end + step
+            rtn.append((new_start, new_end))
+        return sorted((pd.Timestamp(s), pd.Timestamp(e)) for s, e in rtn if s <= e)
+
+    def gaps(self, min_gap=0, start=None, end=None):
+        """ Return list of (end, start) pairs of consecutive intervals that are separated by more
+        than min_gap. If start and end are given, only gaps that overlap [start, end] are returned. """
+        gap_starts, gap_ends = self.ends[:-1], self.starts[1:]
+        idx = (gap_ends - gap_starts) > pd.to_timedelta(min_gap).to_timedelta64()
+        if start is not None:
+            idx &= gap_ends >= np.datetime64(pd.Timestamp(start), 'ns')
+        if end is not None:
+            idx &= gap_starts <= np.datetime64(pd.Timestamp(end), 'ns')
+        return self._to_list(gap_starts[idx], gap_ends[idx])
+
+    def _overlap_slice(self, start, end):
+        i0 = 0 if start is None else np.searchsorted(
+            self.ends, np.datetime64(pd.Timestamp(start), 'ns'), side='left')
+        i1 = len(self) if end is None else np.searchsorted(
+            self.starts, np.datetime64(pd.Timestamp(end), 'ns'), side='right')
+        return i0, i1
+
+    @staticmethod
+    def _to_arrays(intervals):
+        intervals = list(intervals)
+        if not intervals:
+            return np.array([], dtype='datetime64[ns]'), np.array([], dtype='datetime64[ns]')
+        starts, ends = zip(*intervals)
+        return (pd.to_datetime(list(starts)).to_numpy(dtype='datetime64[ns]'),
+                pd.to_datetime(list(ends)).to_numpy(dtype='datetime64[ns]'))
+
+    @staticmethod
+    def _to_list(starts, ends):
+        return [(pd.Timestamp(s), pd.Timestamp(e)) for s, e in zip(starts, ends)]
@@ -0,0 +1,165 @@
+"""
+Incremental reading of large JSON files. iter_array yields the items of one array nested in a
+JSON document without loading the rest of the document into memory. The file is read in
+chunks, values outside the path to the array are skipped without being decoded, and each item
+of the array is decoded on its own.
+"""
+import json
+import re
+
+import numpy as np
+
+default_chunk_size = 2**20
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'\s*')
+_separator = re.compile(r'\s*([,\]])')
+_number_chars = re.compile(r'[0-9.eE+-]*')
+_string = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+# Everything up to a string that continues past the end of the buffer
+_complete_strings = re.compile(r'[^"]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"]*)*')
+# Everything up to the next bracket that is not inside a string. Brackets are the only tokens
+# that need to be found to skip over a nested value.
+_skip_run = re.compile(r'[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*')
+_opening = np.frombuffer(b'[{', dtype='uint8')
+_closing = np.frombuffer(b']}', dtype='uint8')
+
+
+class _Reader:
+    """ Buffer over a text file object with the few scanning operations needed by iter_array. """
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """ Read the next chunk, dropping the consumed part of the buffer. Returns False at the
+        end of the file. """
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ Skip whitespace and return the next character, or '' at the end of the file. """
+        while True:
+            self.pos = _whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        c = self.peek()
+        if c not in chars:
+            raise ValueError(f"Expected one of {chars!r} but found {c!r} in JSON file")
+        self.pos += 1
+        return c
+
+    def decode(self):
+        """ Decode the next value. """
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next chunk
+            if _number_chars.match(self.buf, end).end() == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def skip(self):
+        """ Skip over the next value. Objects and arrays are skipped without being decoded. """
+        if self.peek() not in '[{':
+            self.decode()
+            return
+        depth = 0
+        while True:
+            # While the value continues past the end of the buffer, skip the buffer in one step
+            end = _complete_strings.match(self.buf, self.pos).end()
+            outside_strings = _string.sub('', self.buf[self.pos:end])
+            brackets = np.frombuffer(outside_strings.encode(errors='replace'), dtype='uint8')
+            depths = depth + np.cumsum(np.isin(brackets, _opening).astype('int64')
+                                       - np.isin(brackets, _closing))
+            if len(depths) and depths.min() > 0:
+                depth = int(depths[-1])
+                self.pos = end
+                if not self._fill():
+                    raise ValueError("Unexpected end of JSON file")
+                continue
+
+            # The value ends in this buffer, so find where bracket by bracket
+            while True:
+                self.pos = _skip_run.match(self.buf, self.pos).end()
+                if self.pos == len(self.buf) or self.buf[self.pos] == '"':
+                    break
+                c = self.buf[self.pos]
+                self.pos += 1
+                if c in '[{':
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 0:
+                        return
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON file")
+
+    def find_key(self, key):
+        """ Move to the value of key in the object that starts at the current position, where
+        None matches the first key. Returns False if the value is not an object or does not
+        have the key. """
+        if self.peek() != '{':
+            return False
+        self.pos += 1
+        if self.peek() == '}':
+            return False
+        while True:
+            k = self.decode()
+            self.expect(':')
+            if key is None or k == key:
+                return True
+            self.skip()
+            if self.expect(',}') == '}':
+                return False
+
+    def items(self):
+        """ Yield the items of the array that starts at the current position. """
+        if self.peek() != '[':
+            return
+        self.pos += 1
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.decode()
+            m = _separator.match(self.buf, self.pos)
+            if m is None:
+                sep = self.expect(',]')
+            else:
+                self.pos = m.end()
+                sep = m.group(1)
+            if sep == ']':
+                return
+
+
+def iter_array(f, path, chunk_size=default_chunk_size):
+    """ Yield the items of the array at path in the JSON document read from the text file
+    object f. path is a sequence of object keys leading to the array, where None matches the
+    first key at that level. Only the first array matching path is read. Nothing is yielded if
+    there is no array at path. """
+    reader = _Reader(f, chunk_size)
+    for key in path:
+        if not reader.find_key(key):
+            return
+    yield from reader.items()
@@ -23,7 +23,6 @@ class MeteogramForecast(DataSetWithForecast):
     ):
         super().__init__(db_engine, db_table, resample_interval, average_interval)
         self.data_dir = data_dir
-        self.ids = [1]
 
     def _define_col_names(self):
         self._actual_columns = []
@@ -38,7 +37,6 @@ class MeteogramForecast(DataSetWithForecast):
     def _read_file(self, file_name):
         _log.debug(f"Reading data from {file_name}")
         df = pd.read_csv(file_name, parse_dates=["current_dt", "dt"])
-        df = df.drop(columns=["location"])
         df["type"] = "hourly"
         if df["current_dt"].dt.tz is not None:
             df["current_dt"] = df["current_dt"].dt.tz_convert(None)
@@ -46,6 +44,6 @@ class MeteogramForecast(DataSetWithForecast):
             df["dt"] = df["dt"].dt.tz_convert(None)
         return df
 
-    def _rebuild_processed_data(self):
+    def _rebuild_processed_data(self, intervals=None, workers=1):
         """Override raw data processing to skip this step."""
         return
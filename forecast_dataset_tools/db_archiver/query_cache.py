@@ -0,0 +1,83 @@
+"""
+In-memory cache of DataFrames returned by database queries of the datasets. Entries are
+evicted in least-recently-used order to keep the total size of the cached DataFrames within
+a byte budget. Each entry records the data version of its dataset when it was loaded, and
+an entry is only used while that version is current. Importing data into a dataset bumps
+its version, so cached results are never out of date with imports made in this process.
+Imports made by other processes are not detected.
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+_log = logging.getLogger(__name__)
+
+
+def _copy_on_write_enabled():
+    if int(pd.__version__.split('.')[0]) >= 3:
+        return True
+    try:
+        return pd.get_option('mode.copy_on_write') is True
+    except (KeyError, pd.errors.OptionError):
+        return False
+
+
+class QueryCache:
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (version, df, nbytes)
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        # With copy-on-write, a shallow copy is enough to keep callers from modifying cached data.
+        self._deep_copy = not _copy_on_write_enabled()
+
+    @property
+    def nbytes(self):
+        """ Total size of the cached DataFrames. """
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self._entries), 'nbytes': self._nbytes}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def get_or_load(self, key, version, load):
+        """ Return a copy of the DataFrame cached for key if it was loaded at version. Otherwise
+        call load() to get the DataFrame and cache it. """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1].copy(deep=self._deep_copy)
+            self.misses += 1
+
+        df = load()
+        self._put(key, version, df)
+        return df.copy(deep=self._deep_copy)
+
+    def _put(self, key, version, df):
+        nbytes = int(df.memory_usage(index=True, deep=True).sum())
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= old[2]
+            if nbytes > self.max_bytes:
+                _log.debug(f"Not caching query result of {nbytes} bytes for {key}")
+                return
+            self._entries[key] = (version, df, nbytes)
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes:
+                _, (_, _, evicted_nbytes) = self._entries.popitem(last=False)
+                self._nbytes -= evicted_nbytes
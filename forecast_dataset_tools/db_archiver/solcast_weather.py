@@ -4,6 +4,7 @@ import pandas as pd
 import sqlalchemy
 import logging
 
+from .base import default_site_id
 from .dataset_with_forecast import DataSetWithForecast
 
 _log = logging.getLogger(__name__)
@@ -16,7 +17,6 @@ class SolCastWeather(DataSetWithForecast):
                  resample_interval='30min', average_interval='1h'):
         super().__init__(db_engine, db_table, resample_interval, average_interval)
         self.data_dir = data_dir
-        self.ids = [1]
 
     def _define_col_names(self):
         self._actual_columns = [
@@ -51,10 +51,11 @@ class SolCastWeather(DataSetWithForecast):
     def _read_file(self, file_name):
         _log.debug(f"Reading data from {file_name}")
         df = pd.read_csv(file_name, parse_dates=['current_dt', 'dt'])
-        df = df.drop(columns=['location', 'lat', 'lon'])
+        # The location is kept to separate the data of each site
+        df = df.drop(columns=['lat', 'lon'])
         return df
 
-    def get_fx_by_date(self, site_id=0, start=None, end=None, past=True):
+    def get_fx_by_date(self, site_id=default_site_id, start=None, end=None, past=True):
         df = super().get_fx_by_date(site_id, start, end, past)
         # Resample to average_interval using mean
         # fx_type = df['type'].unique()[0]
@@ -64,3 +65,12 @@ class SolCastWeather(DataSetWithForecast):
         else:
             df2 = df
         return df2
+
+    def get_fx_as_of(self, origins, horizon, site_id=default_site_id):
+        df = super().get_fx_as_of(origins, horizon, site_id)
+        # Resample each origin's forecast to average_interval using mean, as in get_fx_by_date
+        df = df.drop(columns=['type'])
+        if len(df) > 0 and self.average_interval is not None:
+            df = df.groupby([pd.Grouper(level='origin'),
+                             pd.Grouper(level='dt', freq=self.average_interval)]).mean()
+        return df
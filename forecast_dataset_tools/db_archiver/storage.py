@@ -0,0 +1,202 @@
+"""
+Storage backends for the data tables of the datasets. The sqlite database is always used for
+the bookkeeping tables (files and intervals) and as the write path of imports. A storage backend
+serves range reads of the raw, processed, and forecast tables for one site at a time, and is
+given the sites and time ranges of those tables that were changed so that it can keep its own
+copy of the data up to date.
+
+SqlStorage reads directly from the database. ParquetStorage keeps a columnar copy of each data
+table as Parquet files partitioned by site and time period (one file per month by default), and
+reads them with pyarrow, which requires the optional pyarrow dependency.
+"""
+import logging
+import os
+import shutil
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+import sqlalchemy
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as pa_ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+_log = logging.getLogger(__name__)
+
+# Dtype of the datetime columns read from the database, which are converted from datetime
+# objects. Its resolution depends on the pandas version.
+_sql_datetime_dtype = pd.DatetimeIndex([datetime(2000, 1, 1)]).dtype
+
+
+class SqlStorage:
+    """ Reads data tables directly from the database of the dataset. """
+    def read_range(self, dataset, table, site_id, start=None, end=None, inclusive='both', columns=None):
+        """ Return DataFrame indexed by dt with the rows of table for site_id from start to end.
+        inclusive is 'both' or 'left' and gives which of start and end are included. All columns
+        other than id and site_id are returned unless columns is given. """
+        return dataset._read_sql_dt_range(table, site_id, start, end, inclusive, columns)
+
+    def read_fx_before(self, dataset, table, site_id, start, end=None):
+        """ Return DataFrame indexed by dt with the forecasts of site_id in the forecast table that
+        have the latest current_dt before start for each dt from start (inclusive) to end
+        (exclusive). """
+        return dataset._read_sql_fx_before(site_id, start, end)
+
+    def sync(self, dataset, table, intervals=None, site_id=None):
+        """ Update the stored copy of the rows of table for site_id in the given (start, end)
+        intervals, or all of the rows of the site if intervals is None. All sites are updated if
+        site_id is None, in which case intervals must be None. Nothing needs to be done since the
+        database is read directly. """
+        pass
+
+    def sync_if_missing(self, dataset, table):
+        """ Make the stored copy of table if there is none yet. """
+        pass
+
+    def drop(self, dataset, table):
+        """ Remove the stored copy of table. """
+        pass
+
+
+class ParquetStorage(SqlStorage):
+    """ Keeps a copy of the data tables as Parquet files in root, with one directory per table and
+    site and one file per partition_freq period of dt, e.g.
+    root/solcast_weather_data_fx/site_id=1/2023-01.parquet.
+    Range reads only open the files of the site for the periods in the range, and filters on dt and column
+    selection are pushed down to the Parquet reader. Columns are converted to pandas as whole
+    arrays.
+
+    The copy is updated from the database after data is imported or processed. If an import is
+    interrupted, the copy can be brought up to date with sync(dataset, table).
+    """
+    def __init__(self, root, partition_freq='M', compression='zstd'):
+        if pa is None:
+            raise ImportError("ParquetStorage requires the pyarrow package")
+        self.root = Path(root)
+        self.partition_freq = partition_freq
+        self.compression = compression
+
+    def read_range(self, dataset, table, site_id, start=None, end=None, inclusive='both', columns=None):
+        schema = self._schema(table)
+        if columns is None:
+            columns = schema.names
+        columns = ['dt'] + [c for c in columns if c != 'dt']
+
+        files = self._partition_files(table, site_id, start, end)
+        if not files:
+            df = schema.empty_table().select(columns).to_pandas()
+        else:
+            expr = None
+            if start is not None:
+                expr = pa_ds.field('dt') >= pd.Timestamp(start)
+            if end is not None:
+                end_expr = (pa_ds.field('dt') <= pd.Timestamp(end) if inclusive == 'both'
+                            else pa_ds.field('dt') < pd.Timestamp(end))
+                expr = end_expr if expr is None else expr & end_expr
+            dataset_files = pa_ds.dataset([str(f) for f in files], schema=schema, format='parquet')
+            df = dataset_files.to_table(columns=columns, filter=expr).to_pandas()
+        # Parquet timestamps are read with nanosecond resolution. Return the same dtypes as
+        # SqlStorage.
+        for c in df.columns:
+            if pd.api.types.is_datetime64_dtype(df[c]):
+                df[c] = df[c].astype(_sql_datetime_dtype)
+        df = df.set_index('dt').sort_index(kind='stable')
+        return df
+
+    def read_fx_before(self, dataset, table, site_id, start, end=None):
+        df = self.read_range(dataset, table, site_id, start, end, inclusive='left')
+        df = df.loc[df['current_dt'] < pd.Timestamp(start)]
+        latest = df.groupby(level='dt')['current_dt'].transform('max')
+        return df.loc[df['current_dt'] == latest]
+
+    def sync(self, dataset, table, intervals=None, site_id=None):
+        if site_id is None:
+            shutil.rmtree(self._table_dir(table), ignore_errors=True)
+            for site_id in dataset._table_site_ids(table):
+                self.sync(dataset, table, None, site_id)
+            return
+
+        site_dir = self._site_dir(table, site_id)
+        if intervals is None:
+            df = dataset._read_sql_dt_range(table, site_id)
+            shutil.rmtree(site_dir, ignore_errors=True)
+            if df.empty:
+                return
+            for period, df_period in df.groupby(pd.DatetimeIndex(df.index).to_period(self.partition_freq)):
+                self._write_partition(table, site_id, period, df_period)
+            _log.debug(f"Wrote all partitions of {table.name} to {site_dir}")
+            return
+
+        periods = set()
+        for start, end in intervals:
+            periods.update(pd.period_range(pd.Timestamp(start), pd.Timestamp(end), freq=self.partition_freq))
+        for period in sorted(periods):
+            df = dataset._read_sql_dt_range(table, site_id, period.start_time, period.end_time)
+            if df.empty:
+                self._partition_path(table, site_id, period).unlink(missing_ok=True)
+            else:
+                self._write_partition(table, site_id, period, df)
+        _log.debug(f"Wrote {len(periods)} partitions of {table.name} to {site_dir}")
+
+    def sync_if_missing(self, dataset, table):
+        # Copies made before the tables were partitioned by site have no site directories
+        if not any(self._table_dir(table).glob('site_id=*')):
+            self.sync(dataset, table)
+
+    def drop(self, dataset, table):
+        shutil.rmtree(self._table_dir(table), ignore_errors=True)
+
+    def _table_dir(self, table):
+        return self.root / table.name
+
+    def _site_dir(self, table, site_id):
+        return self._table_dir(table) / f'site_id={site_id}'
+
+    def _partition_path(self, table, site_id, period):
+        return self._site_dir(table, site_id) / f'{period}.parquet'
+
+    def _partition_files(self, table, site_id, start=None, end=None):
+        """ Return the files of the partitions of site_id that overlap start to end. """
+        site_dir = self._site_dir(table, site_id)
+        if not site_dir.is_dir():
+            return []
+        files = []
+        for f in sorted(site_dir.glob('*.parquet')):
+            period = pd.Period(f.stem, freq=self.partition_freq)
+            if start is not None and period.end_time < pd.Timestamp(start):
+                continue
+            if end is not None and period.start_time > pd.Timestamp(end):
+                continue
+            files.append(f)
+        return files
+
+    def _write_partition(self, table, site_id, period, df):
+        path = self._partition_path(table, site_id, period)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        arrow_table = pa.Table.from_pandas(df.reset_index(), schema=self._schema(table), preserve_index=False)
+        # Write to a temporary file first so that readers never see a partially written file
+        tmp_path = path.with_suffix('.tmp')
+        pq.write_table(arrow_table, tmp_path, compression=self.compression)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _schema(table):
+        fields = []
+        for c in table.columns:
+            # The site of the rows is given by the directory of the partition
+            if c.name in ('id', 'site_id'):
+                continue
+            if isinstance(c.type, sqlalchemy.DateTime):
+                pa_type = pa.timestamp('ns')
+            elif isinstance(c.type, sqlalchemy.Integer):
+                pa_type = pa.int64()
+            elif isinstance(c.type, sqlalchemy.Float):
+                pa_type = pa.float64()
+            else:
+                pa_type = pa.string()
+            fields.append(pa.field(c.name, pa_type))
+        return pa.schema(fields)
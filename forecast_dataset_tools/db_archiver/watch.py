@@ -0,0 +1,134 @@
+"""
+Watch mode of the archive command. The datasets, their database engine, and their in-memory
+state are kept between imports, and the data directories are polled for new and changed files,
+which are found cheaply using the files tables (see DataSet._files_to_import).
+"""
+import logging
+import signal
+import threading
+import time
+
+_log = logging.getLogger(__name__)
+
+
+class Watcher:
+    """ Imports the new and changed data files of datasets, a dict of DataSet by name, as they
+    appear, starting with the files that were not imported yet. The data directories are polled
+    every interval seconds. Files are imported once they have not been modified for debounce
+    seconds, so that files that are still being written are not read. Their raw data is imported
+    right away, and the processed data of a dataset is rebuilt once no files of it were imported
+    for debounce seconds, so that files that arrive together are processed together. Files are
+    parsed in a pool of that many worker processes if workers is not 1. """
+
+    def __init__(self, datasets, interval=2.0, debounce=2.0, workers=1):
+        self.datasets = datasets
+        self.interval = interval
+        self.debounce = debounce
+        self.workers = workers
+        self._stop = threading.Event()
+        # Time that files of each dataset were last imported, for the datasets whose processed
+        # data has not been rebuilt since
+        self._pending = {}
+        # Modification time of files that could not be imported, by file name. They are tried
+        # again once they are modified.
+        self._failed = {}
+        # Datasets whose files are imported one at a time, since importing several at once failed
+        # and which file failed is not known
+        self._one_at_a_time = set()
+
+    def run(self):
+        """ Poll the data directories until stop is called or the process receives SIGINT or
+        SIGTERM. Any pending rebuilds of processed data are done before returning. """
+        handlers = self._handle_signals()
+        _log.info(f"Watching for new data files every {self.interval} s")
+        try:
+            while not self._stop.is_set():
+                self.poll()
+                self._stop.wait(self.interval)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+            _log.info("Stopping. Rebuilding any pending processed data.")
+            self.flush()
+
+    def stop(self, *args):
+        """ Make run return after the current poll. Can be used as a signal handler. """
+        self._stop.set()
+
+    def poll(self):
+        """ Import the files of each dataset that are ready, and rebuild the processed data of the
+        datasets that have had no files to import for debounce seconds. """
+        for name, ds in self.datasets.items():
+            if self._stop.is_set():
+                break
+            now = time.time()
+            try:
+                files = ds._files_to_import(self._ready)
+            except Exception:
+                _log.error(f"Failed to check the data files of {name}", exc_info=True)
+                continue
+            if files:
+                _log.info(f"Importing {len(files)} files of {name}")
+                self._import(name, ds, files)
+                self._pending[name] = time.time()
+            elif name in self._pending and now - self._pending[name] >= self.debounce:
+                self._rebuild(name)
+
+    def flush(self):
+        """ Rebuild the processed data of all datasets that have files imported since it was last
+        rebuilt. """
+        for name in list(self._pending):
+            self._rebuild(name)
+
+    def _ready(self, file_name, st):
+        """ Whether the file with os.stat_result st can be imported: it has not been modified for
+        debounce seconds and has not failed to import since it was last modified. Files that are
+        not ready are not read, so that a file that is still being written is not hashed by each
+        poll. """
+        return (time.time() - st.st_mtime_ns / 1e9 >= self.debounce
+                and self._failed.get(file_name) != st.st_mtime_ns)
+
+    def _import(self, name, ds, files):
+        if len(files) > 1 and name not in self._one_at_a_time:
+            try:
+                ds._import_files(files, self.workers)
+            except Exception:
+                # The files imported before the failure are recorded in the files table, so the
+                # rest are listed again by the next poll
+                _log.warning(f"Failed to import files of {name}. Trying the rest one at a time.",
+                             exc_info=True)
+                self._one_at_a_time.add(name)
+            return
+        for f in files:
+            try:
+                ds._import_files([f], self.workers)
+            except Exception:
+                _log.error(f"Failed to import {f.name}. It is skipped until it is modified.",
+                           exc_info=True)
+                self._failed[f.name] = f.mtime_ns
+            else:
+                self._failed.pop(f.name, None)
+        self._one_at_a_time.discard(name)
+
+    def _rebuild(self, name):
+        ds = self.datasets[name]
+        _log.info(f"Rebuilding processed data of {name}")
+        try:
+            ds._update_processed_data(workers=self.workers)
+        except Exception:
+            # The raw data that was imported is still marked as unprocessed, and the dataset is
+            # still pending, so the rebuild is tried again after another debounce period
+            _log.error(f"Failed to rebuild the processed data of {name}", exc_info=True)
+            self._pending[name] = time.time()
+        else:
+            del self._pending[name]
+
+    def _handle_signals(self):
+        """ Make SIGINT and SIGTERM stop the watcher. Returns the previous handlers. Signal handlers
+        can only be set in the main thread, so nothing is done in other threads. """
+        if threading.current_thread() is not threading.main_thread():
+            return {}
+        handlers = {}
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            handlers[signum] = signal.signal(signum, self.stop)
+        return handlers
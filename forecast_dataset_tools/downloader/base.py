@@ -1,25 +1,165 @@
+import asyncio
+import functools
+import json
 import logging
+import logging.handlers
 import os
+from collections import Counter
 from datetime import datetime, timezone
 from math import nan
 
 import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .. import profiling
 
 _no_flag = object()
 
 logger = logging.getLogger(__name__)
 
+# Logger for the JSON payloads of responses when they are written to a separate file.
+# See enable_payload_log.
+payload_logger = logging.getLogger("forecast_dataset_tools.downloader.payloads")
+
+
+def log_payload(log, title, data):
+    """Log the JSON payload data of a response under the given title. If a payload log
+    file was set up with enable_payload_log, the payload is written there as one line
+    of JSON. Otherwise, it is logged to log as indented JSON at DEBUG level. The
+    payload is only serialized if it will be logged."""
+    if payload_logger.handlers:
+        if payload_logger.isEnabledFor(logging.DEBUG):
+            payload_logger.debug("%s %s", title, json.dumps(data))
+    elif log.isEnabledFor(logging.DEBUG):
+        log.debug("%s\n%s", title, json.dumps(data, indent=4))
+
+
+def enable_payload_log(filename, max_bytes=10 * 2**20, backup_count=5):
+    """Write the payloads of all responses to filename, one per line, instead of to the
+    DEBUG log. The file is rotated when it reaches max_bytes, keeping backup_count old
+    files."""
+    handler = logging.handlers.RotatingFileHandler(
+        filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+    )
+    handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    payload_logger.addHandler(handler)
+    payload_logger.setLevel(logging.DEBUG)
+    payload_logger.propagate = False
+    return handler
+
+
+def _has_key(d, key):
+    """Whether the dict d has the key, with keys of nested dicts joined by dots."""
+    for k in key.split("."):
+        if not isinstance(d, dict) or k not in d:
+            return False
+        d = d[k]
+    return True
+
+
+def to_utc_naive(s):
+    """Convert a Series of timestamp strings to naive datetimes in UTC, in one call."""
+    return pd.to_datetime(s, utc=True).dt.tz_localize(None)
+
 
 class WeatherService:
     _cfg_key = "Set a value for this service's group in config files."
     _missing = _no_flag
+    # Maximum number of requests to the service that are in progress at once when
+    # downloading concurrently
+    max_concurrency = 4
+    # Timeout in seconds for each HTTP request
+    request_timeout = 30
+    # Number of keep-alive connections kept open to each host
+    pool_size = 10
+    # Requests that fail with a connection error or one of retry_statuses are retried
+    # up to max_retries times, waiting retry_backoff * 2**(n - 1) seconds before the
+    # n-th retry, or as long as the Retry-After header of the response says.
+    max_retries = 3
+    retry_backoff = 0.5
+    retry_statuses = (429, 500, 502, 503, 504)
 
     def __init__(self, data_dir="weather_service", file_prefix=""):
         self.data_dir = data_dir
         self.file_prefix = file_prefix
+        self._semaphore = None
+        self._session = None
+        # Number of times each key was missing from the response being parsed
+        self._missing_keys = Counter()
+
+    @property
+    def session(self):
+        """requests Session shared by all requests to the service, so that connections
+        are reused. Made when first needed."""
+        if self._session is None:
+            retry = Retry(
+                total=self.max_retries,
+                backoff_factor=self.retry_backoff,
+                status_forcelist=self.retry_statuses,
+                allowed_methods=["GET"],
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=self.pool_size,
+                pool_maxsize=self.pool_size,
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._session = session
+        return self._session
+
+    def close(self):
+        """Close the connections of the session."""
+        if self._session is not None:
+            self._session.close()
+            self._session = None
 
     def get_rows(self, location):
-        """Override this function in subclasses. The important thing is
+        """Returns the data of get_df as a list of dicts."""
+        return self.get_df(location).to_dict("records")
+
+    def get_df(self, location):
+        """Gets data from API and returns the useful information as a DataFrame."""
+        return self._parse(location, self.get_data(location))
+
+    async def get_data_async(self, location):
+        """Coroutine version of get_data. Override in subclasses to make independent
+        requests concurrently. By default, get_data is run in a worker thread."""
+        async with self._limiter():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.get_data, location)
+
+    async def get_df_async(self, location):
+        """Coroutine version of get_df."""
+        return self._parse(location, await self.get_data_async(location))
+
+    async def get_rows_async(self, location):
+        """Coroutine version of get_rows."""
+        return (await self.get_df_async(location)).to_dict("records")
+
+    def _parse(self, location, data):
+        with profiling.span(
+            "download.parse", service=self._cfg_key, location=location.name
+        ) as s:
+            df = self._df_from_data(location, data)
+            s.set(rows=len(df))
+        if self._missing_keys:
+            counts = ", ".join(f'"{k}": {n}' for k, n in self._missing_keys.items())
+            logger.warning(
+                f"({self.__class__.__name__}) Missing keys in response for "
+                f"location={location.name} (key: count): {counts}"
+            )
+            self._missing_keys.clear()
+        return df
+
+    def _df_from_data(self, location, data):
+        """Override this function in subclasses to extract the useful information from
+        the data returned by get_data into a DataFrame. The important thing is
         for the column labels to be consistent. Here are some notes:
         current_dt: The datetime (UTC) when the data was provided from the service.
         dt: The datetime (UTC) corresponding to the weather observation or forecast.
@@ -28,30 +168,68 @@ class WeatherService:
             1 for hourly forecast
             2 for daily forecast
         """
-        pass
+        raise NotImplementedError
 
-    def get_df(self, location):
-        rows = self.get_rows(location)
-        # Convert list of dicts to DataFrame
-        df = pd.DataFrame(rows)
-        return df
+    def _columns(self, records, fields, optional=()):
+        """Extract columns from a list of dicts, such as a JSON array of forecasts.
+        fields maps each column name to a key of the dicts. Keys of nested dicts are
+        joined with dots, e.g. "temp.max". Missing keys are filled with nan and, unless
+        they are in optional, counted for a warning. Values equal to the service's
+        missing data flag are replaced with nan. Returns a DataFrame with one row per
+        dict."""
+        df = pd.json_normalize(records) if records else pd.DataFrame()
+        index = pd.RangeIndex(len(records))
+        columns = {}
+        for name, key in fields.items():
+            if key in df:
+                col = df[key]
+                if key not in optional and col.isna().any():
+                    n_missing = sum(not _has_key(r, key) for r in records)
+                    if n_missing:
+                        self._missing_keys[key] += n_missing
+            else:
+                col = pd.Series(nan, index=index)
+                if key not in optional and len(records):
+                    self._missing_keys[key] += len(records)
+            if self._missing is not _no_flag:
+                col = col.mask(
+                    (col == self._missing) | (col.astype(str) == str(self._missing))
+                )
+            columns[name] = col
+        return pd.DataFrame(columns, index=index)
 
-    def _g(cls, d, k, default=nan):
-        """Accesses a member of a dict and either returns the value. If access fails
-        for any reason, a default value is set. Some services may use a flag for
-        missing data, in which case the passed missing parameter is replaced with nan.
-        """
-        try:
-            val = d[k]
-        except KeyError:
-            val = default
-            print(f'WARNING: ({cls.__class__}) Missing key "{k}"')
-
-        if cls._missing is not _no_flag and (
-            val == cls._missing or val == str(cls._missing)
-        ):
-            val = default
-        return val
+    @staticmethod
+    def _with_columns(df, columns):
+        """Return df with columns, a dict of column name -> value or Series, inserted
+        before its own columns."""
+        return pd.DataFrame(columns, index=df.index).join(df)
+
+    def _get_json(self, url, params=None, headers=None):
+        """Make a GET request with the session and return the decoded JSON response."""
+        # The URL is recorded without params and headers, which may hold the API key
+        with profiling.span("download.request", service=self._cfg_key, url=url) as s:
+            response = self.session.get(
+                url, params=params, headers=headers, timeout=self.request_timeout
+            )
+            s.set(status=response.status_code, bytes=len(response.content))
+            return response.json()
+
+    async def _get_json_async(self, url, params=None, headers=None):
+        """Coroutine version of _get_json. The request is made in a worker thread once
+        fewer than max_concurrency requests to the service are in progress."""
+        async with self._limiter():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                None, functools.partial(self._get_json, url, params, headers)
+            )
+
+    def _limiter(self):
+        """Semaphore limiting the requests in progress to max_concurrency. A new one is
+        made for each event loop."""
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore[0] is not loop:
+            self._semaphore = (loop, asyncio.Semaphore(self.max_concurrency))
+        return self._semaphore[1]
 
     def save_to_csv(self, df):
         """Save a DataFrame to csv in the directory and filenameing structure for the class."""
@@ -63,4 +241,10 @@ class WeatherService:
         save_path = self.data_dir
         if not os.path.exists(save_path):
             os.makedirs(save_path)
-        df.to_csv(os.path.join(save_path, fn), index=False)
+        file_name = os.path.join(save_path, fn)
+        with profiling.span(
+            "download.save", service=self._cfg_key, file=file_name, rows=len(df)
+        ) as s:
+            df.to_csv(file_name, index=False)
+            if profiling.enabled():
+                s.set(bytes=os.path.getsize(file_name))
@@ -7,7 +7,10 @@ import click
 import pandas as pd
 
 import forecast_dataset_tools.config as fdt_config
+from forecast_dataset_tools import profiling
 
+from .base import enable_payload_log
+from .concurrent_download import download_concurrently
 from .mgm_havadurumu import MGMHavaDurumu
 from .openweather import OpenWeatherService
 from .solcast import SolcastService
@@ -20,45 +23,72 @@ cfg_cls_map = {cls._cfg_key: cls for cls in cls_list}
 
 @click.command()
 @fdt_config.config_file_option
-def download(config_filename):
+@click.option(
+    "--concurrent",
+    is_flag=True,
+    help="Download from all services and locations concurrently. The number of "
+    "requests in progress to each service is limited by max_concurrency, and each "
+    "request times out after request_timeout seconds. Both can be set in the "
+    "service's group in the config file.",
+)
+@click.option(
+    "--payload-log",
+    type=click.Path(dir_okay=False),
+    help="Write the JSON payloads of all responses to this file, which is rotated "
+    "when it reaches 10 MB.",
+)
+@profiling.profiling_options
+def download(config_filename, concurrent, payload_log, profile, profile_stats):
     """Download data using parameters from a TOML-format configuration file, and
     then export the data to csv files in the configured data directories."""
     click.echo("Starting to download....")
     cfg = fdt_config.load(config_filename)
+    if payload_log is not None:
+        enable_payload_log(payload_log)
 
+    with profiling.profile(profile, profile_stats):
+        _download(cfg, concurrent)
+
+
+def _download(cfg, concurrent):
+    """Download from the services configured in cfg and save the data to csv files."""
     locations = pd.read_csv(cfg["locations_file"])
 
-    # Retrieve results for any downloader classes mapped to groups in the config file
+    # Set up any downloader classes mapped to groups in the config file
+    services = []
     for cfg_key in cfg:
         if cfg_key not in cfg_cls_map:
             continue
-        _log.info(f"Processing {cfg_key}")
-
-        results_list = []
 
         cls = cfg_cls_map[cfg_key]
         svc_cfg = cfg[cfg_key]
         svc_init_args = inspect.signature(cls.__init__).parameters
         svc_args = {p: svc_cfg[p] for p in svc_init_args if p in svc_cfg}
         svc = cls(**svc_args)
-
-        for l in locations.itertuples():
-            _log.debug(
-                f"Preparing to download from service={type(svc)} for location={l.name}"
-            )
-            try:
-                df_l = svc.get_df(l)
-            except Exception as e:
-                if isinstance(e, SystemExit):
-                    raise e
-                _log.error(
-                    f"Exception while processing service={type(svc)}, location={l.name}",
-                    exc_info=True,
-                )
-            else:
-                if len(df_l) > 0:
-                    results_list.append(df_l)
-
+        for attr in [
+            "base_url",
+            "max_concurrency",
+            "request_timeout",
+            "pool_size",
+            "max_retries",
+            "retry_backoff",
+            "use_station_cache",
+            "station_cache_ttl",
+        ]:
+            if attr in svc_cfg:
+                setattr(svc, attr, svc_cfg[attr])
+        services.append(svc)
+
+    if concurrent:
+        results = download_concurrently(services, locations)
+    else:
+        results = []
+        for svc in services:
+            _log.info(f"Processing {svc._cfg_key}")
+            results.append(get_dfs(svc, locations))
+
+    for svc, results_list in zip(services, results):
+        svc.close()
         if results_list:
             df = pd.concat(results_list)
             svc.save_to_csv(df)
@@ -66,5 +96,28 @@ def download(config_filename):
     return None
 
 
+def get_dfs(svc, locations):
+    """Get the DataFrames for all locations from svc one at a time. Returns a list of
+    the non-empty DataFrames in the order of the locations."""
+    results_list = []
+    for l in locations.itertuples():
+        _log.debug(
+            f"Preparing to download from service={type(svc)} for location={l.name}"
+        )
+        try:
+            df_l = svc.get_df(l)
+        except Exception as e:
+            if isinstance(e, SystemExit):
+                raise e
+            _log.error(
+                f"Exception while processing service={type(svc)}, location={l.name}",
+                exc_info=True,
+            )
+        else:
+            if len(df_l) > 0:
+                results_list.append(df_l)
+    return results_list
+
+
 if __name__ == "__main__":
     download()
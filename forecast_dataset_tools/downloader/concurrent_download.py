@@ -0,0 +1,45 @@
+"""Download from several weather services and locations concurrently. Each service
+limits its own requests in progress to its max_concurrency, and the HTTP requests
+are made in a pool of worker threads."""
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+_log = logging.getLogger(__name__)
+
+
+async def get_dfs_async(svc, locations):
+    """Get the DataFrames for all locations from svc concurrently. Returns a list of
+    the non-empty DataFrames in the order of the locations. Locations that fail are
+    logged and skipped."""
+
+    async def get_df(l):
+        _log.debug(
+            f"Preparing to download from service={type(svc)} for location={l.name}"
+        )
+        try:
+            return await svc.get_df_async(l)
+        except Exception:
+            _log.error(
+                f"Exception while processing service={type(svc)}, location={l.name}",
+                exc_info=True,
+            )
+            return None
+
+    dfs = await asyncio.gather(*(get_df(l) for l in locations.itertuples()))
+    return [df for df in dfs if df is not None and len(df) > 0]
+
+
+def download_concurrently(services, locations):
+    """Get the DataFrames for all locations from all services concurrently. Returns a
+    list with the list of DataFrames from get_dfs_async for each service."""
+
+    async def run():
+        max_workers = max(1, sum(svc.max_concurrency for svc in services))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            asyncio.get_running_loop().set_default_executor(executor)
+            return await asyncio.gather(
+                *(get_dfs_async(svc, locations) for svc in services)
+            )
+
+    return asyncio.run(run())
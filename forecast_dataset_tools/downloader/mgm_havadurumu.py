@@ -1,11 +1,17 @@
+import asyncio
 import json
 import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 
 import pandas as pd
+import platformdirs
 import requests
 
-from .base import WeatherService
+from .base import WeatherService, log_payload, to_utc_naive
 
 _log = logging.getLogger(__name__)
 
@@ -14,9 +20,38 @@ class MGMHavaDurumu(WeatherService):
     base_url = "https://servis.mgm.gov.tr/web/"
     _cfg_key = "MGM Hava Durumu"
     _missing = -9999
+    _headers = {"Origin": "https://www.mgm.gov.tr"}
+    _ids_api_call = "merkezler/ililcesi"
+    # The station ids looked up for each (il, ilce) are cached on disk and reused for
+    # station_cache_ttl seconds. Older cached ids are used if the lookup fails.
+    station_cache_file = (
+        platformdirs.user_cache_path("forecast_dataset_tools") / "mgm_station_ids.json"
+    )
+    station_cache_ttl = 7 * 24 * 3600
+    use_station_cache = True
+    _station_id_keys = [
+        "merkezId",
+        "saatlikTahminIstNo",
+        "gunlukTahminIstNo",
+        "enlem",
+        "boylam",
+    ]
 
     def __init__(self, data_dir="MGM/HavaDurumu", file_prefix=""):
         super().__init__(data_dir, file_prefix)
+        self._station_cache = None
+        self._station_cache_lock = threading.Lock()
+
+    @contextmanager
+    def station_cache_disabled(self):
+        """Context manager in which station ids are always looked up from the service,
+        and the cache of station ids is neither used nor updated."""
+        use_station_cache = self.use_station_cache
+        self.use_station_cache = False
+        try:
+            yield self
+        finally:
+            self.use_station_cache = use_station_cache
 
     def get_data(self, location):
         # If site id is not set, no request can be done
@@ -25,170 +60,255 @@ class MGMHavaDurumu(WeatherService):
         if pd.isna(site_il) or pd.isna(site_ilce):
             return None
 
-        session = requests.session()  # Reuse the session object for efficiency
-
-        forecast_ids = self._get_forecast_ids(site_il, site_ilce, session)
+        forecast_ids = self._get_forecast_ids(site_il, site_ilce)
         if forecast_ids is None:
             _log.error(
                 "Failed to retrieve MGM forecast due to failure to get location ids."
             )
             return None
-        id_current = forecast_ids["merkezId"]
-        id_hourly_forecast = forecast_ids["saatlikTahminIstNo"]
-        id_daily_forecast = forecast_ids["gunlukTahminIstNo"]
 
-        headers = {"Origin": "https://www.mgm.gov.tr"}
-        data = dict()
+        data = {"lat": forecast_ids["enlem"], "lon": forecast_ids["boylam"]}
+        for key, api_call, payload in self._forecast_requests(forecast_ids):
+            response = self._get_json(
+                self.base_url + "/" + api_call,
+                params=payload,
+                headers=self._headers,
+            )
+            data[key] = self._check_response(api_call, response, site_il, site_ilce)
+        return data
 
-        data["lat"] = forecast_ids["enlem"]
-        data["lon"] = forecast_ids["boylam"]
+    async def get_data_async(self, location):
+        site_il = location.il
+        site_ilce = location.ilce
+        if pd.isna(site_il) or pd.isna(site_ilce):
+            return None
 
-        api_call = "sondurumlar"
-        payload = {"merkezid": id_current}
-        response = session.get(
-            self.base_url + "/" + api_call, params=payload, headers=headers
-        ).json()
-        _log.debug(f"MGM Hava Durumu {api_call} json response:")
-        for l in json.dumps(response, indent=4).splitlines():
-            _log.debug(l)
-        if "error" in response:
+        # The lookup makes at most one request, so all of it is run in a worker thread,
+        # the same code as for get_data
+        async with self._limiter():
+            forecast_ids = await asyncio.get_running_loop().run_in_executor(
+                None, self._get_forecast_ids, site_il, site_ilce
+            )
+        if forecast_ids is None:
             _log.error(
-                f"Failed to get {api_call} from MGM for {site_il=}, {site_ilce=}."
-                "Error: " + response["error"] + "/" + response["message"]
+                "Failed to retrieve MGM forecast due to failure to get location ids."
             )
-            data["current"] = None
-        else:
-            data["current"] = response[0]
+            return None
 
-        api_call = "tahminler/saatlik"
-        payload = {"istno": id_hourly_forecast}
-        response = session.get(
-            self.base_url + "/" + api_call, params=payload, headers=headers
-        ).json()
-        _log.debug(f"MGM Hava Durumu {api_call} json response:")
-        for l in json.dumps(response, indent=4).splitlines():
-            _log.debug(l)
-        if "error" in response:
-            _log.error(
-                f"Failed to get {api_call} from MGM for {site_il=}, {site_ilce=}."
-                "Error: " + response["error"] + "/" + response["message"]
+        # The current weather and forecasts only depend on the location ids
+        forecast_requests = self._forecast_requests(forecast_ids)
+        responses = await asyncio.gather(
+            *(
+                self._get_json_async(
+                    self.base_url + "/" + api_call, params=payload, headers=self._headers
+                )
+                for _, api_call, payload in forecast_requests
             )
-            data["hourly"] = None
-        else:
-            data["hourly"] = response[0]
+        )
+        data = {"lat": forecast_ids["enlem"], "lon": forecast_ids["boylam"]}
+        for (key, api_call, _), response in zip(forecast_requests, responses):
+            data[key] = self._check_response(api_call, response, site_il, site_ilce)
+        return data
 
-        api_call = "tahminler/gunluk"
-        payload = {"istno": id_daily_forecast}
-        response = session.get(
-            self.base_url + "/" + api_call, params=payload, headers=headers
-        ).json()
-        _log.debug(f"MGM Hava Durumu {api_call} json response:")
-        for l in json.dumps(response, indent=4).splitlines():
-            _log.debug(l)
+    @staticmethod
+    def _forecast_requests(forecast_ids):
+        """List of (key, api_call, payload) of the requests for the current weather,
+        hourly forecast, and daily forecast."""
+        return [
+            ("current", "sondurumlar", {"merkezid": forecast_ids["merkezId"]}),
+            (
+                "hourly",
+                "tahminler/saatlik",
+                {"istno": forecast_ids["saatlikTahminIstNo"]},
+            ),
+            ("daily", "tahminler/gunluk", {"istno": forecast_ids["gunlukTahminIstNo"]}),
+        ]
+
+    @staticmethod
+    def _check_response(api_call, response, site_il, site_ilce):
+        log_payload(_log, f"MGM Hava Durumu {api_call} json response:", response)
         if "error" in response:
             _log.error(
                 f"Failed to get {api_call} from MGM for {site_il=}, {site_ilce=}."
                 "Error: " + response["error"] + "/" + response["message"]
             )
-            data["daily"] = None
-        else:
-            data["daily"] = response[0]
-        return data
+            return None
+        return response[0]
 
-    def get_rows(self, location):
-        """Gets data from API, extracts the useful information in a list of dicts
-        suitable to be converted to a dataframe."""
-        rtn = []
-        data = self.get_data(location)
+    def _df_from_data(self, location, data):
+        """Extracts the useful information from the data into a DataFrame."""
         if data is None:
-            return []
+            return pd.DataFrame()
 
         if data["current"] and data["current"]["veriZamani"]:
             current_dt = self._fix_time(data["current"]["veriZamani"])
         else:
             current_dt = datetime.utcnow()
-        # TODO: Building the dict all at once means that if any item fails for
-        #  whatever reason, the whole row will be lost. Maybe better to build it
-        #  one item at a time and gracefully handle missing data.
+        common = {"location": location.name, "lat": data["lat"], "lon": data["lon"]}
+        dfs = []
         # Current weather
         if data["current"] is not None:
-            rtn.append(
+            current = self._columns(
+                [data["current"]],
                 {
-                    "location": location.name,
-                    "lat": data["lat"],
-                    "lon": data["lon"],
-                    "type": 0,
-                    "current_dt": current_dt,
-                    "dt": current_dt,
-                    "temp": self._g(data["current"], "sicaklik"),
-                    "clouds": self._g(
-                        data["current"], "kapalilik"
-                    ),  # Is this ever filled??
-                    "condition": self._g(data["current"], "hadiseKodu"),
-                    "humidity": self._g(data["current"], "nem"),
-                    "wind_speed": self._g(data["current"], "ruzgarHiz"),
-                    "wind_direction": self._g(data["current"], "ruzgarYon"),
+                    "temp": "sicaklik",
+                    "clouds": "kapalilik",  # Is this ever filled??
+                    "condition": "hadiseKodu",
+                    "humidity": "nem",
+                    "wind_speed": "ruzgarHiz",
+                    "wind_direction": "ruzgarYon",
                     # Preciptation comes in the following:
                     # yagis00Now, yagis10Dk, yagis1Saat, yagis6Saat, yagis12Saat, yagis24Saat
-                    "precipitation": self._g(data["current"], "yagis1Saat"),
-                    "precipitation_period": 60,  # Number of minutes for rain accumulation
-                }
+                    "precipitation": "yagis1Saat",
+                },
+            )
+            current = self._with_columns(
+                current,
+                {**common, "type": 0, "current_dt": current_dt, "dt": current_dt},
             )
+            # Number of minutes for rain accumulation
+            current["precipitation_period"] = 60
+            dfs.append(current)
         # Hourly forecasts
         if data["hourly"] is not None:
-            for h in data["hourly"]["tahmin"]:
-                rtn.append(
-                    {
-                        "location": location.name,
-                        "lat": data["lat"],
-                        "lon": data["lon"],
-                        "type": "hourly",
-                        "current_dt": self._fix_time(data["hourly"]["baslangicZamani"]),
-                        "dt": self._fix_time(self._g(h, "tarih")),
-                        "temp": self._g(h, "sicaklik"),
-                        "condition": self._g(h, "hadise"),
-                        "humidity": self._g(h, "nem"),
-                        "wind_speed": self._g(h, "ruzgarHizi"),
-                        "wind_direction": self._g(h, "ruzgarYonu"),
-                    }
-                )
+            hourly = self._columns(
+                data["hourly"]["tahmin"],
+                {
+                    "dt": "tarih",
+                    "temp": "sicaklik",
+                    "condition": "hadise",
+                    "humidity": "nem",
+                    "wind_speed": "ruzgarHizi",
+                    "wind_direction": "ruzgarYonu",
+                },
+            )
+            hourly = self._with_columns(
+                hourly.drop(columns="dt"),
+                {
+                    **common,
+                    "type": "hourly",
+                    "current_dt": self._fix_time(data["hourly"]["baslangicZamani"]),
+                    "dt": self._fix_times(hourly["dt"]),
+                },
+            )
+            dfs.append(hourly)
         # Daily forecasts
         d = data["daily"]
         if d is not None:
-            for dn in "12345":
-                rtn.append(
-                    {
-                        "location": location.name,
-                        "lat": data["lat"],
-                        "lon": data["lon"],
-                        "type": "daily",
-                        "current_dt": current_dt,
-                        "dt": self._fix_time(self._g(d, "tarihGun" + dn)),
-                        "temp_high": self._g(d, "enYuksekGun" + dn),
-                        "temp_low": self._g(d, "enDusukGun" + dn),
-                        "humidity_low": self._g(d, "enDusukNemGun" + dn),
-                        "humidity_high": self._g(d, "enYuksekNemGun" + dn),
-                        "wind_speed": self._g(d, "ruzgarHizGun" + dn),
-                        "wind_direction": self._g(d, "ruzgarYonGun" + dn),
-                        "condition": self._g(d, "hadiseGun" + dn),
-                    }
+            daily = pd.concat(
+                [
+                    self._columns(
+                        [d],
+                        {
+                            "dt": "tarihGun" + dn,
+                            "temp_high": "enYuksekGun" + dn,
+                            "temp_low": "enDusukGun" + dn,
+                            "humidity_low": "enDusukNemGun" + dn,
+                            "humidity_high": "enYuksekNemGun" + dn,
+                            "wind_speed": "ruzgarHizGun" + dn,
+                            "wind_direction": "ruzgarYonGun" + dn,
+                            "condition": "hadiseGun" + dn,
+                        },
+                    )
+                    for dn in "12345"
+                ],
+                ignore_index=True,
+            )
+            daily = self._with_columns(
+                daily.drop(columns="dt"),
+                {
+                    **common,
+                    "type": "daily",
+                    "current_dt": current_dt,
+                    "dt": self._fix_times(daily["dt"]),
+                },
+            )
+            dfs.append(daily)
+        if not dfs:
+            return pd.DataFrame()
+        return pd.concat(dfs, ignore_index=True)
+
+    def _get_forecast_ids(self, site_il, site_ilce):
+        """Return the forecast ids of the location, from the cache of station ids or
+        looked up from the service. Returns None if they could not be found."""
+        forecast_ids, fresh = self._read_station_cache(site_il, site_ilce)
+        if fresh:
+            return forecast_ids
+        try:
+            data = self._get_json(
+                self.base_url + "/" + self._ids_api_call,
+                params={"il": site_il},
+                headers=self._headers,
+            )
+        except requests.RequestException:
+            _log.warning(
+                f"Request for MGM forecast ids failed for {site_il=}, {site_ilce=}.",
+                exc_info=True,
+            )
+            data = None
+        return self._update_station_cache(site_il, site_ilce, data, forecast_ids)
+
+    def _read_station_cache(self, site_il, site_ilce):
+        """Return (forecast_ids, fresh) from the cache of station ids. forecast_ids is
+        None if there are no cached ids. fresh is True if they are within the TTL."""
+        if not self.use_station_cache:
+            return None, False
+        with self._station_cache_lock:
+            if self._station_cache is None:
+                self._station_cache = self._load_station_cache()
+            entry = self._station_cache.get(f"{site_il}/{site_ilce}")
+        if entry is None:
+            return None, False
+        fresh = time.time() - entry["time"] < self.station_cache_ttl
+        return pd.Series(entry["ids"], dtype=object), fresh
+
+    def _update_station_cache(self, site_il, site_ilce, data, cached_ids):
+        """Return the forecast ids from the response data of the lookup, and save them
+        in the cache. If the lookup failed, return cached_ids instead."""
+        forecast_ids = None
+        if data is not None:
+            forecast_ids = self._forecast_ids_from_response(data, site_il, site_ilce)
+        if forecast_ids is None:
+            if cached_ids is not None:
+                _log.warning(
+                    f"Using expired cached MGM forecast ids for {site_il=}, {site_ilce=}."
                 )
-        return rtn
+            return cached_ids
+        if self.use_station_cache:
+            ids = {k: forecast_ids[k] for k in self._station_id_keys}
+            # Convert numpy scalars to Python types for json
+            ids = {k: v.item() if hasattr(v, "item") else v for k, v in ids.items()}
+            with self._station_cache_lock:
+                if self._station_cache is None:
+                    self._station_cache = self._load_station_cache()
+                self._station_cache[f"{site_il}/{site_ilce}"] = {
+                    "time": time.time(),
+                    "ids": ids,
+                }
+                self._save_station_cache()
+        return forecast_ids
 
-    @classmethod
-    def _get_forecast_ids(cls, site_il, site_ilce, session=None):
-        if session is None:
-            session = requests.session()
-        payload = {"il": site_il}
-        headers = {"Origin": "https://www.mgm.gov.tr"}
-        api_call = "merkezler/ililcesi"
-        # TODO: Add context manager to allow to disable caching'
-        data = requests.get(
-            cls.base_url + "/" + api_call, params=payload, headers=headers
-        ).json()
-        _log.debug("MGM Hava Durumu merkezler/ililcesi json response:")
-        for l in json.dumps(data, indent=4).splitlines():
-            _log.debug(l)
+    def _load_station_cache(self):
+        try:
+            with open(self.station_cache_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            _log.warning(f"Ignoring invalid cache file {self.station_cache_file}")
+            return {}
+
+    def _save_station_cache(self):
+        os.makedirs(os.path.dirname(self.station_cache_file), exist_ok=True)
+        # Write to a temporary file first so that the cache file is never left partial
+        tmp_file = f"{self.station_cache_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self._station_cache, f, indent=1)
+        os.replace(tmp_file, self.station_cache_file)
+
+    @staticmethod
+    def _forecast_ids_from_response(data, site_il, site_ilce):
+        log_payload(_log, "MGM Hava Durumu merkezler/ililcesi json response:", data)
 
         if "error" in data:
             _log.error(
@@ -226,6 +346,12 @@ class MGMHavaDurumu(WeatherService):
         # dt = dt.tz_localize(None)
         return dt
 
+    @classmethod
+    def _fix_times(cls, s):
+        """Convert a Series of text timestamps from service to pandas datetimes"""
+        # Same conversion as _fix_time, in one call for all of the timestamps
+        return to_utc_naive(s)
+
     _weather_condition_map_tr = {
         "A": "Açık",
         "AB": "Az Bulutlu",
@@ -1,10 +1,10 @@
-import json
 import logging
 from datetime import datetime
 
-import requests
+import pandas as pd
+from dateutil.tz import gettz
 
-from .base import WeatherService
+from .base import WeatherService, log_payload
 
 _log = logging.getLogger(__name__)
 
@@ -19,18 +19,27 @@ class OpenWeatherService(WeatherService):
 
     def get_data(self, location):
         api_call = "onecall"
-        payload = {
+        data = self._get_json(self.base_url + api_call, params=self._payload(location))
+        return self._check_response(location, data)
+
+    async def get_data_async(self, location):
+        api_call = "onecall"
+        data = await self._get_json_async(
+            self.base_url + api_call, params=self._payload(location)
+        )
+        return self._check_response(location, data)
+
+    def _payload(self, location):
+        return {
             "appid": self.api_key,
             "lat": location.lat,
             "lon": location.lon,
             "exclude": "minutely,alerts",
             "units": "metric",
         }
-        data = requests.get(self.base_url + api_call, params=payload).json()
 
-        _log.debug("JSON response:")
-        for l in json.dumps(data, indent=4).splitlines():
-            _log.debug(l)
+    def _check_response(self, location, data):
+        log_payload(_log, "OpenWeather JSON response:", data)
         """
         Example response when API key is invalid:
         {
@@ -47,78 +56,92 @@ class OpenWeatherService(WeatherService):
 
         return data
 
-    def get_rows(self, location):
-        """Gets data from API, extracts the useful information in a list of dicts
-        suitable to be converted to a dataframe."""
-        rtn = []
-        data = self.get_data(location)
+    def _df_from_data(self, location, data):
+        """Extracts the useful information from the data into a DataFrame."""
         if data is None:
-            return None
+            return pd.DataFrame()
         current_dt = datetime.fromtimestamp(data["current"]["dt"])
-        # TODO: Building the dict all at once means that if any item fails for
-        #  whatever reason, the whole row will be lost. Maybe better to build it
-        #  one item at a time and gracefully handle missing data.
+        common = {"location": location.name, "lat": data["lat"], "lon": data["lon"]}
         # Current weather
-        rtn.append(
+        current = self._columns(
+            [data["current"]],
             {
-                "location": location.name,
-                "lat": data["lat"],
-                "lon": data["lon"],
-                "type": 0,
-                "current_dt": current_dt,
-                "dt": current_dt,
-                "temp": data["current"]["temp"],
-                "clouds": data["current"]["clouds"],
-                "humidity": data["current"]["humidity"],
-                "wind_speed": data["current"]["wind_speed"],
-                "wind_direction": data["current"]["wind_deg"],
+                "temp": "temp",
+                "clouds": "clouds",
+                "humidity": "humidity",
+                "wind_speed": "wind_speed",
+                "wind_direction": "wind_deg",
                 # Preciptation is not included unless it is non-zero.
-                "precipitation": data["current"].get("rain", {"1h": 0})["1h"],
-                "precipitation_period": 60,  # Number of minutes for rain accumulation
-            }
+                "precipitation": "rain.1h",
+            },
+            optional=["rain.1h"],
+        )
+        current = self._with_columns(
+            current, {**common, "type": 0, "current_dt": current_dt, "dt": current_dt}
         )
+        current["precipitation"] = current["precipitation"].fillna(0)
+        current["precipitation_period"] = 60  # Number of minutes for rain accumulation
         # Hourly forecasts
-        for h in data["hourly"]:
-            rtn.append(
-                {
-                    "location": location.name,
-                    "lat": data["lat"],
-                    "lon": data["lon"],
-                    "type": "hourly",
-                    "current_dt": current_dt,
-                    "dt": datetime.fromtimestamp(h["dt"]),
-                    "temp": h["temp"],
-                    "clouds": h["clouds"],
-                    "humidity": h["humidity"],
-                    "wind_speed": h["wind_speed"],
-                    "wind_direction": h["wind_deg"],
-                    "probability_of_preciptitation": h["pop"],
-                    # Preciptation is not included unless it is non-zero.
-                    # TODO: Need to confirm the key is right
-                    "precipitation": h.get("rain", {"1h": 0})["1h"],
-                    "precipitation_period": 60,
-                }
-            )
+        hourly = self._columns(
+            data["hourly"],
+            {
+                "dt": "dt",
+                "temp": "temp",
+                "clouds": "clouds",
+                "humidity": "humidity",
+                "wind_speed": "wind_speed",
+                "wind_direction": "wind_deg",
+                "probability_of_preciptitation": "pop",
+                # Preciptation is not included unless it is non-zero.
+                # TODO: Need to confirm the key is right
+                "precipitation": "rain.1h",
+            },
+            optional=["rain.1h"],
+        )
+        hourly = self._with_columns(
+            hourly.drop(columns="dt"),
+            {
+                **common,
+                "type": "hourly",
+                "current_dt": current_dt,
+                "dt": _local_times(hourly["dt"]),
+            },
+        )
+        hourly["precipitation"] = hourly["precipitation"].fillna(0)
+        hourly["precipitation_period"] = 60
         # Daily forecasts
-        for d in data["daily"]:
-            rtn.append(
-                {
-                    "location": location.name,
-                    "lat": data["lat"],
-                    "lon": data["lon"],
-                    "type": "daily",
-                    "current_dt": current_dt,
-                    "dt": datetime.fromtimestamp(d["dt"]),
-                    "temp_high": d["temp"]["max"],
-                    "temp_low": d["temp"]["min"],
-                    "clouds": d["clouds"],
-                    "humidity": d["humidity"],
-                    "wind_speed": d["wind_speed"],
-                    "wind_direction": d["wind_deg"],
-                    "probability_of_preciptitation": d["pop"],
-                    # Preciptation is not included unless it is non-zero.
-                    "precipitation": d.get("rain", 0),
-                    "precipitation_period": 60 * 24,
-                }
-            )
-        return rtn
+        daily = self._columns(
+            data["daily"],
+            {
+                "dt": "dt",
+                "temp_high": "temp.max",
+                "temp_low": "temp.min",
+                "clouds": "clouds",
+                "humidity": "humidity",
+                "wind_speed": "wind_speed",
+                "wind_direction": "wind_deg",
+                "probability_of_preciptitation": "pop",
+                # Preciptation is not included unless it is non-zero.
+                "precipitation": "rain",
+            },
+            optional=["rain"],
+        )
+        daily = self._with_columns(
+            daily.drop(columns="dt"),
+            {
+                **common,
+                "type": "daily",
+                "current_dt": current_dt,
+                "dt": _local_times(daily["dt"]),
+            },
+        )
+        daily["precipitation"] = daily["precipitation"].fillna(0)
+        daily["precipitation_period"] = 60 * 24
+        return pd.concat([current, hourly, daily], ignore_index=True)
+
+
+def _local_times(timestamps):
+    """Convert a Series of Unix timestamps to naive local times, as datetime.fromtimestamp
+    does for each of them."""
+    utc = pd.to_datetime(timestamps, unit="s", utc=True)
+    return utc.dt.tz_convert(gettz()).dt.tz_localize(None)
@@ -1,12 +1,11 @@
-import json
+import asyncio
 import logging
 import re
 from datetime import timedelta
 
 import pandas as pd
-import requests
 
-from .base import WeatherService
+from .base import WeatherService, log_payload, to_utc_naive
 
 _log = logging.getLogger(__name__)
 
@@ -49,9 +48,15 @@ def _parse_period(s):
     return ret
 
 
+def _parse_periods(s):
+    """Parse a Series of ISO duration strings. Each distinct string is parsed once."""
+    return pd.to_timedelta(s.map({p: _parse_period(p) for p in s.unique()}))
+
+
 class SolcastService(WeatherService):
     base_url = "https://api.solcast.com.au/"
     _cfg_key = "SolCast Weather"
+    _data_requests = ["forecasts", "estimated_actuals"]
 
     def __init__(self, api_key, data_dir="SolCast", file_prefix=""):
         super().__init__(data_dir, file_prefix)
@@ -62,25 +67,43 @@ class SolcastService(WeatherService):
         site_id = location.solcast_site_id
         if pd.isna(site_id):
             return None
+        payload = {"api_key": self.api_key, "format": "json"}
+        responses = [
+            self._get_json(self._url(location, data_request), params=payload)
+            for data_request in self._data_requests
+        ]
+        return self._merge_responses(location, responses)
+
+    async def get_data_async(self, location):
+        site_id = location.solcast_site_id
+        if pd.isna(site_id):
+            return None
+        payload = {"api_key": self.api_key, "format": "json"}
+        responses = await asyncio.gather(
+            *(
+                self._get_json_async(self._url(location, data_request), params=payload)
+                for data_request in self._data_requests
+            )
+        )
+        return self._merge_responses(location, responses)
+
+    def _url(self, location, data_request):
         api_call = "weather_sites"
+        return (
+            self.base_url
+            + api_call
+            + "/"
+            + location.solcast_site_id
+            + "/"
+            + data_request
+        )
+
+    def _merge_responses(self, location, responses):
         data = dict()
-        for data_request in ["forecasts", "estimated_actuals"]:
-            payload = {"api_key": self.api_key, "format": "json"}
-            data.update(
-                requests.get(
-                    self.base_url
-                    + api_call
-                    + "/"
-                    + location.solcast_site_id
-                    + "/"
-                    + data_request,
-                    params=payload,
-                ).json()
-            )
+        for response in responses:
+            data.update(response)
 
-        _log.debug("JSON response:")
-        for l in json.dumps(data, indent=4).splitlines():
-            _log.debug(l)
+        log_payload(_log, "SolCast JSON response:", data)
         """
         Example response when the API key is invalid:
 
@@ -101,55 +124,57 @@ class SolcastService(WeatherService):
 
         return data
 
-    def get_rows(self, location):
-        """Gets data from API, extracts the useful information in a list of dicts
-        suitable to be converted to a dataframe."""
-        rtn = []
-        data = self.get_data(location)
+    def _df_from_data(self, location, data):
+        """Extracts the useful information from the data into a DataFrame."""
         if data is None:
-            return []
+            return pd.DataFrame()
         f = data["forecasts"][0]
         current_dt = pd.to_datetime(f["period_end"]).tz_localize(None) - _parse_period(
             f["period"]
         )
-        rtn = []
-        for f in data["estimated_actuals"]:
-            rtn.append(
-                {
-                    "location": location.name,
-                    "lat": location.lat,
-                    "lon": location.lon,
-                    "type": 0,
-                    "current_dt": current_dt,
-                    "dt": pd.to_datetime(f["period_end"]).tz_localize(None)
-                    - _parse_period(f["period"]),
-                    "clouds": f["cloud_opacity"],
-                    "ghi": f["ghi"],
-                    "ebh": f["ebh"],
-                    "dni": f["dni"],
-                    "dhi": f["dhi"],
-                }
-            )
-        for f in data["forecasts"]:
-            rtn.append(
-                {
-                    "location": location.name,
-                    "lat": location.lat,
-                    "lon": location.lon,
-                    "type": f["period"],
-                    "current_dt": current_dt,
-                    "dt": pd.to_datetime(f["period_end"]).tz_localize(None)
-                    - _parse_period(f["period"]),
-                    "temp": f["air_temp"],
-                    "clouds": f["cloud_opacity"],
-                    "ghi": f["ghi"],
-                    "ghi90": f["ghi90"],
-                    "ghi10": f["ghi10"],
-                    "ebh": f["ebh"],
-                    "dni": f["dni"],
-                    "dni10": f["dni10"],
-                    "dni90": f["dni90"],
-                    "dhi": f["dhi"],
-                }
+        actuals = self._columns(
+            data["estimated_actuals"],
+            {
+                "period_end": "period_end",
+                "period": "period",
+                "clouds": "cloud_opacity",
+                "ghi": "ghi",
+                "ebh": "ebh",
+                "dni": "dni",
+                "dhi": "dhi",
+            },
+        )
+        forecasts = self._columns(
+            data["forecasts"],
+            {
+                "period_end": "period_end",
+                "period": "period",
+                "temp": "air_temp",
+                "clouds": "cloud_opacity",
+                "ghi": "ghi",
+                "ghi90": "ghi90",
+                "ghi10": "ghi10",
+                "ebh": "ebh",
+                "dni": "dni",
+                "dni10": "dni10",
+                "dni90": "dni90",
+                "dhi": "dhi",
+            },
+        )
+        dfs = []
+        for df, fx_type in [(actuals, 0), (forecasts, forecasts["period"])]:
+            dfs.append(
+                self._with_columns(
+                    df.drop(columns=["period_end", "period"]),
+                    {
+                        "location": location.name,
+                        "lat": location.lat,
+                        "lon": location.lon,
+                        "type": fx_type,
+                        "current_dt": current_dt,
+                        "dt": to_utc_naive(df["period_end"])
+                        - _parse_periods(df["period"]),
+                    },
+                )
             )
-        return rtn
+        return pd.concat(dfs, ignore_index=True)
@@ -0,0 +1,188 @@
+"""
+Lightweight timing of the stages of archiving and downloading. The stages are wrapped in
+spans, which record their wall time and details such as the dataset, file, and number of
+rows and bytes handled:
+
+    with profiling.span("archive.read_file", dataset=name, file=file_name) as s:
+        df = read(file_name)
+        s.set(rows=len(df))
+
+Spans are only recorded while profiling is enabled with enable() or profile(). Otherwise
+span() returns a shared object that does nothing, so the spans cost next to nothing.
+Spans are recorded in the process that enabled profiling, from any thread. Work done in
+worker processes is timed by the spans around waiting for its results.
+"""
+
+import cProfile
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+import click
+
+# Profiler that spans are recorded in, or None if profiling is disabled
+_profiler = None
+
+
+class Profiler:
+    """Record of the spans timed while profiling is enabled."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self.spans.append(record)
+
+    def report(self):
+        """Return a dict with the records of all spans, in the order they ended, and
+        their totals by span name and by dataset or service and span name."""
+        with self._lock:
+            spans = list(self.spans)
+        totals = {}
+        by_source = {}
+        for record in spans:
+            _add_to_total(totals, record["name"], record)
+            source = record.get("dataset", record.get("service"))
+            if source is not None:
+                _add_to_total(by_source.setdefault(source, {}), record["name"], record)
+        return {
+            "seconds": time.perf_counter() - self.start,
+            "totals": totals,
+            "by_source": by_source,
+            "spans": spans,
+        }
+
+
+class _Span:
+    """Span that is being timed. Details are added to its record with set()."""
+
+    __slots__ = ("_profiler", "_start", "record")
+
+    def __init__(self, profiler, name, details):
+        self._profiler = profiler
+        self.record = {"name": name, **details}
+
+    def set(self, **details):
+        self.record.update(details)
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        self.record["start"] = self._start - self._profiler.start
+        self.record["seconds"] = end - self._start
+        if exc_type is not None:
+            self.record["error"] = exc_type.__name__
+        self._profiler.add(self.record)
+
+
+class _NullSpan:
+    """Span returned while profiling is disabled, which records nothing."""
+
+    __slots__ = ()
+
+    def set(self, **details):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+def span(name, **details):
+    """Context manager that times the stage called name if profiling is enabled. The
+    keyword arguments, and any given to the set method of the span, are saved in its
+    record. Values should be JSON serializable."""
+    profiler = _profiler
+    if profiler is None:
+        return _null_span
+    return _Span(profiler, name, details)
+
+
+def enabled():
+    """Whether spans are being recorded."""
+    return _profiler is not None
+
+
+def enable():
+    """Start recording spans in a new Profiler and return it."""
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+
+def disable():
+    """Stop recording spans. Returns the Profiler they were recorded in, or None."""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+def add_spans(records):
+    """Add the records of spans timed in another process, such as a worker process that
+    enabled profiling itself, to the spans being recorded. Their start times are relative
+    to the start of profiling in that process. Does nothing if profiling is disabled."""
+    profiler = _profiler
+    if profiler is not None:
+        for record in records:
+            profiler.add(record)
+
+
+@contextmanager
+def profile(report_file=None, stats_file=None):
+    """Context manager that records spans while it is active if report_file is given,
+    and writes their report to it as JSON when it exits. If stats_file is given, the
+    code is also run under cProfile and its statistics are written to stats_file, which
+    can be read with pstats. Does nothing if neither is given."""
+    profiler = enable() if report_file is not None else None
+    c_profile = cProfile.Profile() if stats_file is not None else None
+    if c_profile is not None:
+        c_profile.enable()
+    try:
+        yield profiler
+    finally:
+        if c_profile is not None:
+            c_profile.disable()
+            c_profile.dump_stats(stats_file)
+        if profiler is not None:
+            disable()
+            with open(report_file, "w") as f:
+                json.dump(profiler.report(), f, indent=1, default=str)
+
+
+def profiling_options(f):
+    """Decorator adding the --profile and --profile-stats options, passed as profile and
+    profile_stats, to a click command."""
+    f = click.option(
+        "--profile-stats",
+        type=click.Path(dir_okay=False, writable=True),
+        help="Run under cProfile and write its statistics to this file, which can be "
+        "read with pstats.",
+    )(f)
+    f = click.option(
+        "--profile",
+        type=click.Path(dir_okay=False, writable=True),
+        help="Write a JSON report of the time spent in each stage, with the rows and "
+        "bytes handled, to this file.",
+    )(f)
+    return f
+
+
+def _add_to_total(totals, name, record):
+    total = totals.setdefault(name, {"count": 0, "seconds": 0.0})
+    total["count"] += 1
+    total["seconds"] += record["seconds"]
+    for key in ("rows", "bytes"):
+        if key in record:
+            total[key] = total.get(key, 0) + record[key]
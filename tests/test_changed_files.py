@@ -0,0 +1,106 @@
+"""
+Importing data files again after they changed should give the same data as a new import of the
+same files.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import sqlalchemy
+
+from forecast_dataset_tools.db_archiver.base import DataSet
+
+
+class CsvDataSet(DataSet):
+    """ Dataset of csv files with dt, location and value columns. """
+    def __init__(self, data_dir, db_engine):
+        super().__init__(db_engine, 'csv_dataset')
+        self.data_dir = data_dir
+
+    def _read_file(self, file_name):
+        return pd.read_csv(file_name, parse_dates=['dt'], index_col='dt')
+
+
+def write_file(file_name, start, end, value, locations=('A',), mtime=None):
+    dt = pd.date_range(start, end, freq='5min', inclusive='left')
+    df = pd.concat([pd.DataFrame({'dt': dt, 'location': location, 'value': value + np.arange(len(dt)) % 7})
+                    for location in locations])
+    df.to_csv(file_name, index=False)
+    # Make sure that the change is seen even if the file is rewritten within the mtime resolution
+    if mtime is not None:
+        os.utime(file_name, ns=(mtime, mtime))
+
+
+def import_data(data_dir, db_file):
+    ds = CsvDataSet(str(data_dir), sqlalchemy.create_engine(f'sqlite:///{db_file}'))
+    ds.import_new_data()
+    return ds
+
+
+def table_df(ds, table):
+    cols = [c for c in table.columns if c.name != 'id']
+    with ds.db_engine.connect() as conn:
+        df = pd.DataFrame(conn.execute(sqlalchemy.select(*cols)).all(), columns=[c.name for c in cols])
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+def assert_same_as_new_import(ds, tmp_path):
+    new = import_data(ds.data_dir, tmp_path / 'new.sqlite')
+    pd.testing.assert_frame_equal(table_df(ds, ds.data_table_raw), table_df(new, new.data_table_raw))
+    pd.testing.assert_frame_equal(table_df(ds, ds.data_table), table_df(new, new.data_table))
+    assert {k: list(v) for k, v in ds.intervals.items()} == {k: list(v) for k, v in new.intervals.items()}
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    data_dir = tmp_path / 'data'
+    data_dir.mkdir()
+    return data_dir
+
+
+def test_changed_file_keeps_data_of_overlapping_files(data_dir, tmp_path):
+    write_file(data_dir / 'a.csv', '2023-01-01', '2023-01-08', 10)
+    write_file(data_dir / 'b.csv', '2023-01-01', '2023-01-15', 20)
+    ds = import_data(data_dir, tmp_path / 'db.sqlite')
+    n_rows = len(table_df(ds, ds.data_table_raw))
+
+    write_file(data_dir / 'b.csv', '2023-01-08', '2023-01-15', 30, mtime=2_000_000_000 * 10**9)
+    ds.import_new_data()
+    assert len(table_df(ds, ds.data_table_raw)) == n_rows
+    assert_same_as_new_import(ds, tmp_path)
+
+
+def test_changed_file_does_not_replace_data_of_earlier_files(data_dir, tmp_path):
+    write_file(data_dir / 'a.csv', '2023-01-01', '2023-01-05', 10)
+    write_file(data_dir / 'b.csv', '2023-01-04', '2023-01-08', 20)
+    ds = import_data(data_dir, tmp_path / 'db.sqlite')
+
+    write_file(data_dir / 'b.csv', '2023-01-03', '2023-01-09', 30, mtime=2_000_000_000 * 10**9)
+    ds.import_new_data()
+    assert_same_as_new_import(ds, tmp_path)
+
+
+def test_changed_file_removes_data_it_no_longer_has(data_dir, tmp_path):
+    write_file(data_dir / 'a.csv', '2023-01-01', '2023-01-05', 10, locations=('A', 'B'))
+    write_file(data_dir / 'b.csv', '2023-01-05', '2023-01-09', 20, locations=('A', 'B'))
+    write_file(data_dir / 'c.csv', '2023-01-08', '2023-01-12', 30, locations=('A', 'B'))
+    ds = import_data(data_dir, tmp_path / 'db.sqlite')
+
+    write_file(data_dir / 'b.csv', '2023-01-06', '2023-01-07', 40, locations=('B',), mtime=2_000_000_000 * 10**9)
+    ds.import_new_data()
+    assert_same_as_new_import(ds, tmp_path)
+
+
+def test_overlapping_file_recorded_without_ranges(data_dir, tmp_path):
+    write_file(data_dir / 'a.csv', '2023-01-01', '2023-01-08', 10)
+    write_file(data_dir / 'b.csv', '2023-01-01', '2023-01-15', 20)
+    ds = import_data(data_dir, tmp_path / 'db.sqlite')
+    # As in databases made before the ranges of the files were recorded
+    table = ds.file_ranges_table
+    with ds.db_engine.begin() as conn:
+        conn.execute(sqlalchemy.delete(table).where(table.c.fname == str(data_dir / 'a.csv')))
+
+    write_file(data_dir / 'b.csv', '2023-01-08', '2023-01-15', 30, mtime=2_000_000_000 * 10**9)
+    ds.import_new_data()
+    assert_same_as_new_import(ds, tmp_path)
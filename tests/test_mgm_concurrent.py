@@ -0,0 +1,197 @@
+"""Tests of downloading from MGMHavaDurumu concurrently, against a local stub of the
+MGM service."""
+import json
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+import pytest
+
+from forecast_dataset_tools.downloader.cli import get_dfs
+from forecast_dataset_tools.downloader.concurrent_download import download_concurrently
+from forecast_dataset_tools.downloader.mgm_havadurumu import MGMHavaDurumu
+
+# Station ids of the districts of each province, as returned by merkezler/ililcesi
+STATIONS = {
+    "Ankara": [
+        ("Çankaya", 90601, 17130, 17130, 39.91, 32.86),
+        ("Keçiören", 90602, 17131, 17130, 39.98, 32.86),
+    ],
+    "İzmir": [("Konak", 93501, 17220, 17220, 38.42, 27.13)],
+}
+START = pd.Timestamp("2023-06-01 09:00")
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.000Z"
+
+
+def ids_response(il):
+    return [
+        {
+            "il": il,
+            "ilce": ilce,
+            "merkezId": merkez_id,
+            "saatlikTahminIstNo": saatlik,
+            "gunlukTahminIstNo": gunluk,
+            "enlem": lat,
+            "boylam": lon,
+        }
+        for ilce, merkez_id, saatlik, gunluk, lat, lon in STATIONS[il]
+    ]
+
+
+def current_response(merkez_id):
+    return [
+        {
+            "istNo": merkez_id,
+            "veriZamani": START.strftime(TIME_FORMAT),
+            "sicaklik": merkez_id % 30,
+            "kapalilik": 2,
+            "hadiseKodu": "AB",
+            "nem": 40,
+            "ruzgarHiz": 12.5,
+            "ruzgarYon": 180,
+            "yagis1Saat": -9999,
+        }
+    ]
+
+
+def hourly_response(istno):
+    times = pd.date_range(START, periods=8, freq="3h").strftime(TIME_FORMAT)
+    return [
+        {
+            "istNo": istno,
+            "baslangicZamani": START.strftime(TIME_FORMAT),
+            "tahmin": [
+                {
+                    "tarih": t,
+                    "sicaklik": istno % 30 + i,
+                    "hadise": "PB",
+                    "nem": 50,
+                    "ruzgarHizi": 10,
+                    "ruzgarYonu": 90,
+                }
+                for i, t in enumerate(times)
+            ],
+        }
+    ]
+
+
+def daily_response(istno):
+    daily = {"istNo": istno}
+    times = pd.date_range(START.floor("D"), periods=5, freq="1D").strftime(TIME_FORMAT)
+    for d, t in enumerate(times, start=1):
+        daily.update(
+            {
+                f"tarihGun{d}": t,
+                f"enYuksekGun{d}": 25 + d,
+                f"enDusukGun{d}": 10 + d,
+                f"enDusukNemGun{d}": 30,
+                f"enYuksekNemGun{d}": 70,
+                f"ruzgarHizGun{d}": 15,
+                f"ruzgarYonGun{d}": 270,
+                f"hadiseGun{d}": "A",
+            }
+        )
+    return [daily]
+
+
+class StubMGMHandler(BaseHTTPRequestHandler):
+    """Serves the requests made by MGMHavaDurumu, and counts them by api call."""
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        api_call = url.path.strip("/")
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        self.server.requests[api_call] += 1
+        if api_call == "merkezler/ililcesi":
+            body = ids_response(params["il"])
+        elif api_call == "sondurumlar":
+            body = current_response(int(params["merkezid"]))
+        elif api_call == "tahminler/saatlik":
+            body = hourly_response(int(params["istno"]))
+        elif api_call == "tahminler/gunluk":
+            body = daily_response(int(params["istno"]))
+        else:
+            self.send_error(404)
+            return
+        content = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubMGMHandler)
+    server.requests = Counter()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+@pytest.fixture
+def locations():
+    return pd.DataFrame(
+        {
+            "name": ["cankaya", "kecioren", "konak", "unknown"],
+            "il": ["Ankara", "Ankara", "İzmir", "İzmir"],
+            "ilce": ["Çankaya", "Keçiören", "Konak", "Bornova"],
+        }
+    )
+
+
+def make_service(stub_server, tmp_path):
+    svc = MGMHavaDurumu(data_dir=str(tmp_path))
+    svc.base_url = f"http://127.0.0.1:{stub_server.server_port}/"
+    svc.station_cache_file = tmp_path / "mgm_station_ids.json"
+    svc.max_concurrency = 3
+    return svc
+
+
+def test_concurrent_same_as_sequential(stub_server, tmp_path, locations):
+    svc = make_service(stub_server, tmp_path)
+    with svc.station_cache_disabled():
+        expected = get_dfs(svc, locations)
+        (dfs,) = download_concurrently([svc], locations)
+    svc.close()
+
+    assert [df["location"].iloc[0] for df in dfs] == ["cankaya", "kecioren", "konak"]
+    assert len(dfs) == len(expected)
+    for df, expected_df in zip(dfs, expected):
+        pd.testing.assert_frame_equal(df, expected_df)
+    # Each run looks up the ids of each location, and makes the three forecast
+    # requests for the locations that were found
+    assert stub_server.requests == {
+        "merkezler/ililcesi": 8,
+        "sondurumlar": 6,
+        "tahminler/saatlik": 6,
+        "tahminler/gunluk": 6,
+    }
+
+
+def test_concurrent_uses_station_cache(stub_server, tmp_path, locations):
+    svc = make_service(stub_server, tmp_path)
+    expected = get_dfs(svc, locations)
+    assert stub_server.requests["merkezler/ililcesi"] == 4
+
+    (dfs,) = download_concurrently([svc], locations)
+    svc.close()
+
+    for df, expected_df in zip(dfs, expected):
+        pd.testing.assert_frame_equal(df, expected_df)
+    # Only the location that was not found is looked up again
+    assert stub_server.requests["merkezler/ililcesi"] == 5
+    assert set(json.loads(svc.station_cache_file.read_text())) == {
+        "Ankara/Çankaya",
+        "Ankara/Keçiören",
+        "İzmir/Konak",
+    }